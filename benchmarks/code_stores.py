@@ -0,0 +1,108 @@
+"""Claim throughput of the discount code stores - claims per second from concurrent threads.
+
+Every store claims the same number of codes through `create_discount_code`, from threads
+with their own app context, against a file SQLite database in a temporary directory or the
+database given with --database-uri (DROPS ALL TABLES). The redis store runs against the
+in-process stand-in, and against a server when --redis-url is given (FLUSHES THE DATABASE).
+Claims of the redis store are persisted to SQL after the measurement, and timed separately.
+
+    python benchmarks/code_stores.py --claims 2000 --threads 8
+    python benchmarks/code_stores.py --redis-url redis://localhost:6379/15
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from hot_paths import CAMPAIGN_ID, create_benchmark_app, prepare_database
+
+from app import db
+from app.config import get_settings
+from app.discounts.code_fetch import create_discount_code
+from app.discounts.code_store import discount_code_store
+from app.models import AvailableDiscountCode
+from app.util.redis_client import create_redis_client
+
+
+def run_claims(app, user_ids: List[int], errors: List[Exception]) -> None:
+    with app.app_context():
+        for user_id in user_ids:
+            try:
+                create_discount_code(CAMPAIGN_ID, user_id)
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+
+def benchmark_store(
+    database_uri: str, redis_url: Optional[str], args: argparse.Namespace
+) -> Dict[str, float]:
+    os.environ["DISCOUNT_CODE_STORE"] = "redis" if redis_url else "sql"
+    if redis_url:
+        os.environ["DISCOUNT_CODE_STORE_REDIS_URL"] = redis_url
+        # Persistence is timed on its own, after the claims
+        os.environ["DISCOUNT_CODE_STORE_PERSIST_IN_BACKGROUND"] = "false"
+        create_redis_client(redis_url).flushall()
+    app = create_benchmark_app(database_uri)
+    prepare_database(app, args.claims)
+    if redis_url:
+        with app.app_context():
+            code_ids = [code_id for (code_id,) in db.session.query(AvailableDiscountCode.id)]
+            # Steady state after the switch - claims don't look users up in SQL
+            discount_code_store.store.backfill_user_keys()
+        discount_code_store.codes_added(CAMPAIGN_ID, code_ids)
+
+    errors: List[Exception] = []
+    threads = [
+        threading.Thread(
+            target=run_claims,
+            args=(app, list(range(index + 1, args.claims + 1, args.threads)), errors),
+        )
+        for index in range(args.threads)
+    ]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+
+    result = {"claims_per_second": round(args.claims / elapsed), "errors": len(errors)}
+    if redis_url:
+        start_time = time.perf_counter()
+        with app.app_context():
+            discount_code_store.persist_claimed()
+        result["persist_seconds"] = round(time.perf_counter() - start_time, 3)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--claims", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--database-uri", help="benchmark database, DROPS ALL TABLES")
+    parser.add_argument("--redis-url", help="benchmark Redis server, FLUSHES THE DATABASE")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_uri = args.database_uri or f"sqlite:///{directory}/benchmark.db"
+        stores = {"sql": None, "redis (memory)": "memory://benchmark"}
+        if args.redis_url:
+            stores["redis (server)"] = args.redis_url
+        results = {}
+        for store, redis_url in stores.items():
+            results[store] = benchmark_store(database_uri, redis_url, args)
+            get_settings.cache_clear()
+
+    print(f"\n{'store':<16}{'claims/s':>10}{'errors':>8}{'persist s':>11}")
+    for store, result in results.items():
+        persist_seconds = result.get("persist_seconds", "-")
+        print(
+            f"{store:<16}{result['claims_per_second']:>10}{result['errors']:>8}"
+            f"{persist_seconds:>11}"
+        )
+
+
+if __name__ == "__main__":
+    main()
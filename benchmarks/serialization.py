@@ -0,0 +1,73 @@
+"""Microbenchmark of response serialization - microseconds per response body.
+
+`jsonify` of the `to_dict` payload, as before the serialization layer, against the orjson
+and pre-encoded bodies. Both run in an app context, as in a request.
+
+    python benchmarks/serialization.py --number 100000
+"""
+import argparse
+import timeit
+from typing import Callable
+
+from flask import Flask, jsonify
+
+from app.models import FetchedDiscountCode
+from app.util.serialization import (
+    encode_error,
+    encode_fetched_discount_code,
+    json_response,
+)
+
+
+def jsonify_error(error_code: str, error_message: str = None):
+    payload = {"error_code": error_code}
+    if error_message is not None:
+        payload["error_message"] = error_message
+    return jsonify(payload)
+
+
+def microseconds_per_call(call: Callable[[], object], number: int, repeat: int) -> float:
+    best_seconds = min(timeit.repeat(call, number=number, repeat=repeat))
+    return best_seconds / number * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    discount_code = FetchedDiscountCode(
+        id="A1B2C3D4E5", campaign_id=1, user_id=123456, is_used=False
+    )
+    discount_code_dict = discount_code.to_dict()
+    benchmarks = {
+        # Body of a claim, from the model
+        "claim 201": (
+            lambda: jsonify(discount_code.to_dict()),
+            lambda: json_response(encode_fetched_discount_code(discount_code), 201),
+        ),
+        # Body of a lookup, from the cached dict
+        "lookup 200": (
+            lambda: jsonify(discount_code_dict),
+            lambda: json_response(discount_code_dict),
+        ),
+        "error 404": (
+            lambda: jsonify_error("DISCOUNT_CODE_NOT_FOUND"),
+            lambda: json_response(encode_error("DISCOUNT_CODE_NOT_FOUND"), 404),
+        ),
+        "error 409": (
+            lambda: jsonify_error("DISCOUNT_CODE_ALREADY_FETCHED"),
+            lambda: json_response(encode_error("DISCOUNT_CODE_ALREADY_FETCHED"), 409),
+        ),
+    }
+    with Flask(__name__).app_context():
+        print(f"{'response':<16}{'jsonify µs':>12}{'orjson µs':>12}{'speedup':>10}")
+        for name, (before, after) in benchmarks.items():
+            before_us = microseconds_per_call(before, args.number, args.repeat)
+            after_us = microseconds_per_call(after, args.number, args.repeat)
+            print(f"{name:<16}{before_us:>12.2f}{after_us:>12.2f}{before_us / after_us:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
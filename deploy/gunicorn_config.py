@@ -1,3 +1,52 @@
 import os
+import shutil
 
 bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 5000)}"
+# Imports and the app are loaded once in the master, workers start from a fork of it
+preload_app = os.getenv("GUNICORN_PRELOAD_APP", "false").lower() in ("1", "true")
+
+
+def on_starting(server):
+    """Refuse per-process idempotency responses with more than one worker or an unreachable
+    Redis of them, start with empty metrics of the workers - files of a previous run would be
+    aggregated."""
+    from app.discounts.idempotency import check_shared_store  # noqa
+
+    check_shared_store(server.cfg.workers)
+
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Pool of the preloaded app is not shared with the master and other workers."""
+    if server.cfg.preload_app:
+        from app.warmup import dispose_engine_after_fork  # noqa
+
+        dispose_engine_after_fork(server.app.wsgi())
+
+
+def post_worker_init(worker):
+    """Warm up the worker before it accepts requests (WARMUP_ENABLED)."""
+    from app.warmup import warmup  # noqa
+
+    warmup.warm_up(worker.wsgi)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drop live gauges of the exited worker from the aggregated metrics."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # noqa
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Return codes leased by the worker back to the shared pool."""
+    from app.discounts.code_lease import discount_code_lease_pool  # noqa
+
+    if discount_code_lease_pool.enabled:
+        with worker.wsgi.app_context():
+            discount_code_lease_pool.release_leases()
@@ -1,3 +1,4 @@
+import sys
 from subprocess import check_call
 
 
@@ -28,6 +29,10 @@ def lint() -> None:
     check_call(["bandit", "-r", "src"])
 
 
+def benchmark() -> None:
+    check_call([sys.executable, "benchmarks/hot_paths.py", *sys.argv[1:]])
+
+
 def test() -> None:
     check_call(["pytest"])
 
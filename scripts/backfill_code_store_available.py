@@ -0,0 +1,36 @@
+"""Pushes discount codes available in SQL to the Redis lists of the redis code store.
+
+Generation jobs and imports push only the codes they add, so codes generated while the app
+ran with the sql store reach the redis store through this script. Run it once, before the
+switch to `DISCOUNT_CODE_STORE=redis`, while no generation job or import is running.
+
+    DISCOUNT_CODE_STORE=redis python scripts/backfill_code_store_available.py
+"""
+import argparse
+
+from structlog import get_logger
+
+from app import create_app
+from app.discounts.code_store import RedisCodeStore, discount_code_store
+
+logger = get_logger(__name__)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    app = create_app()
+    if not isinstance(discount_code_store.store, RedisCodeStore):
+        parser.exit(1, "DISCOUNT_CODE_STORE is not redis\n")
+    with app.app_context():
+        try:
+            count = discount_code_store.store.backfill_available_codes(args.chunk_size)
+        except RuntimeError as exc:
+            parser.exit(1, f"{exc}\n")
+    logger.info("discount_code_store_available_backfilled", count=count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Sets Redis user keys of all discount codes fetched in SQL, for the redis code store.
+
+Until it has run, the first claim of every user through the redis store looks up a code the
+user fetched in SQL before the switch from the sql store. Run it once no worker claims
+through the sql store any more.
+
+    DISCOUNT_CODE_STORE=redis python scripts/backfill_code_store_users.py
+"""
+import argparse
+
+from structlog import get_logger
+
+from app import create_app
+from app.discounts.code_store import RedisCodeStore, discount_code_store
+
+logger = get_logger(__name__)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    app = create_app()
+    if not isinstance(discount_code_store.store, RedisCodeStore):
+        parser.exit(1, "DISCOUNT_CODE_STORE is not redis\n")
+    with app.app_context():
+        count = discount_code_store.store.backfill_user_keys(args.chunk_size)
+    logger.info("discount_code_store_users_backfilled", count=count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Query plans and timings of the claim and lookup queries before and after the migrations.
+
+Recreates the discount code tables with the schema before the first migration, loads the
+dataset, prints EXPLAIN (ANALYZE, BUFFERS) and timings, applies the migrations and does it again.
+PostgreSQL only. DROPS ALL TABLES of the database in SQLALCHEMY_DATABASE_URI.
+
+    python scripts/explain_claim_queries.py --rows 10000000
+"""
+import argparse
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.engine import Connection
+from structlog import get_logger
+
+from app import db
+from app.config import get_settings
+from app.discounts.code_generation import insert_discount_codes
+from app.discounts.code_store import _claim_statement
+from app.migrations import migrate
+from app.models import FetchedDiscountCode
+from app.util.code_generators import get_code_generator
+
+logger = get_logger(__name__)
+
+fetched_discount_codes = FetchedDiscountCode.__table__
+
+LEGACY_SCHEMA = [
+    "DROP TABLE available_discount_codes",
+    "DROP TABLE fetched_discount_codes",
+    "DELETE FROM schema_migrations",
+    """
+    CREATE TABLE available_discount_codes (
+        id VARCHAR(10) NOT NULL,
+        campaign_id INTEGER NOT NULL REFERENCES campaigns (id),
+        leased_by VARCHAR(64),
+        lease_expires_at TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id, campaign_id),
+        UNIQUE (id)
+    )
+    """,
+    """
+    CREATE TABLE fetched_discount_codes (
+        id VARCHAR(10) NOT NULL,
+        campaign_id INTEGER NOT NULL REFERENCES campaigns (id),
+        user_id INTEGER NOT NULL,
+        is_used BOOLEAN NOT NULL,
+        is_fetched_event_sent BOOLEAN NOT NULL,
+        PRIMARY KEY (id, campaign_id, user_id),
+        UNIQUE (id)
+    )
+    """,
+]
+
+
+def load_dataset(connection: Connection, rows: int, campaigns: int, fetched_rows: int) -> None:
+    """Codes of a campaign are stored next to each other, as written by a generation job."""
+    connection.execute(
+        text(
+            "INSERT INTO marketplace (id, name, website_url, is_approved, is_active) "
+            "VALUES (1, 'Benchmark', 'https://benchmark.com', true, true)"
+        )
+    )
+    connection.execute(
+        text(
+            "INSERT INTO campaigns (id, name, marketplace_id) "
+            "SELECT n, 'Campaign ' || n, 1 FROM generate_series(1, :campaigns) AS n"
+        ),
+        {"campaigns": campaigns},
+    )
+    connection.execute(
+        text(
+            "INSERT INTO available_discount_codes (id, campaign_id) "
+            "SELECT lpad(to_hex(n), 10, '0'), 1 + (n - 1) * :campaigns / :rows "
+            "FROM generate_series(1, :rows) AS n"
+        ),
+        {"campaigns": campaigns, "rows": rows},
+    )
+    connection.execute(
+        text(
+            "INSERT INTO fetched_discount_codes "
+            "(id, campaign_id, user_id, is_used, is_fetched_event_sent) "
+            "SELECT 'F' || lpad(to_hex(n), 9, '0'), 1 + (n - 1) * :campaigns / :rows, n, "
+            "false, true FROM generate_series(1, :rows) AS n"
+        ),
+        {"campaigns": campaigns, "rows": fetched_rows},
+    )
+
+
+def explain(connection: Connection, statement) -> str:
+    compiled = statement.compile(dialect=connection.dialect)
+    transaction = connection.begin()
+    try:
+        plan = connection.exec_driver_sql(
+            f"EXPLAIN (ANALYZE, BUFFERS) {compiled}", compiled.params
+        ).all()
+    finally:
+        # The claim deletes and inserts rows, the dataset stays the same for every run
+        transaction.rollback()
+    return "\n".join(row[0] for row in plan)
+
+
+def time_statement(connection: Connection, run: Callable[[], None], repeat: int) -> Dict:
+    timings_ms: List[float] = []
+    for _ in range(repeat):
+        transaction = connection.begin()
+        start_time = time.perf_counter()
+        run()
+        timings_ms.append((time.perf_counter() - start_time) * 1000)
+        transaction.rollback()
+    timings_ms.sort()
+    return {
+        "mean_ms": round(statistics.mean(timings_ms), 3),
+        "p95_ms": round(timings_ms[int((len(timings_ms) - 1) * 0.95)], 3),
+    }
+
+
+def measure(connection: Connection, campaigns: int, repeat: int, insert_rows: int) -> Dict:
+    with connection.begin():
+        connection.exec_driver_sql("ANALYZE")
+    # The last campaign - codes of all other campaigns come first in the table
+    claim = _claim_statement(campaigns, user_id=0)
+    lookup = select(fetched_discount_codes).where(
+        fetched_discount_codes.c.campaign_id == campaigns,
+        fetched_discount_codes.c.user_id == 1,
+    )
+    codes = get_code_generator().generate(connection, campaigns, insert_rows)
+
+    print("-- claim\n" + explain(connection, claim))
+    print("-- lookup\n" + explain(connection, lookup))
+    return {
+        "claim": time_statement(connection, lambda: connection.execute(claim).all(), repeat),
+        "lookup": time_statement(connection, lambda: connection.execute(lookup).all(), repeat),
+        f"insert {insert_rows} codes": time_statement(
+            connection, lambda: insert_discount_codes(campaigns, codes, connection), repeat=3
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--fetched-rows", type=int, default=1_000_000)
+    parser.add_argument("--campaigns", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--insert-rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    engine = create_engine(get_settings().SQLALCHEMY_DATABASE_URI)
+    if engine.dialect.name != "postgresql":
+        parser.error("PostgreSQL database is required")
+
+    with engine.connect() as connection:
+        with connection.begin():
+            db.metadata.drop_all(connection)
+            db.metadata.create_all(connection)
+            for statement in LEGACY_SCHEMA:
+                connection.execute(text(statement))
+            logger.info("loading_dataset", rows=args.rows, fetched_rows=args.fetched_rows)
+            load_dataset(connection, args.rows, args.campaigns, args.fetched_rows)
+
+        print("==== before migrations")
+        before = measure(connection, args.campaigns, args.repeat, args.insert_rows)
+        with connection.begin():
+            logger.info("applying_migrations", applied_versions=migrate(connection))
+        print("==== after migrations")
+        after = measure(connection, args.campaigns, args.repeat, args.insert_rows)
+
+    print(f"\n{'query':<24}{'before mean/p95 ms':>24}{'after mean/p95 ms':>24}")
+    for query, timings in before.items():
+        print(
+            f"{query:<24}"
+            f"{timings['mean_ms']:>12}/{timings['p95_ms']:<11}"
+            f"{after[query]['mean_ms']:>12}/{after[query]['p95_ms']:<11}"
+        )
+
+
+if __name__ == "__main__":
+    main()
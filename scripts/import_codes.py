@@ -0,0 +1,60 @@
+"""Imports discount codes from a NDJSON or CSV file to the available codes of a campaign.
+
+Same as `POST /api/discounts/<campaign_id>/manage/import` - the file is read one line at
+a time and codes are committed in chunks of `DISCOUNT_CODE_IMPORT_CHUNK_SIZE`.
+Use `-` to read standard input.
+
+    python scripts/import_codes.py --campaign-id 1 codes.csv
+    gunzip -c codes.ndjson.gz | python scripts/import_codes.py --campaign-id 1 --format ndjson -
+"""
+import argparse
+import sys
+
+from structlog import get_logger
+
+from app import create_app
+from app.config import get_settings
+from app.discounts.bulk import (
+    CSV_CONTENT_TYPES,
+    NDJSON_CONTENT_TYPES,
+    parse_code_ids,
+    with_totals,
+)
+from app.discounts.code_import import OUTCOMES, import_discount_codes
+from app.discounts.exceptions import CampaignNotFoundError
+
+logger = get_logger(__name__)
+
+CONTENT_TYPES = {"csv": CSV_CONTENT_TYPES[0], "ndjson": NDJSON_CONTENT_TYPES[0]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--campaign-id", type=int, required=True)
+    parser.add_argument("--format", choices=CONTENT_TYPES, help="default - the file extension")
+    parser.add_argument("path", help="NDJSON or CSV file, - for standard input")
+    args = parser.parse_args()
+    file_format = args.format or args.path.rpartition(".")[2].lower()
+    if file_format not in CONTENT_TYPES:
+        parser.error("--format is required for files without a .csv or .ndjson extension")
+
+    app = create_app()
+    with app.app_context():
+        stream = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+        with stream:
+            try:
+                chunks = import_discount_codes(
+                    campaign_id=args.campaign_id,
+                    code_ids=parse_code_ids(stream, CONTENT_TYPES[file_format]),
+                    chunk_size=get_settings().DISCOUNT_CODE_IMPORT_CHUNK_SIZE,
+                )
+            except CampaignNotFoundError:
+                parser.exit(1, f"Campaign {args.campaign_id} not found\n")
+            # Every committed chunk is logged by the import
+            for counts in with_totals(chunks, OUTCOMES):
+                if "totals" in counts:
+                    logger.info("discount_codes_import_finished", **counts["totals"])
+
+
+if __name__ == "__main__":
+    main()
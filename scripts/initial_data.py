@@ -4,6 +4,9 @@ from flask import Flask
 from structlog import get_logger
 
 from app import create_app, db
+from app.discounts.code_store import discount_code_store
+from app.discounts.counters import increment_campaign_counters
+from app.migrations import stamp
 from app.models import AvailableDiscountCode, Campaign, Marketplace
 
 logger = get_logger(__name__)
@@ -17,6 +20,8 @@ def initial_data(app: Flask):
     with app.app_context():
         db.drop_all()
         db.create_all()
+        with db.engine.begin() as connection:
+            stamp(connection)
 
         # Create Marketplace
         marketplace_1 = Marketplace(
@@ -54,12 +59,18 @@ def initial_data(app: Flask):
         db.session.commit()
 
         # Create available discount codes for the campaign
+        discount_codes_1 = []
         for _ in range(DISCOUNT_CODE_COUNT):
             discount_code_1 = AvailableDiscountCode(campaign_id=campaign_1.id)
             # discount_code_2 = AvailableDiscountCode(campaign_id=campaign_2.id)
             db.session.add(discount_code_1)
+            discount_codes_1.append(discount_code_1)
             # db.session.add(discount_code_2)
+        db.session.flush()
+        code_ids_1 = [discount_code.id for discount_code in discount_codes_1]
+        increment_campaign_counters(campaign_1.id, available=len(code_ids_1))
         db.session.commit()
+        discount_code_store.codes_added(campaign_1.id, code_ids_1)
 
 
 if __name__ == "__main__":
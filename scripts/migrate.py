@@ -0,0 +1,13 @@
+from structlog import get_logger
+
+from app import create_app, db
+from app.migrations import migrate
+
+logger = get_logger(__name__)
+
+
+if __name__ == "__main__":
+    app = create_app()
+    with app.app_context(), db.engine.begin() as connection:
+        applied_versions = migrate(connection)
+    logger.info("schema_migrated", applied_versions=applied_versions)
@@ -0,0 +1,26 @@
+import time
+
+from structlog import get_logger
+
+from app import create_app
+from app.discounts.code_store import discount_code_store
+from app.discounts.events import discount_code_event_relay
+
+logger = get_logger(__name__)
+
+POLL_INTERVAL_SECONDS = 1
+
+
+def relay_events_forever(app):
+    with app.app_context():
+        while True:
+            # Claims queued by the code store get their outbox events when they're persisted
+            persisted_count = discount_code_store.persist_claimed()
+            if not discount_code_event_relay.relay() and not persisted_count:
+                time.sleep(POLL_INTERVAL_SECONDS)
+
+
+if __name__ == "__main__":
+    app = create_app()
+    logger.info("relaying_discount_code_fetched_events")
+    relay_events_forever(app)
@@ -0,0 +1,35 @@
+"""Recomputes inventory counters of campaigns from the discount code tables.
+
+Counters are kept up to date by claims, generation jobs, imports and redemptions - run this
+after codes were changed by other means, e.g. by hand in SQL.
+
+    python scripts/repair_campaign_counters.py
+    python scripts/repair_campaign_counters.py --campaign-id 1 --campaign-id 2
+"""
+import argparse
+
+from structlog import get_logger
+
+from app import create_app
+from app.discounts.counters import repair_campaign_counters
+from app.discounts.exceptions import CampaignNotFoundError
+
+logger = get_logger(__name__)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--campaign-id", type=int, action="append", help="default - all campaigns")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        try:
+            repaired = repair_campaign_counters(args.campaign_id)
+        except CampaignNotFoundError:
+            parser.exit(1, "Campaign not found\n")
+        logger.info("campaign_counters_repair_finished", repaired_campaign_ids=list(repaired))
+
+
+if __name__ == "__main__":
+    main()
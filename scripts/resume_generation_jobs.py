@@ -0,0 +1,21 @@
+from structlog import get_logger
+
+from app import create_app, executor
+from app.config import get_settings
+from app.discounts.code_generation import (
+    resume_interrupted_generate_discount_codes_jobs,
+)
+
+logger = get_logger(__name__)
+
+
+if __name__ == "__main__":
+    app = create_app()
+    # Flask-Executor copies the request context into the background job
+    with app.test_request_context():
+        job_ids = resume_interrupted_generate_discount_codes_jobs(
+            commit_batch=get_settings().DISCOUNT_CODE_GENERATION_COMMIT_BATCH
+        )
+        logger.info("generation_jobs_resumed", job_ids=job_ids)
+        # Wait for the resumed jobs before exiting
+        executor.shutdown(wait=True)
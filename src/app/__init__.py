@@ -4,6 +4,7 @@ from flask_sqlalchemy import SQLAlchemy
 from structlog import get_logger
 
 from .config import get_settings
+from .metrics import metrics
 from .middleware import enrich_structlog_with_request_context
 from .util.structlog import configure_structlog_logging
 
@@ -22,11 +23,18 @@ def create_app() -> Flask:
     app_config = get_settings()
     app.config.from_object(app_config)
 
-    configure_structlog_logging(is_production=app_config.is_production)
+    configure_structlog_logging(
+        is_production=app_config.is_production,
+        async_logging=app_config.LOG_ASYNC_ENABLED,
+        queue_size=app_config.LOG_QUEUE_SIZE,
+        batch_size=app_config.LOG_BATCH_SIZE,
+        sample_rates=app_config.LOG_SAMPLE_RATES,
+    )
 
     # Init Flask plugins
     db.init_app(app)
     executor.init_app(app)
+    metrics.init_app(app)
 
     # Add routes
     # fmt: off
@@ -39,6 +47,33 @@ def create_app() -> Flask:
     app.register_blueprint(discounts_bp, url_prefix="/api/discounts")
     # fmt: on
 
+    # Init per-worker discount code state
+    # fmt: off
+    from .discounts.availability import campaign_availability_cache  # noqa
+    campaign_availability_cache.init_app(app)
+
+    from .discounts.code_cache import fetched_discount_code_cache  # noqa
+    fetched_discount_code_cache.init_app(app)
+
+    from .discounts.code_lease import discount_code_lease_pool  # noqa
+    discount_code_lease_pool.init_app(app)
+
+    from .discounts.code_store import discount_code_store  # noqa
+    discount_code_store.init_app(app)
+
+    from .discounts.events import discount_code_event_relay  # noqa
+    discount_code_event_relay.init_app(app)
+
+    from .discounts.claim_batching import discount_code_claim_coalescer  # noqa
+    discount_code_claim_coalescer.init_app(app)
+
+    from .discounts.idempotency import idempotent_responses  # noqa
+    idempotent_responses.init_app(app)
+
+    from .warmup import warmup  # noqa
+    warmup.init_app(app)
+    # fmt: on
+
     return app
 
 
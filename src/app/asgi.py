@@ -0,0 +1,187 @@
+"""ASGI variant of the discount code fetch API for asyncio servers.
+
+    uvicorn --factory app.asgi:create_asgi_app --workers 4
+
+Serves `POST` and `GET /api/discounts/<campaign_id>` with async SQLAlchemy sessions, so
+a request waiting on the database doesn't hold a worker. Responses and error codes are
+the same as of the Flask app, which still serves all other endpoints. The Flask app is
+created alongside for the shared per-worker state and the background outbox relay.
+"""
+import re
+import time
+from typing import Dict, Optional, Tuple
+
+from flask import Flask
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from structlog import get_logger
+from werkzeug.exceptions import InternalServerError, MethodNotAllowed, NotFound
+from werkzeug.http import HTTP_STATUS_CODES
+
+from . import create_app
+from .auth import InvalidAccessTokenError, User, decode_token
+from .config import get_settings
+from .discounts.code_fetch_async import (
+    create_discount_code,
+    get_already_created_discount_code_dict,
+)
+from .discounts.events import discount_code_event_relay
+from .discounts.exceptions import (
+    DiscountCodeAlreadyExistsError,
+    DiscountCodeNotAvailableError,
+)
+from .errors.exceptions import AppError
+from .metrics import DISCOUNT_CODE_CLAIMS, HTTP_REQUEST_DURATION, HTTP_REQUESTS
+from .util.serialization import dumps
+
+logger = get_logger(__name__)
+
+DISCOUNT_CODE_PATH = re.compile(r"^/api/discounts/(?P<campaign_id>\d+)/?$")
+# Route label of the metrics - same as of the Flask app
+DISCOUNT_CODE_ROUTE = "/api/discounts/<campaign_id>"
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_database_url(database_uri: str) -> URL:
+    url = make_url(database_uri)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+def current_user(headers: Dict[str, str]) -> User:
+    try:
+        token = decode_token(headers.get("authorization"))
+        return User(id=token["uid"])
+    except InvalidAccessTokenError as exc:
+        raise AppError(error_code="INVALID_ACCESS_TOKEN", status_code=401) from exc
+
+
+def error_payload(error_code: str, error_message: Optional[str] = None) -> dict:
+    payload = {"error_code": error_code}
+    if error_message is not None:
+        payload["error_message"] = error_message
+    return payload
+
+
+def http_error(code: int, description: str) -> Tuple[int, dict]:
+    return code, error_payload(
+        HTTP_STATUS_CODES[code], f"{code} {HTTP_STATUS_CODES[code]}: {description}"
+    )
+
+
+class AsyncDiscountsApp:
+    def __init__(self, flask_app: Flask) -> None:
+        app_config = get_settings()
+        if app_config.DISCOUNT_CODE_STORE != "sql":
+            # Claims run the SQL statements directly - codes of another store would be issued twice
+            raise ValueError("ASGI app supports only the sql discount code store")
+        database_url = async_database_url(app_config.SQLALCHEMY_DATABASE_URI)
+        engine_options = {}
+        # Same pool as the Flask app, SQLite opens a connection per session without a pool
+        if database_url.get_backend_name() != "sqlite":
+            if app_config.SQLALCHEMY_POOL_SIZE is not None:
+                engine_options["pool_size"] = app_config.SQLALCHEMY_POOL_SIZE
+            if app_config.SQLALCHEMY_MAX_OVERFLOW is not None:
+                engine_options["max_overflow"] = app_config.SQLALCHEMY_MAX_OVERFLOW
+        self.flask_app = flask_app
+        self.engine = create_async_engine(
+            database_url, echo=app_config.SQLALCHEMY_ECHO, **engine_options
+        )
+        self.session_factory = sessionmaker(
+            self.engine, class_=AsyncSession, expire_on_commit=False
+        )
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        started_at = time.perf_counter()
+        status_code, payload = await self.handle(scope)
+        route = DISCOUNT_CODE_ROUTE if DISCOUNT_CODE_PATH.match(scope["path"]) else "<unmatched>"
+        HTTP_REQUEST_DURATION.labels(route, scope["method"]).observe(
+            time.perf_counter() - started_at
+        )
+        HTTP_REQUESTS.labels(route, scope["method"], status_code).inc()
+        body = dumps(payload)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def handle(self, scope: dict) -> Tuple[int, dict]:
+        match = DISCOUNT_CODE_PATH.match(scope["path"])
+        if not match:
+            return http_error(NotFound.code, NotFound.description)
+        if scope["method"] not in ("GET", "POST"):
+            return http_error(MethodNotAllowed.code, MethodNotAllowed.description)
+        campaign_id = int(match["campaign_id"])
+        headers = {
+            name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]
+        }
+        try:
+            user = current_user(headers)
+            async with self.session_factory() as session:
+                if scope["method"] == "POST":
+                    return 201, await self.create_discount_code(session, campaign_id, user)
+                return 200, await self.get_discount_code(session, campaign_id, user)
+        except AppError as exc:
+            logger.error(
+                "app_error",
+                error_class_name=exc.__class__.__name__,
+                error_code=exc.error_code,
+                error_message=exc.error_message,
+            )
+            return exc.status_code, error_payload(exc.error_code, exc.error_message)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("unhandled_exception")
+            return InternalServerError.code, error_payload(
+                HTTP_STATUS_CODES[InternalServerError.code], InternalServerError.description
+            )
+
+    async def create_discount_code(
+        self, session: AsyncSession, campaign_id: int, user: User
+    ) -> dict:
+        try:
+            discount_code = await create_discount_code(session, campaign_id, user["id"])
+        except DiscountCodeNotAvailableError as exc:
+            DISCOUNT_CODE_CLAIMS.labels("not_available").inc()
+            raise AppError(error_code="DISCOUNT_CODE_NOT_AVAILABLE", status_code=404) from exc
+        except DiscountCodeAlreadyExistsError as exc:
+            DISCOUNT_CODE_CLAIMS.labels("already_fetched").inc()
+            raise AppError(error_code="DISCOUNT_CODE_ALREADY_FETCHED", status_code=409) from exc
+        DISCOUNT_CODE_CLAIMS.labels("created").inc()
+        # Event is already in the outbox - the relay publishes it in the next batch
+        discount_code_event_relay.schedule()
+        return discount_code
+
+    async def get_discount_code(self, session: AsyncSession, campaign_id: int, user: User) -> dict:
+        discount_code = await get_already_created_discount_code_dict(
+            session, campaign_id, user["id"]
+        )
+        if not discount_code:
+            raise AppError(error_code="DISCOUNT_CODE_NOT_FOUND", status_code=404)
+        return discount_code
+
+
+def create_asgi_app() -> AsyncDiscountsApp:
+    return AsyncDiscountsApp(create_app())
@@ -1,9 +1,9 @@
 from __future__ import annotations
 
 from functools import lru_cache
-from typing import Optional
+from typing import Dict, Optional
 
-from pydantic import BaseSettings
+from pydantic import BaseSettings, root_validator
 
 
 @lru_cache
@@ -25,7 +25,103 @@ class Settings(BaseSettings):
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
     SQLALCHEMY_ECHO: bool = False
 
+    # Render and write log events in a background thread, events are dropped when the queue
+    # is full. Sample rates keep a share of events by name, e.g. {"discount_code_created": 0.1}
+    LOG_ASYNC_ENABLED: bool = False
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_BATCH_SIZE: int = 500
+    LOG_SAMPLE_RATES: Dict[str, float] = {}
+
+    # Open pool connections and compile the claim and lookup statements before a gunicorn
+    # worker takes traffic, GET /ready responds 503 until then
+    WARMUP_ENABLED: bool = False
+    WARMUP_POOL_CONNECTIONS: int = 4
+
+    # Prometheus metrics at GET /metrics, set PROMETHEUS_MULTIPROC_DIR for multiple workers
+    METRICS_ENABLED: bool = True
+
     DISCOUNT_CODE_GENERATION_COMMIT_BATCH: int = 100000
+    DISCOUNT_CODE_GENERATION_CHUNK_SIZE: int = 10000
+    # Running job without progress for this long is considered interrupted and can be resumed
+    DISCOUNT_CODE_GENERATION_JOB_STALE_SECONDS: int = 300
+    # More than 1 process generates jobs larger than one shard in parallel worker processes
+    DISCOUNT_CODE_GENERATION_PROCESSES: int = 1
+    DISCOUNT_CODE_GENERATION_SHARD_SIZE: int = 1000000
+    DISCOUNT_CODE_GENERATION_SHARD_RETRIES: int = 2
+
+    # random or permutation, see util/code_generators.py
+    DISCOUNT_CODE_GENERATOR: str = "random"
+    DISCOUNT_CODE_ALPHABET: str = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+    # Up to 10 chars - length of the code id columns
+    DISCOUNT_CODE_LENGTH: int = 10
+    # Codes of the permutation generator can't be guessed without the key, required by it.
+    # Changing the key of campaigns with generated codes can produce already existing codes
+    DISCOUNT_CODE_PERMUTATION_KEY: Optional[str] = None
+
+    # sql or redis, see discounts/code_store.py. memory:// is an in-process stand-in of Redis
+    DISCOUNT_CODE_STORE: str = "sql"
+    DISCOUNT_CODE_STORE_REDIS_URL: str = "redis://localhost:6379/0"
+    DISCOUNT_CODE_STORE_PERSIST_BATCH: int = 500
+    # Disable to persist claims only in a separate process - scripts/relay_events.py
+    DISCOUNT_CODE_STORE_PERSIST_IN_BACKGROUND: bool = True
+
+    DISCOUNT_CODE_LEASE_ENABLED: bool = False
+    DISCOUNT_CODE_LEASE_BLOCK_SIZE: int = 100
+    DISCOUNT_CODE_LEASE_REFILL_THRESHOLD: int = 20
+    DISCOUNT_CODE_LEASE_TTL_SECONDS: int = 300
+    # Codes of a lease aren't handed out for this long before it expires
+    DISCOUNT_CODE_LEASE_SAFETY_MARGIN_SECONDS: int = 30
+
+    DISCOUNT_CODE_BATCH_CLAIM_MAX_USERS: int = 10000
+    # Reported redemptions are committed in chunks of code ids, see discounts/redemption.py
+    DISCOUNT_CODE_REDEMPTION_CHUNK_SIZE: int = 1000
+    # Rows fetched from the server-side cursor and written at a time, see discounts/export.py
+    DISCOUNT_CODE_EXPORT_CHUNK_SIZE: int = 5000
+    # Imported codes are deduplicated and committed in chunks, see discounts/code_import.py
+    DISCOUNT_CODE_IMPORT_CHUNK_SIZE: int = 10000
+    # Rows per campaign the inventory counters are spread over, see discounts/counters.py
+    CAMPAIGN_COUNTER_STRIPES: int = 8
+
+    # Responses of claims with an Idempotency-Key header are replayed to retries, see
+    # discounts/idempotency.py. The default memory:// URL is per process - gunicorn with more
+    # than one worker refuses to start with it, or with a redis:// URL it can't reach
+    IDEMPOTENCY_ENABLED: bool = True
+    IDEMPOTENCY_REDIS_URL: str = "memory://idempotency?max_keys=100000"
+    IDEMPOTENCY_TTL_SECONDS: int = 86400
+    # Retries wait for the first request until it responds or its key expires
+    IDEMPOTENCY_LOCK_TTL_SECONDS: float = 30.0
+    IDEMPOTENCY_WAIT_SECONDS: float = 10.0
+    IDEMPOTENCY_POLL_INTERVAL_MS: float = 10.0
+    IDEMPOTENCY_MAX_KEY_LENGTH: int = 255
+
+    # Concurrent claims for the same campaign are claimed in one transaction per worker
+    DISCOUNT_CODE_CLAIM_BATCHING_ENABLED: bool = False
+    DISCOUNT_CODE_CLAIM_BATCHING_WINDOW_MS: float = 5.0
+    DISCOUNT_CODE_CLAIM_BATCHING_MAX_SIZE: int = 100
+
+    DISCOUNT_CODE_AVAILABILITY_CACHE_TTL_SECONDS: float = 1.0
+
+    DISCOUNT_CODE_CACHE_MAX_SIZE: int = 100000
+    DISCOUNT_CODE_CACHE_TTL_SECONDS: float = 30.0
+    DISCOUNT_CODE_CACHE_NEGATIVE_MAX_SIZE: int = 10000
+    DISCOUNT_CODE_CACHE_NEGATIVE_TTL_SECONDS: float = 1.0
+
+    # log, memory or file
+    DISCOUNT_CODE_EVENT_SINK: str = "log"
+    DISCOUNT_CODE_EVENT_SINK_FILE: str = "discount_code_events.ndjson"
+    DISCOUNT_CODE_EVENT_RELAY_BATCH: int = 500
+    # Disable to run the relay only as a separate process - scripts/relay_events.py
+    DISCOUNT_CODE_EVENT_RELAY_IN_BACKGROUND: bool = True
+
+    @root_validator(skip_on_failure=True)
+    def check_permutation_key(cls, values: dict) -> dict:  # pylint: disable=no-self-argument
+        if values["DISCOUNT_CODE_GENERATOR"] == "permutation" and not values.get(
+            "DISCOUNT_CODE_PERMUTATION_KEY"
+        ):
+            raise ValueError(
+                "DISCOUNT_CODE_PERMUTATION_KEY is required by the permutation generator"
+            )
+        return values
 
     @property
     def is_production(self) -> bool:
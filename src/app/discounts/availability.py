@@ -0,0 +1,82 @@
+"""In-process cache of per-campaign discount code availability.
+
+Lets exhausted campaigns be answered with DISCOUNT_CODE_NOT_AVAILABLE without a database
+round trip. The exhausted flag lives for a short TTL only, because codes generated by
+another worker invalidate the cache of that worker alone.
+"""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict
+
+from flask import Flask
+
+from ..config import get_settings
+
+
+@dataclass
+class CampaignAvailability:
+    is_exhausted: bool = False
+    exhausted_until: float = 0.0
+
+
+class CampaignAvailabilityCache:
+    def __init__(self) -> None:
+        self.ttl = 1.0
+        self.hits = 0
+        self.misses = 0
+        self._campaigns: Dict[str, CampaignAvailability] = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask) -> None:  # pylint: disable=unused-argument
+        self.ttl = get_settings().DISCOUNT_CODE_AVAILABILITY_CACHE_TTL_SECONDS
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._campaigns = {}
+            self.hits = 0
+            self.misses = 0
+
+    def is_exhausted(self, campaign_id: int) -> bool:
+        """Returns True if the campaign is known to have no codes left - a cache hit."""
+        with self._lock:
+            availability = self._campaigns.get(str(campaign_id))
+            if (
+                availability
+                and availability.is_exhausted
+                and availability.exhausted_until > time.monotonic()
+            ):
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def mark_exhausted(self, campaign_id: int) -> None:
+        with self._lock:
+            availability = self._campaigns.setdefault(str(campaign_id), CampaignAvailability())
+            availability.is_exhausted = True
+            availability.exhausted_until = time.monotonic() + self.ttl
+
+    def codes_added(self, campaign_id: int) -> None:
+        """Invalidates the exhausted flag after new codes for the campaign are committed."""
+        with self._lock:
+            availability = self._campaigns.get(str(campaign_id))
+            if availability:
+                availability.is_exhausted = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "exhausted_campaigns": sum(
+                    1
+                    for availability in self._campaigns.values()
+                    if availability.is_exhausted and availability.exhausted_until > now
+                ),
+            }
+
+
+campaign_availability_cache = CampaignAvailabilityCache()
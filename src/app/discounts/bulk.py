@@ -0,0 +1,76 @@
+"""Bulk request bodies of discount code ids, read and processed one chunk at a time.
+
+Bodies are NDJSON lines of a code id string or an object with `id`, or CSV rows with the code
+id in the first column and an optional header row. Lines are read one at a time, so memory
+doesn't grow with the body.
+"""
+import csv
+from typing import IO, Iterator, Optional, Sequence
+
+import orjson
+
+from ..models import FetchedDiscountCode
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+CSV_CONTENT_TYPES = ("text/csv",)
+CSV_HEADERS = ("id", "code", "code_id", "discount_code")
+# Longer lines are never valid code ids - they are skipped without being read into memory
+MAX_LINE_BYTES = 1024
+CODE_ID_MAX_LENGTH = FetchedDiscountCode.__table__.c.id.type.length
+
+
+def _iter_lines(stream: IO[bytes]) -> Iterator[Optional[bytes]]:
+    """Lines of the stream, None for lines longer than `MAX_LINE_BYTES`."""
+    while True:
+        line = stream.readline(MAX_LINE_BYTES + 1)
+        if not line:
+            return
+        if len(line) > MAX_LINE_BYTES:
+            while line and not line.endswith(b"\n"):
+                line = stream.readline(MAX_LINE_BYTES)
+            yield None
+            continue
+        yield line
+
+
+def _parse_ndjson_line(line: bytes) -> Optional[str]:
+    try:
+        value = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return None
+    if isinstance(value, dict):
+        value = value.get("id")
+    return value if isinstance(value, str) else None
+
+
+def _parse_csv_line(line: bytes) -> Optional[str]:
+    try:
+        row = next(csv.reader([line.decode()]), [])
+    except (UnicodeDecodeError, csv.Error):
+        return None
+    return row[0].strip() if row else None
+
+
+def parse_code_ids(stream: IO[bytes], content_type: str) -> Iterator[Optional[str]]:
+    """Code ids of a NDJSON or CSV body, None for invalid lines. Blank lines are skipped."""
+    is_csv = content_type in CSV_CONTENT_TYPES
+    parse_line = _parse_csv_line if is_csv else _parse_ndjson_line
+    for line_number, line in enumerate(_iter_lines(stream)):
+        if line is not None and not line.strip():
+            continue
+        code_id = parse_line(line) if line is not None else None
+        if is_csv and line_number == 0 and code_id and code_id.lower() in CSV_HEADERS:
+            continue
+        if code_id is not None and not 0 < len(code_id) <= CODE_ID_MAX_LENGTH:
+            code_id = None
+        yield code_id
+
+
+def with_totals(chunks: Iterator[dict], outcomes: Sequence[str]) -> Iterator[dict]:
+    """Counts of every chunk with its 1-based number, followed by the totals of all chunks."""
+    totals = dict.fromkeys(outcomes, 0)
+    for number, counts in enumerate(chunks, start=1):
+        for outcome in outcomes:
+            totals[outcome] += counts[outcome]
+        yield {"chunk": number, **counts}
+    yield {"totals": totals}
@@ -0,0 +1,119 @@
+"""Micro-batching of concurrent discount code claims for the same campaign.
+
+The first claim for a campaign leads a batch - it waits for
+`DISCOUNT_CODE_CLAIM_BATCHING_WINDOW_MS` or until `DISCOUNT_CODE_CLAIM_BATCHING_MAX_SIZE`
+claims have joined, and claims codes for all of them in one transaction with
+`create_discount_codes_batch`. Other claims wait for the leader and get their own code or
+error. Needs a threaded worker - concurrent claims are coalesced within one process only.
+"""
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+
+from flask import Flask
+
+from .. import db
+from ..config import get_settings
+from ..models import FetchedDiscountCode
+from .availability import campaign_availability_cache
+from .code_fetch import create_discount_codes_batch
+from .exceptions import DiscountCodeAlreadyExistsError, DiscountCodeNotAvailableError
+
+
+@dataclass
+class PendingClaim:
+    user_id: int
+    is_done: threading.Event = field(default_factory=threading.Event)
+    result: Optional[Union[FetchedDiscountCode, Exception]] = None
+
+
+@dataclass
+class ClaimBatch:
+    claims: List[PendingClaim] = field(default_factory=list)
+    is_full: threading.Event = field(default_factory=threading.Event)
+
+
+class DiscountCodeClaimCoalescer:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.window_seconds = 0.005
+        self.max_size = 100
+        self.batches_count = 0
+        self.claims_count = 0
+        self._batches: Dict[str, ClaimBatch] = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask) -> None:  # pylint: disable=unused-argument
+        app_config = get_settings()
+        self.enabled = app_config.DISCOUNT_CODE_CLAIM_BATCHING_ENABLED
+        self.window_seconds = app_config.DISCOUNT_CODE_CLAIM_BATCHING_WINDOW_MS / 1000
+        self.max_size = app_config.DISCOUNT_CODE_CLAIM_BATCHING_MAX_SIZE
+        self.batches_count = 0
+        self.claims_count = 0
+        self._batches = {}
+
+    def claim(self, campaign_id: int, user_id: int) -> FetchedDiscountCode:
+        """Claims discount code in the next batch of the campaign, raises errors
+        of `create_discount_code`."""
+        if campaign_availability_cache.is_exhausted(campaign_id):
+            raise DiscountCodeNotAvailableError
+
+        key = str(campaign_id)
+        pending_claim = PendingClaim(int(user_id))
+        with self._lock:
+            batch = self._batches.get(key)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._batches[key] = ClaimBatch()
+            batch.claims.append(pending_claim)
+            if len(batch.claims) >= self.max_size:
+                # Claims arriving from now on start the next batch
+                del self._batches[key]
+                batch.is_full.set()
+
+        if is_leader:
+            batch.is_full.wait(self.window_seconds)
+            with self._lock:
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+            self._claim_batch(campaign_id, batch)
+        else:
+            pending_claim.is_done.wait()
+
+        if isinstance(pending_claim.result, Exception):
+            raise pending_claim.result
+        return pending_claim.result
+
+    def _claim_batch(self, campaign_id: int, batch: ClaimBatch) -> None:
+        try:
+            results = create_discount_codes_batch(
+                campaign_id, [pending_claim.user_id for pending_claim in batch.claims]
+            )
+            claimed_user_ids = set()
+            for pending_claim in batch.claims:
+                result = results[pending_claim.user_id]
+                if pending_claim.user_id in claimed_user_ids:
+                    # Repeated request of the same user within the batch
+                    result = (
+                        type(result)()
+                        if isinstance(result, Exception)
+                        else DiscountCodeAlreadyExistsError()
+                    )
+                claimed_user_ids.add(pending_claim.user_id)
+                pending_claim.result = result
+        except Exception as exc:  # pylint: disable=broad-except
+            db.session.rollback()
+            for pending_claim in batch.claims:
+                pending_claim.result = exc
+        finally:
+            with self._lock:
+                self.batches_count += 1
+                self.claims_count += len(batch.claims)
+            for pending_claim in batch.claims:
+                pending_claim.is_done.set()
+
+    def stats(self) -> dict:
+        return {"batches": self.batches_count, "claims": self.claims_count}
+
+
+discount_code_claim_coalescer = DiscountCodeClaimCoalescer()
@@ -0,0 +1,68 @@
+"""Read-through cache of fetched discount codes keyed by (campaign_id, user_id).
+
+Found codes and "not found" results live in separate caches, so a burst of users polling
+before claiming cannot evict cached codes. "Not found" is cached for a shorter TTL, because
+a code claimed through another worker does not invalidate the cache of this worker.
+"""
+from typing import Any, Hashable, Optional
+
+from flask import Flask
+
+from ..config import get_settings
+from ..util.cache import MISSING, LRUCache
+
+
+class FetchedDiscountCodeCache:
+    def __init__(self) -> None:
+        self._found = LRUCache()
+        self._not_found = LRUCache()
+
+    def init_app(self, app: Flask) -> None:  # pylint: disable=unused-argument
+        app_config = get_settings()
+        self._found.configure(
+            max_size=app_config.DISCOUNT_CODE_CACHE_MAX_SIZE,
+            ttl=app_config.DISCOUNT_CODE_CACHE_TTL_SECONDS,
+        )
+        self._not_found.configure(
+            max_size=app_config.DISCOUNT_CODE_CACHE_NEGATIVE_MAX_SIZE,
+            ttl=app_config.DISCOUNT_CODE_CACHE_NEGATIVE_TTL_SECONDS,
+        )
+
+    @staticmethod
+    def _key(campaign_id: int, user_id: int) -> Hashable:
+        return (str(campaign_id), int(user_id))
+
+    def get(self, campaign_id: int, user_id: int) -> Any:
+        """Returns cached discount code dict, None if cached as not found, or MISSING."""
+        key = self._key(campaign_id, user_id)
+        discount_code = self._found.get(key)
+        if discount_code is not MISSING:
+            return discount_code
+        if self._not_found.get(key) is not MISSING:
+            return None
+        return MISSING
+
+    def set(self, campaign_id: int, user_id: int, discount_code: Optional[dict]) -> None:
+        key = self._key(campaign_id, user_id)
+        if discount_code is None:
+            self._not_found.set(key, True)
+        else:
+            self._not_found.delete(key)
+            self._found.set(key, discount_code)
+
+    def invalidate(self, campaign_id: int, user_id: int) -> None:
+        key = self._key(campaign_id, user_id)
+        self._found.delete(key)
+        self._not_found.delete(key)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self._found.hits + self._not_found.hits,
+            # Every miss of the found cache is looked up in the not found cache
+            "misses": self._not_found.misses,
+            "size": len(self._found),
+            "negative_size": len(self._not_found),
+        }
+
+
+fetched_discount_code_cache = FetchedDiscountCodeCache()
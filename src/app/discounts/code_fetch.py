@@ -1,14 +1,30 @@
-from typing import Optional
+from typing import Dict, List, Optional, Union
 
-from flask_executor.executor import ExecutorJob
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 from structlog import get_logger
 
 from .. import db
-from ..models import AvailableDiscountCode, FetchedDiscountCode
+from ..models import (
+    AvailableDiscountCode,
+    DiscountCodeFetchedOutbox,
+    FetchedDiscountCode,
+)
+from ..util.cache import MISSING
+from .availability import campaign_availability_cache
+from .code_cache import fetched_discount_code_cache
+from .code_lease import not_fetched_filter
+from .code_store import ClaimedDiscountCode, discount_code_store
+from .counters import increment_campaign_counters
 from .exceptions import DiscountCodeAlreadyExistsError, DiscountCodeNotAvailableError
 
 logger = get_logger()
 
+available_discount_codes = AvailableDiscountCode.__table__
+fetched_discount_codes = FetchedDiscountCode.__table__
+discount_code_fetched_outbox = DiscountCodeFetchedOutbox.__table__
+
 
 def get_already_created_discount_code(
     campaign_id: int, user_id: int
@@ -22,34 +38,56 @@ def get_already_created_discount_code(
     return None
 
 
-def create_discount_code(
-    campaign_id: int, user_id: int, code_fetched_event: Optional[ExecutorJob] = None
-) -> FetchedDiscountCode:
-    discount_code = get_already_created_discount_code(campaign_id, user_id)
-    if discount_code:
-        raise DiscountCodeAlreadyExistsError
-
-    available_discount_code = (
-        AvailableDiscountCode.query.with_for_update(skip_locked=True)
-        .filter(AvailableDiscountCode.campaign_id == campaign_id)
-        .first()
-    )
-    if not available_discount_code:
-        raise DiscountCodeNotAvailableError
+def get_already_created_discount_code_dict(campaign_id: int, user_id: int) -> Optional[dict]:
+    """Cached variant of `get_already_created_discount_code` for read-only API responses."""
+    discount_code = fetched_discount_code_cache.get(campaign_id, user_id)
+    if discount_code is not MISSING:
+        return discount_code
+    fetched_discount_code = get_already_created_discount_code(campaign_id, user_id)
+    discount_code = fetched_discount_code.to_dict() if fetched_discount_code else None
+    if discount_code is None:
+        # Claimed, but not yet persisted by the code store
+        code_id = discount_code_store.get_claimed_code_id(campaign_id, user_id)
+        if code_id:
+            discount_code = _to_fetched_discount_code(
+                ClaimedDiscountCode(code_id, int(campaign_id)), user_id
+            ).to_dict()
+    fetched_discount_code_cache.set(campaign_id, user_id, discount_code)
+    return discount_code
 
+
+def _to_fetched_discount_code(
+    claimed_discount_code: ClaimedDiscountCode, user_id: int
+) -> FetchedDiscountCode:
     fetched_discount_code = FetchedDiscountCode(
-        id=available_discount_code.id,
-        campaign_id=available_discount_code.campaign_id,
+        id=claimed_discount_code.id,
+        campaign_id=claimed_discount_code.campaign_id,
         user_id=user_id,
+        is_used=False,
+        is_fetched_event_sent=False,
     )
+    # Row is already persisted with Core, so the instance can be attached to any session
+    make_transient_to_detached(fetched_discount_code)
+    return fetched_discount_code
 
-    db.session.delete(available_discount_code)
-    db.session.add(fetched_discount_code)
-    db.session.commit()
 
-    # limitation: handle error if message queue is unavailable and retry message population
-    if code_fetched_event:
-        code_fetched_event.submit(discount_code=fetched_discount_code)
+def create_discount_code(campaign_id: int, user_id: int) -> FetchedDiscountCode:
+    if campaign_availability_cache.is_exhausted(campaign_id):
+        raise DiscountCodeNotAvailableError
+
+    claimed_discount_code = discount_code_store.claim(campaign_id, user_id)
+    if not claimed_discount_code:
+        campaign_availability_cache.mark_exhausted(campaign_id)
+        # Slow path only - tell apart exhausted campaign from a repeated request
+        if get_already_created_discount_code(campaign_id, user_id):
+            raise DiscountCodeAlreadyExistsError
+        raise DiscountCodeNotAvailableError
+
+    fetched_discount_code = _to_fetched_discount_code(claimed_discount_code, user_id)
+    fetched_discount_code_cache.set(campaign_id, user_id, fetched_discount_code.to_dict())
+
+    # Claim and its event are persisted, or queued for persistence by the code store
+    discount_code_store.schedule_persistence()
 
     logger.info(
         "discount_code_created",
@@ -58,3 +96,152 @@ def create_discount_code(
         user_id=fetched_discount_code.user_id,
     )
     return fetched_discount_code
+
+
+def create_discount_codes_batch(
+    campaign_id: int, user_ids: List[int]
+) -> Dict[int, Union[FetchedDiscountCode, Exception]]:
+    """Claims discount codes for many users in one transaction.
+
+    Returns created discount code, DiscountCodeAlreadyExistsError or
+    DiscountCodeNotAvailableError for every unique user id, in the order of `user_ids`.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if discount_code_store.name == "sql":
+        results = _claim_discount_codes_batch_with_retry(campaign_id, user_ids)
+    else:
+        # Codes are popped one by one from the store - there's no transaction to share
+        results = _claim_discount_codes_from_store(campaign_id, user_ids)
+
+    created = [result for result in results.values() if isinstance(result, FetchedDiscountCode)]
+    if created:
+        for fetched_discount_code in created:
+            fetched_discount_code_cache.set(
+                campaign_id, fetched_discount_code.user_id, fetched_discount_code.to_dict()
+            )
+        discount_code_store.schedule_persistence()
+    logger.info(
+        "discount_codes_batch_created",
+        campaign_id=campaign_id,
+        users_count=len(user_ids),
+        created_count=len(created),
+    )
+    return results
+
+
+def _claim_discount_codes_batch_with_retry(
+    campaign_id: int, user_ids: List[int]
+) -> Dict[int, Union[FetchedDiscountCode, Exception]]:
+    try:
+        return _claim_discount_codes_batch(campaign_id, user_ids)
+    except IntegrityError:
+        # Some user got a code concurrently - retry once with fresh already fetched codes
+        db.session.rollback()
+    try:
+        return _claim_discount_codes_batch(campaign_id, user_ids)
+    except IntegrityError:
+        db.session.rollback()
+        raise
+
+
+def _claim_discount_codes_batch(
+    campaign_id: int, user_ids: List[int]
+) -> Dict[int, Union[FetchedDiscountCode, Exception]]:
+    results: Dict[int, Union[FetchedDiscountCode, Exception]] = {}
+    already_fetched_user_ids = set(
+        db.session.execute(
+            select(fetched_discount_codes.c.user_id).where(
+                fetched_discount_codes.c.campaign_id == campaign_id,
+                fetched_discount_codes.c.user_id.in_(user_ids),
+            )
+        ).scalars()
+    )
+    new_user_ids = [user_id for user_id in user_ids if user_id not in already_fetched_user_ids]
+
+    available_discount_codes_rows = []
+    if new_user_ids and not campaign_availability_cache.is_exhausted(campaign_id):
+        available_discount_codes_rows = db.session.execute(
+            select(available_discount_codes.c.id, available_discount_codes.c.campaign_id)
+            .where(
+                available_discount_codes.c.campaign_id == campaign_id,
+                available_discount_codes.c.leased_by.is_(None),
+                not_fetched_filter(),
+            )
+            .limit(len(new_user_ids))
+            .with_for_update(skip_locked=True)
+        ).all()
+    claimed = [
+        (ClaimedDiscountCode(row.id, row.campaign_id), user_id)
+        for row, user_id in zip(available_discount_codes_rows, new_user_ids)
+    ]
+    if claimed:
+        db.session.execute(
+            delete(available_discount_codes).where(
+                available_discount_codes.c.id.in_(
+                    [claimed_discount_code.id for claimed_discount_code, _ in claimed]
+                )
+            )
+        )
+        db.session.execute(
+            fetched_discount_codes.insert(),
+            [
+                {
+                    "id": claimed_discount_code.id,
+                    "campaign_id": claimed_discount_code.campaign_id,
+                    "user_id": user_id,
+                    "is_used": False,
+                    "is_fetched_event_sent": False,
+                }
+                for claimed_discount_code, user_id in claimed
+            ],
+        )
+        db.session.execute(
+            discount_code_fetched_outbox.insert(),
+            [
+                {
+                    "discount_code_id": claimed_discount_code.id,
+                    "campaign_id": claimed_discount_code.campaign_id,
+                    "user_id": user_id,
+                }
+                for claimed_discount_code, user_id in claimed
+            ],
+        )
+        increment_campaign_counters(campaign_id, available=-len(claimed), issued=len(claimed))
+    db.session.commit()
+    if len(claimed) < len(new_user_ids):
+        campaign_availability_cache.mark_exhausted(campaign_id)
+
+    created = {
+        user_id: _to_fetched_discount_code(claimed_discount_code, user_id)
+        for claimed_discount_code, user_id in claimed
+    }
+    for user_id in user_ids:
+        if user_id in already_fetched_user_ids:
+            results[user_id] = DiscountCodeAlreadyExistsError()
+        elif user_id in created:
+            results[user_id] = created[user_id]
+        else:
+            results[user_id] = DiscountCodeNotAvailableError()
+    return results
+
+
+def _claim_discount_codes_from_store(
+    campaign_id: int, user_ids: List[int]
+) -> Dict[int, Union[FetchedDiscountCode, Exception]]:
+    results: Dict[int, Union[FetchedDiscountCode, Exception]] = {}
+    for user_id in user_ids:
+        try:
+            claimed_discount_code = (
+                None
+                if campaign_availability_cache.is_exhausted(campaign_id)
+                else discount_code_store.claim(campaign_id, user_id)
+            )
+        except DiscountCodeAlreadyExistsError as exc:
+            results[user_id] = exc
+            continue
+        if claimed_discount_code:
+            results[user_id] = _to_fetched_discount_code(claimed_discount_code, user_id)
+        else:
+            campaign_availability_cache.mark_exhausted(campaign_id)
+            results[user_id] = DiscountCodeNotAvailableError()
+    return results
@@ -0,0 +1,105 @@
+"""Discount code claim and lookup with async SQLAlchemy sessions, for the ASGI app in asgi.py.
+
+Runs the same statements as code_fetch.py and shares the per-worker caches. Codes leased by
+the lease pool are not handed out - the pool is bound to the sync session.
+"""
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from structlog import get_logger
+
+from ..models import FetchedDiscountCode
+from ..util.cache import MISSING
+from .availability import campaign_availability_cache
+from .code_cache import fetched_discount_code_cache
+from .code_fetch import _to_fetched_discount_code
+from .code_store import (
+    ClaimedDiscountCode,
+    _claim_statement,
+    _delete_available_code_statement,
+    _insert_fetched_discount_code_statements,
+    _select_available_code_statement,
+)
+from .counters import increment_statement
+from .exceptions import DiscountCodeAlreadyExistsError, DiscountCodeNotAvailableError
+
+logger = get_logger()
+
+
+async def get_already_created_discount_code(
+    session: AsyncSession, campaign_id: int, user_id: int
+) -> Optional[FetchedDiscountCode]:
+    result = await session.execute(
+        select(FetchedDiscountCode).where(
+            FetchedDiscountCode.campaign_id == campaign_id,
+            FetchedDiscountCode.user_id == user_id,
+        )
+    )
+    return result.scalars().first()
+
+
+async def get_already_created_discount_code_dict(
+    session: AsyncSession, campaign_id: int, user_id: int
+) -> Optional[dict]:
+    discount_code = fetched_discount_code_cache.get(campaign_id, user_id)
+    if discount_code is not MISSING:
+        return discount_code
+    fetched_discount_code = await get_already_created_discount_code(session, campaign_id, user_id)
+    discount_code = fetched_discount_code.to_dict() if fetched_discount_code else None
+    fetched_discount_code_cache.set(campaign_id, user_id, discount_code)
+    return discount_code
+
+
+async def _claim_discount_code(
+    session: AsyncSession, campaign_id: int, user_id: int
+) -> Optional[ClaimedDiscountCode]:
+    if session.bind.dialect.name == "postgresql":
+        row = (await session.execute(_claim_statement(campaign_id, user_id))).first()
+        return ClaimedDiscountCode(*row) if row else None
+
+    available_discount_code = (
+        await session.execute(_select_available_code_statement(campaign_id))
+    ).first()
+    if not available_discount_code:
+        return None
+    await session.execute(_delete_available_code_statement(available_discount_code))
+    for statement in _insert_fetched_discount_code_statements(
+        available_discount_code.id, available_discount_code.campaign_id, user_id
+    ):
+        await session.execute(statement)
+    return ClaimedDiscountCode(available_discount_code.id, available_discount_code.campaign_id)
+
+
+async def create_discount_code(session: AsyncSession, campaign_id: int, user_id: int) -> dict:
+    if campaign_availability_cache.is_exhausted(campaign_id):
+        raise DiscountCodeNotAvailableError
+
+    try:
+        claimed_discount_code = await _claim_discount_code(session, campaign_id, user_id)
+    except IntegrityError as exc:
+        await session.rollback()
+        if await get_already_created_discount_code(session, campaign_id, user_id):
+            raise DiscountCodeAlreadyExistsError from exc
+        raise
+    if not claimed_discount_code:
+        await session.rollback()
+        campaign_availability_cache.mark_exhausted(campaign_id)
+        if await get_already_created_discount_code(session, campaign_id, user_id):
+            raise DiscountCodeAlreadyExistsError
+        raise DiscountCodeNotAvailableError
+    await session.execute(
+        increment_statement(session.bind.dialect.name, campaign_id, available=-1, issued=1)
+    )
+    await session.commit()
+
+    discount_code = _to_fetched_discount_code(claimed_discount_code, user_id).to_dict()
+    fetched_discount_code_cache.set(campaign_id, user_id, discount_code)
+    logger.info(
+        "discount_code_created",
+        id=discount_code["id"],
+        campaign_id=discount_code["campaign_id"],
+        user_id=discount_code["user_id"],
+    )
+    return discount_code
@@ -1,14 +1,36 @@
+import io
+import multiprocessing
 import time
 import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
 
+from sqlalchemy import create_engine, event, func, select, update
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.exc import IntegrityError
 from structlog import get_logger
 
 from .. import db, executor
-from ..models import AvailableDiscountCode, Campaign
-from .exceptions import CampaignNotFoundError
+from ..config import get_settings
+from ..metrics import DISCOUNT_CODE_GENERATED_CODES, DISCOUNT_CODE_GENERATION_JOBS
+from ..models import AvailableDiscountCode, Campaign, DiscountCodeGenerationJob
+from ..util.code_generators import CodeGenerator, get_code_generator
+from .availability import campaign_availability_cache
+from .code_store import create_code_store, discount_code_store
+from .counters import increment_campaign_counters
+from .exceptions import (
+    CampaignNotFoundError,
+    GenerationJobAlreadyFinishedError,
+    GenerationJobAlreadyRunningError,
+    GenerationJobNotFoundError,
+)
 
 logger = get_logger(__name__)
 
+# Generation of a chunk colliding with existing codes is retried, see _insert_generated_chunk
+GENERATION_CHUNK_ATTEMPTS = 3
+
 
 def start_generate_discount_codes_job(
     campaign_id: int, discount_codes_count: int, commit_batch: int = 100000
@@ -16,42 +38,453 @@ def start_generate_discount_codes_job(
     campaign = Campaign.query.filter(Campaign.id == campaign_id).first()
     if not campaign:
         raise CampaignNotFoundError
-    job_id = str(uuid.uuid4())
-    __generate_discount_codes_job.submit(
-        job_id=job_id,
-        campaign=campaign,
-        discount_codes_count=discount_codes_count,
-        commit_batch=commit_batch,
+    job = DiscountCodeGenerationJob(
+        id=str(uuid.uuid4()),
+        campaign_id=campaign.id,
+        status="pending",
+        target_count=discount_codes_count,
+    )
+    db.session.add(job)
+    db.session.commit()
+    __generate_discount_codes_job.submit(job_id=job.id, commit_batch=commit_batch)
+    return job.id
+
+
+def get_generate_discount_codes_job(campaign_id: int, job_id: str) -> DiscountCodeGenerationJob:
+    job = DiscountCodeGenerationJob.query.filter(
+        DiscountCodeGenerationJob.id == job_id,
+        DiscountCodeGenerationJob.campaign_id == campaign_id,
+    ).first()
+    if not job:
+        raise GenerationJobNotFoundError
+    return job
+
+
+def _is_interrupted(job: DiscountCodeGenerationJob) -> bool:
+    stale_after = timedelta(seconds=get_settings().DISCOUNT_CODE_GENERATION_JOB_STALE_SECONDS)
+    return job.status == "failed" or (
+        job.status == "running" and job.updated_at < datetime.utcnow() - stale_after
+    )
+
+
+def resume_generate_discount_codes_job(
+    campaign_id: int, job_id: str, commit_batch: int = 100000
+) -> DiscountCodeGenerationJob:
+    """Resubmits a failed or interrupted job, it continues from the recorded generated count."""
+    job = get_generate_discount_codes_job(campaign_id, job_id)
+    if job.status == "finished":
+        raise GenerationJobAlreadyFinishedError
+    if job.status != "pending" and not _is_interrupted(job):
+        raise GenerationJobAlreadyRunningError
+    job.status = "pending"
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    __generate_discount_codes_job.submit(job_id=job.id, commit_batch=commit_batch)
+    return job
+
+
+def resume_interrupted_generate_discount_codes_jobs(commit_batch: int = 100000) -> List[str]:
+    """Resubmits all failed or interrupted jobs, e.g. after the worker running them died."""
+    jobs = DiscountCodeGenerationJob.query.filter(
+        DiscountCodeGenerationJob.status.in_(["running", "failed"])
+    ).all()
+    resumed_job_ids = []
+    for job in jobs:
+        if _is_interrupted(job):
+            resume_generate_discount_codes_job(job.campaign_id, job.id, commit_batch)
+            resumed_job_ids.append(job.id)
+    return resumed_job_ids
+
+
+def _start_job_run(job_id: str) -> bool:
+    """Moves pending job to running. Only one of concurrently submitted runs succeeds."""
+    now = datetime.utcnow()
+    result = db.session.execute(
+        update(DiscountCodeGenerationJob)
+        .where(
+            DiscountCodeGenerationJob.id == job_id, DiscountCodeGenerationJob.status == "pending"
+        )
+        .values(
+            status="running",
+            started_at=func.coalesce(DiscountCodeGenerationJob.started_at, now),
+            updated_at=now,
+            error=None,
+        )
+    )
+    db.session.commit()
+    return bool(result.rowcount)
+
+
+def _job_progress_statement(job_id: str, committed_count: int, **values):
+    """Job progress update, executed in the transaction of the batch
+    so it can't drift from the codes table."""
+    return (
+        update(DiscountCodeGenerationJob)
+        .where(DiscountCodeGenerationJob.id == job_id)
+        .values(
+            generated_count=DiscountCodeGenerationJob.generated_count + committed_count,
+            updated_at=datetime.utcnow(),
+            **values,
+        )
     )
-    return job_id
+
+
+def _record_job_progress(
+    job_id: str, committed_count: int, rows_per_second: Optional[float], **values
+) -> None:
+    db.session.execute(
+        _job_progress_statement(job_id, committed_count, rows_per_second=rows_per_second, **values)
+    )
+
+
+def insert_discount_code_chunks(
+    campaign_id: int,
+    discount_codes_count: int,
+    chunk_size: int,
+    connection: Optional[Connection] = None,
+) -> Iterator[List[str]]:
+    """Generates and inserts new discount codes in chunks of at most `chunk_size` items,
+    yields codes of every inserted chunk, so only one chunk is held in memory at a time.
+
+    Every chunk is inserted in a savepoint of the current transaction of the given connection,
+    or of the session. A chunk colliding with existing codes - possible with the random
+    generator - is rolled back to its savepoint and generated again, earlier chunks stay.
+    """
+    code_generator = get_code_generator()
+    remaining = discount_codes_count
+    while remaining > 0:
+        size = min(chunk_size, remaining)
+        yield _insert_generated_chunk(code_generator, campaign_id, size, connection)
+        remaining -= size
+
+
+def _insert_generated_chunk(
+    code_generator: CodeGenerator, campaign_id: int, count: int, connection: Optional[Connection]
+) -> List[str]:
+    attempt = 1
+    while True:
+        savepoint = (connection or db.session).begin_nested()
+        try:
+            codes = code_generator.generate(
+                connection or db.session.connection(), campaign_id, count
+            )
+            insert_discount_codes(campaign_id, codes, connection)
+        except IntegrityError:
+            savepoint.rollback()
+            if attempt >= GENERATION_CHUNK_ATTEMPTS:
+                raise
+            logger.warning("discount_code_chunk_collided", campaign_id=campaign_id, attempt=attempt)
+            attempt += 1
+        else:
+            savepoint.commit()
+            return codes
+
+
+def insert_discount_codes(
+    campaign_id: int, codes: List[str], connection: Optional[Connection] = None
+) -> None:
+    """Bulk inserts discount codes in the current transaction of the given connection,
+    or of the session, bypassing the ORM, and adds them to the campaign counters.
+
+    PostgreSQL gets `COPY ... FROM STDIN`, other databases a Core executemany insert.
+    """
+    connection = connection or db.session.connection()
+    if connection.dialect.name == "postgresql":
+        buffer = io.StringIO("".join(f"{code}\t{campaign_id}\n" for code in codes))
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {AvailableDiscountCode.__tablename__} (id, campaign_id) FROM STDIN", buffer
+            )
+    else:
+        connection.execute(
+            AvailableDiscountCode.__table__.insert(),
+            [{"id": code, "campaign_id": campaign_id} for code in codes],
+        )
+    increment_campaign_counters(campaign_id, available=len(codes), connection=connection)
+
+
+def _create_shard_engine(database_uri: str) -> Engine:
+    engine = create_engine(database_uri)
+    if engine.dialect.name == "sqlite":
+        # pysqlite begins transactions on its own, and a chunk savepoint taken before that
+        # commits on release - without the job progress, lost if the worker process dies.
+        # The transaction is begun explicitly instead, taking the write lock up front.
+        @event.listens_for(engine, "connect")
+        def disable_pysqlite_transactions(dbapi_connection, _connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def begin_immediate(connection):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return engine
+
+
+def generate_discount_codes_shard(
+    database_uri: str,
+    job_id: str,
+    campaign_id: int,
+    discount_codes_count: int,
+    commit_batch: int,
+    chunk_size: int,
+) -> dict:
+    """Generates one shard of a job with its own database connection, runs in a worker process.
+
+    Returns generated_count of committed codes and error, if the shard failed midway.
+    """
+    engine = _create_shard_engine(database_uri)
+    generated_count = 0
+    try:
+        # Settings of the app come from the environment inherited by the worker process
+        code_store = create_code_store(get_settings().DISCOUNT_CODE_STORE)
+        with engine.connect() as connection:
+            uncommitted: List[str] = []
+            transaction = connection.begin()
+            for codes in insert_discount_code_chunks(
+                campaign_id, discount_codes_count, chunk_size, connection
+            ):
+                uncommitted.extend(codes)
+                if len(uncommitted) >= commit_batch:
+                    connection.execute(_job_progress_statement(job_id, len(uncommitted)))
+                    transaction.commit()
+                    code_store.codes_added(campaign_id, uncommitted)
+                    generated_count += len(uncommitted)
+                    uncommitted = []
+                    transaction = connection.begin()
+            connection.execute(_job_progress_statement(job_id, len(uncommitted)))
+            transaction.commit()
+            code_store.codes_added(campaign_id, uncommitted)
+            generated_count += len(uncommitted)
+    except Exception as exc:  # pylint: disable=broad-except
+        return {"generated_count": generated_count, "error": repr(exc)}
+    finally:
+        engine.dispose()
+    return {"generated_count": generated_count, "error": None}
+
+
+def _is_sharded_generation(discount_codes_count: int) -> bool:
+    app_config = get_settings()
+    database_url = make_url(app_config.SQLALCHEMY_DATABASE_URI)
+    # Separate processes can't share in-memory SQLite database
+    is_in_memory_database = database_url.get_backend_name() == "sqlite" and (
+        database_url.database in (None, "", ":memory:")
+    )
+    return (
+        app_config.DISCOUNT_CODE_GENERATION_PROCESSES > 1
+        and discount_codes_count > app_config.DISCOUNT_CODE_GENERATION_SHARD_SIZE
+        and not is_in_memory_database
+    )
+
+
+def _committed_job_count(job_id: str) -> int:
+    """Generated count of the job committed so far, shards included."""
+    generated_count = db.session.execute(
+        select(DiscountCodeGenerationJob.generated_count).where(
+            DiscountCodeGenerationJob.id == job_id
+        )
+    ).scalar_one()
+    db.session.commit()
+    return generated_count
+
+
+def _create_shard_pool(processes: int) -> ProcessPoolExecutor:
+    # Spawned, not forked - worker processes must not inherit connections and threads of the app
+    return ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _generate_discount_codes_sharded(
+    job_id: str, campaign_id: int, discount_codes_count: int, commit_batch: int, chunk_size: int
+) -> int:
+    """Splits generation into shards executed by a process pool, retrying failed shards
+    for their not yet committed codes. A worker process dying breaks the pool, which is
+    recreated for the unfinished shards. Returns the count of generated codes."""
+    app_config = get_settings()
+    shard_size = app_config.DISCOUNT_CODE_GENERATION_SHARD_SIZE
+    shard_retries = app_config.DISCOUNT_CODE_GENERATION_SHARD_RETRIES
+    shard_counts = [
+        min(shard_size, discount_codes_count - offset)
+        for offset in range(0, discount_codes_count, shard_size)
+    ]
+    log = logger.bind(job_id=job_id, campaign_id=campaign_id, shards_count=len(shard_counts))
+
+    committed_before_count = _committed_job_count(job_id)
+    generated_count = 0
+    pool = _create_shard_pool(app_config.DISCOUNT_CODE_GENERATION_PROCESSES)
+
+    def submit_shard(shard_index: int, count: int, attempt: int):
+        future = pool.submit(
+            generate_discount_codes_shard,
+            app_config.SQLALCHEMY_DATABASE_URI,
+            job_id,
+            campaign_id,
+            count,
+            commit_batch,
+            chunk_size,
+        )
+        pending[future] = (shard_index, count, attempt)
+
+    try:
+        pending: Dict[Future, Tuple[int, int, int]] = {}
+        for shard_index, count in enumerate(shard_counts):
+            submit_shard(shard_index, count, attempt=0)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            if any(future.exception() is not None for future in done):
+                # A dead worker breaks the pool - all of its shards fail, finished or not
+                pool.shutdown(wait=True)
+                pool = _create_shard_pool(app_config.DISCOUNT_CODE_GENERATION_PROCESSES)
+                done = set(pending)
+
+            retried_shards: List[Tuple[int, int, int]] = []
+            lost_shards: List[Tuple[int, int, int]] = []
+            for future in done:
+                shard_index, count, attempt = pending.pop(future)
+                if future.exception() is not None:
+                    lost_shards.append((shard_index, count, attempt))
+                    continue
+                result = future.result()
+                generated_count += result["generated_count"]
+                DISCOUNT_CODE_GENERATED_CODES.inc(result["generated_count"])
+                log.info(
+                    "generate_discount_codes_shard",
+                    shard_index=shard_index,
+                    attempt=attempt,
+                    generated_count=result["generated_count"],
+                    error=result["error"],
+                )
+                if not result["error"]:
+                    continue
+                if attempt >= shard_retries:
+                    raise RuntimeError(
+                        f"Shard {shard_index} failed after {attempt + 1} attempts: "
+                        f"{result['error']}"
+                    )
+                retried_shards.append((shard_index, count - result["generated_count"], attempt))
+
+            if lost_shards:
+                # Lost shards committed what the job recorded beyond the returned shards
+                lost_count = _committed_job_count(job_id) - committed_before_count - generated_count
+                generated_count += lost_count
+                DISCOUNT_CODE_GENERATED_CODES.inc(lost_count)
+                log.warning(
+                    "generate_discount_codes_shards_lost",
+                    shard_indexes=sorted(shard_index for shard_index, _, _ in lost_shards),
+                    generated_count=lost_count,
+                )
+                remaining = sum(count for _, count, _ in lost_shards) - lost_count
+                for shard_index, count, attempt in sorted(lost_shards):
+                    if attempt >= shard_retries:
+                        raise RuntimeError(
+                            f"Shard {shard_index} failed after {attempt + 1} attempts: "
+                            "worker process died"
+                        )
+                    if remaining > 0:
+                        retried_shards.append((shard_index, min(count, remaining), attempt))
+                        remaining -= min(count, remaining)
+
+            # Submitted after the lost shards are counted, so their commits aren't counted twice
+            for shard_index, count, attempt in retried_shards:
+                submit_shard(shard_index, count, attempt=attempt + 1)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return generated_count
+
+
+def _rows_per_second(generated_count: int, elapsed_seconds: float) -> Optional[float]:
+    return round(generated_count / elapsed_seconds, 1) if elapsed_seconds else None
+
+
+def _generate_discount_codes_serially(
+    job_id: str,
+    campaign_id: int,
+    discount_codes_count: int,
+    commit_batch: int,
+    chunk_size: int,
+    start_time: float,
+) -> int:
+    generated_count = 0
+    uncommitted: List[str] = []
+    # if program would fail in the middle of the execution,
+    # rows would be already committed to the database together with the job progress
+    # one commit batch - one async event
+    for codes in insert_discount_code_chunks(campaign_id, discount_codes_count, chunk_size):
+        generated_count += len(codes)
+        uncommitted.extend(codes)
+        if len(uncommitted) >= commit_batch:
+            _commit_generated_codes(job_id, campaign_id, uncommitted, generated_count, start_time)
+            uncommitted = []
+    _commit_generated_codes(job_id, campaign_id, uncommitted, generated_count, start_time)
+    return generated_count
+
+
+def _commit_generated_codes(
+    job_id: str, campaign_id: int, codes: List[str], generated_count: int, start_time: float
+) -> None:
+    _record_job_progress(
+        job_id, len(codes), _rows_per_second(generated_count, time.time() - start_time)
+    )
+    db.session.commit()
+    # Codes are claimable from the code store only once they're committed
+    discount_code_store.codes_added(campaign_id, codes)
+    campaign_availability_cache.codes_added(campaign_id)
+    DISCOUNT_CODE_GENERATED_CODES.inc(len(codes))
 
 
 @executor.job
-def __generate_discount_codes_job(
-    job_id: str, campaign: Campaign, discount_codes_count: int, commit_batch
-):
+def __generate_discount_codes_job(job_id: str, commit_batch: int):
+    generate_discount_codes_job(job_id, commit_batch)
+
+
+def generate_discount_codes_job(job_id: str, commit_batch: int) -> None:
+    """Runs a pending generation job to the end in the calling thread, as the background job
+    of the generation endpoint does. Skips a job that isn't pending."""
+    if not _start_job_run(job_id):
+        logger.info("generate_discount_codes_job", job_id=job_id, skipped=True)
+        return
+    job = db.session.get(DiscountCodeGenerationJob, job_id)
+    campaign_id = job.campaign_id
+    discount_codes_count = job.target_count - job.generated_count
+    db.session.commit()
+
     start_time = time.time()
-    log = logger.bind(job_id=job_id, campaign=campaign, discount_codes_count=discount_codes_count)
+    log = logger.bind(
+        job_id=job_id, campaign_id=campaign_id, discount_codes_count=discount_codes_count
+    )
     log.info("generate_discount_codes_job", started=True)
 
-    flush_counter = 0
-    for _ in range(discount_codes_count):
-        discount_code = AvailableDiscountCode(campaign_id=campaign.id)
-        # if program would fail in the middle of the execution,
-        # rows would be already committed to the database
-        # one commit batch - one async event
-        db.session.add(discount_code)
-        flush_counter += 1
-        if flush_counter > commit_batch:
-            flush_counter = 0
-            db.session.commit()
-            db.session.flush()
-    db.session.commit()
-    db.session.flush()
+    chunk_size = min(get_settings().DISCOUNT_CODE_GENERATION_CHUNK_SIZE, commit_batch)
+    try:
+        if _is_sharded_generation(discount_codes_count):
+            # Shards record their progress to the job themselves
+            generated_count = _generate_discount_codes_sharded(
+                job_id, campaign_id, discount_codes_count, commit_batch, chunk_size
+            )
+            campaign_availability_cache.codes_added(campaign_id)
+        else:
+            generated_count = _generate_discount_codes_serially(
+                job_id, campaign_id, discount_codes_count, commit_batch, chunk_size, start_time
+            )
+        finished_in_seconds = time.time() - start_time
+        rows_per_second = _rows_per_second(generated_count, finished_in_seconds)
+        _record_job_progress(
+            job_id, 0, rows_per_second, status="finished", finished_at=datetime.utcnow()
+        )
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        log.exception("generate_discount_codes_job", failed=True)
+        _record_job_progress(job_id, 0, None, status="failed", error=str(exc)[:512])
+        db.session.commit()
+        DISCOUNT_CODE_GENERATION_JOBS.labels("failed").inc()
+        raise
 
-    finished_in_seconds = time.time() - start_time
+    DISCOUNT_CODE_GENERATION_JOBS.labels("finished").inc()
     log.info(
         "generate_discount_codes_job",
         finished=True,
         finished_in_seconds=finished_in_seconds,
+        rows_per_second=rows_per_second,
     )
@@ -0,0 +1,104 @@
+"""Import of discount codes supplied by marketplaces, e.g. pre-printed codes, in bulk.
+
+Code ids are read one line at a time, see `bulk.parse_code_ids`, and imported in chunks of
+`DISCOUNT_CODE_IMPORT_CHUNK_SIZE`. Every chunk is deduplicated against both code tables with
+a primary key lookup each, loaded with `insert_discount_codes` - `COPY` on PostgreSQL - and
+committed on its own, so only the current chunk is held in memory.
+"""
+import re
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Set
+
+from sqlalchemy import select, union
+from sqlalchemy.exc import IntegrityError
+from structlog import get_logger
+
+from .. import db
+from ..metrics import DISCOUNT_CODE_IMPORTED_CODES
+from ..models import AvailableDiscountCode, Campaign, FetchedDiscountCode
+from .availability import campaign_availability_cache
+from .code_generation import insert_discount_codes
+from .code_store import discount_code_store
+from .exceptions import CampaignNotFoundError
+
+logger = get_logger(__name__)
+
+available_discount_codes = AvailableDiscountCode.__table__
+fetched_discount_codes = FetchedDiscountCode.__table__
+
+OUTCOMES = ("accepted", "duplicate", "invalid")
+# Letters, digits, dashes and underscores - nothing to escape in URLs, CSV or COPY
+CODE_ID_PATTERN = re.compile(r"[0-9A-Za-z_-]+")
+
+
+def import_discount_codes(
+    campaign_id: int, code_ids: Iterable[Optional[str]], chunk_size: int
+) -> Iterator[dict]:
+    """Imports codes to the available codes of the campaign, the returned iterator yields
+    counts of every committed chunk as it imports them.
+
+    Counts - accepted, duplicate (already exists in any campaign, or repeated in the body)
+    and invalid (not a code id).
+    """
+    if not db.session.get(Campaign, campaign_id):
+        raise CampaignNotFoundError
+    return _import_chunks(campaign_id, iter(code_ids), chunk_size)
+
+
+def _existing_code_ids(code_ids: List[str]) -> Set[str]:
+    return set(
+        db.session.execute(
+            union(
+                select(available_discount_codes.c.id).where(
+                    available_discount_codes.c.id.in_(code_ids)
+                ),
+                select(fetched_discount_codes.c.id).where(
+                    fetched_discount_codes.c.id.in_(code_ids)
+                ),
+            )
+        ).scalars()
+    )
+
+
+def _insert_new_codes(campaign_id: int, code_ids: List[str]) -> List[str]:
+    """Inserts and commits codes which don't exist yet, returns them."""
+    existing_code_ids = _existing_code_ids(code_ids)
+    new_code_ids = [code_id for code_id in code_ids if code_id not in existing_code_ids]
+    if new_code_ids:
+        insert_discount_codes(campaign_id, new_code_ids)
+    db.session.commit()
+    return new_code_ids
+
+
+def _import_chunks(
+    campaign_id: int, code_ids: Iterator[Optional[str]], chunk_size: int
+) -> Iterator[dict]:
+    while chunk := list(islice(code_ids, chunk_size)):
+        valid_code_ids = [
+            code_id
+            for code_id in chunk
+            if code_id is not None and CODE_ID_PATTERN.fullmatch(code_id)
+        ]
+        unique_code_ids = list(dict.fromkeys(valid_code_ids))
+        if unique_code_ids:
+            try:
+                accepted = _insert_new_codes(campaign_id, unique_code_ids)
+            except IntegrityError:
+                # Codes of the chunk were added by another import after the lookup
+                db.session.rollback()
+                accepted = _insert_new_codes(campaign_id, unique_code_ids)
+            # Codes are claimable from the code store only once they're committed
+            discount_code_store.codes_added(campaign_id, accepted)
+            campaign_availability_cache.codes_added(campaign_id)
+        else:
+            accepted = []
+
+        counts = {
+            "accepted": len(accepted),
+            "duplicate": len(valid_code_ids) - len(accepted),
+            "invalid": len(chunk) - len(valid_code_ids),
+        }
+        for outcome, count in counts.items():
+            DISCOUNT_CODE_IMPORTED_CODES.labels(outcome).inc(count)
+        logger.info("discount_codes_imported", campaign_id=campaign_id, **counts)
+        yield counts
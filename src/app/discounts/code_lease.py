@@ -0,0 +1,254 @@
+"""Per-worker reservation of discount codes.
+
+A worker leases a block of codes for a campaign by marking rows in `available_discount_codes`
+with its worker id and a lease expiry, and hands them out from memory. Claiming a leased code
+is then a single insert into `fetched_discount_codes`. Rows of already issued codes are deleted
+and unissued ones are returned to the shared pool on the next refill, on clean shutdown
+or, when a worker dies, by any other worker after the lease has expired.
+
+A worker stops handing out codes of a lease `DISCOUNT_CODE_LEASE_SAFETY_MARGIN_SECONDS` before
+it expires, so a code isn't returned to the shared pool between being handed out and issued.
+Shared claims skip codes already in `fetched_discount_codes` should it happen anyway - only
+while leases are enabled, otherwise no such rows are left and the claim stays an index probe.
+"""
+import atexit
+import os
+import socket
+import threading
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Deque, Dict, NamedTuple, Optional
+
+from flask import Flask
+from sqlalchemy import and_, delete, exists, or_, select, true, update
+from structlog import get_logger
+
+from .. import db, executor
+from ..config import get_settings
+from ..models import AvailableDiscountCode, FetchedDiscountCode
+
+logger = get_logger(__name__)
+
+available_discount_codes = AvailableDiscountCode.__table__
+fetched_discount_codes = FetchedDiscountCode.__table__
+
+# Available code row of an issued code, left behind by a lease - not to be claimed again
+is_not_fetched = ~exists().where(fetched_discount_codes.c.id == available_discount_codes.c.id)
+
+
+class LeasedDiscountCode(NamedTuple):
+    id: str
+    campaign_id: int
+
+
+@dataclass
+class DiscountCodeLease:
+    expires_at: datetime
+    codes: Deque[LeasedDiscountCode] = field(default_factory=deque)
+    is_refilling: bool = False
+
+
+def release_expired_leases(campaign_id: int) -> None:
+    """Returns codes of expired leases to the shared pool, e.g. left by a crashed worker."""
+    expired = and_(
+        available_discount_codes.c.campaign_id == campaign_id,
+        available_discount_codes.c.leased_by.isnot(None),
+        available_discount_codes.c.lease_expires_at < datetime.utcnow(),
+    )
+    db.session.execute(
+        delete(available_discount_codes).where(
+            expired,
+            available_discount_codes.c.id.in_(
+                select(fetched_discount_codes.c.id).where(
+                    fetched_discount_codes.c.campaign_id == campaign_id
+                )
+            ),
+        )
+    )
+    db.session.execute(
+        update(available_discount_codes)
+        .where(expired)
+        .values(leased_by=None, lease_expires_at=None)
+    )
+
+
+class DiscountCodeLeasePool:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.block_size = 100
+        self.refill_threshold = 20
+        self.lease_ttl = timedelta(seconds=300)
+        self.safety_margin = timedelta(seconds=30)
+        self._leases: Dict[str, DiscountCodeLease] = {}
+        self._lock = threading.Lock()
+        self._worker_id = ""
+        self._worker_pid: Optional[int] = None
+        self._app: Optional[Flask] = None
+        self._is_exit_handler_registered = False
+
+    def init_app(self, app: Flask) -> None:
+        app_config = get_settings()
+        self.enabled = app_config.DISCOUNT_CODE_LEASE_ENABLED
+        self.block_size = app_config.DISCOUNT_CODE_LEASE_BLOCK_SIZE
+        self.refill_threshold = app_config.DISCOUNT_CODE_LEASE_REFILL_THRESHOLD
+        self.lease_ttl = timedelta(seconds=app_config.DISCOUNT_CODE_LEASE_TTL_SECONDS)
+        self.safety_margin = timedelta(seconds=app_config.DISCOUNT_CODE_LEASE_SAFETY_MARGIN_SECONDS)
+        self._leases = {}
+        # Leases are released with the last initialized app, by one handler per process
+        self._app = app
+        if self.enabled and not self._is_exit_handler_registered:
+            atexit.register(self._release_leases_on_exit)
+            self._is_exit_handler_registered = True
+
+    @property
+    def worker_id(self) -> str:
+        # Recomputed after fork, so every gunicorn worker leases codes under its own id
+        pid = os.getpid()
+        if self._worker_pid != pid:
+            self._worker_pid = pid
+            self._worker_id = f"{socket.gethostname()[:40]}:{pid}:{uuid.uuid4().hex[:8]}"
+            self._leases = {}
+        return self._worker_id
+
+    def take(self, campaign_id: int) -> Optional[LeasedDiscountCode]:
+        """Returns a leased code, leasing a new block first if the worker has none left."""
+        leased_code = self._pop(campaign_id)
+        if leased_code is None:
+            self.refill(campaign_id)
+            leased_code = self._pop(campaign_id)
+        return leased_code
+
+    def put_back(self, leased_code: LeasedDiscountCode) -> None:
+        with self._lock:
+            lease = self._leases.get(str(leased_code.campaign_id))
+            if lease:
+                lease.codes.appendleft(leased_code)
+
+    def _pop(self, campaign_id: int) -> Optional[LeasedDiscountCode]:
+        key = str(campaign_id)
+        with self._lock:
+            lease = self._leases.get(key)
+            if not lease:
+                return None
+            if lease.expires_at - self.safety_margin <= datetime.utcnow():
+                # Unissued rows are returned to the shared pool by the next refill
+                del self._leases[key]
+                return None
+            if not lease.codes:
+                return None
+            leased_code = lease.codes.popleft()
+            should_refill = len(lease.codes) <= self.refill_threshold and not lease.is_refilling
+            if should_refill:
+                lease.is_refilling = True
+        if should_refill:
+            executor.submit(self._refill_in_background, campaign_id)
+        return leased_code
+
+    def _refill_in_background(self, campaign_id: int) -> None:
+        try:
+            self.refill(campaign_id)
+        except Exception:  # pylint: disable=broad-except
+            db.session.rollback()
+            logger.exception("discount_code_lease_refill_failed", campaign_id=campaign_id)
+        finally:
+            with self._lock:
+                lease = self._leases.get(str(campaign_id))
+                if lease:
+                    lease.is_refilling = False
+
+    def refill(self, campaign_id: int) -> None:
+        """Leases another block of codes and extends the lease of codes the worker still holds."""
+        worker_id = self.worker_id
+        expires_at = datetime.utcnow() + self.lease_ttl
+        owned = and_(
+            available_discount_codes.c.campaign_id == campaign_id,
+            available_discount_codes.c.leased_by == worker_id,
+        )
+
+        release_expired_leases(campaign_id)
+        db.session.execute(
+            delete(available_discount_codes).where(
+                owned,
+                available_discount_codes.c.id.in_(
+                    select(fetched_discount_codes.c.id).where(
+                        fetched_discount_codes.c.campaign_id == campaign_id
+                    )
+                ),
+            )
+        )
+        with self._lock:
+            is_held = str(campaign_id) in self._leases
+        if not is_held:
+            # Codes of a lease dropped within the safety margin are no longer handed out
+            db.session.execute(
+                update(available_discount_codes)
+                .where(owned)
+                .values(leased_by=None, lease_expires_at=None)
+            )
+        rows = db.session.execute(
+            select(available_discount_codes.c.id, available_discount_codes.c.campaign_id)
+            .where(
+                available_discount_codes.c.campaign_id == campaign_id,
+                available_discount_codes.c.leased_by.is_(None),
+                is_not_fetched,
+            )
+            .limit(self.block_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        db.session.execute(
+            update(available_discount_codes)
+            .where(or_(owned, available_discount_codes.c.id.in_([row.id for row in rows])))
+            .values(leased_by=worker_id, lease_expires_at=expires_at)
+        )
+        db.session.commit()
+
+        with self._lock:
+            lease = self._leases.setdefault(
+                str(campaign_id), DiscountCodeLease(expires_at=expires_at)
+            )
+            lease.expires_at = expires_at
+            lease.codes.extend(LeasedDiscountCode(row.id, row.campaign_id) for row in rows)
+        logger.info(
+            "discount_code_lease_refilled",
+            campaign_id=campaign_id,
+            worker_id=worker_id,
+            leased_count=len(rows),
+        )
+
+    def release_leases(self) -> None:
+        """Deletes rows of issued codes and returns unissued ones to the shared pool."""
+        worker_id = self.worker_id
+        owned = available_discount_codes.c.leased_by == worker_id
+        db.session.execute(
+            delete(available_discount_codes).where(
+                owned, available_discount_codes.c.id.in_(select(fetched_discount_codes.c.id))
+            )
+        )
+        db.session.execute(
+            update(available_discount_codes)
+            .where(owned)
+            .values(leased_by=None, lease_expires_at=None)
+        )
+        db.session.commit()
+        with self._lock:
+            self._leases = {}
+        logger.info("discount_code_leases_released", worker_id=worker_id)
+
+    def _release_leases_on_exit(self) -> None:
+        if not self.enabled or not self._leases:
+            return
+        try:
+            with self._app.app_context():
+                self.release_leases()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("discount_code_leases_release_failed", worker_id=self.worker_id)
+
+
+discount_code_lease_pool = DiscountCodeLeasePool()
+
+
+def not_fetched_filter():
+    """Filter of claimable codes skipping rows of issued codes - only leases leave them behind."""
+    return is_not_fetched if discount_code_lease_pool.enabled else true()
@@ -0,0 +1,549 @@
+"""Stores of available discount codes a claim takes a code from (`DISCOUNT_CODE_STORE`).
+
+`sql` - available codes are rows of `available_discount_codes`, a claim moves one unlocked
+row to `fetched_discount_codes` in one transaction (or hands out a code leased by the worker).
+
+`redis` - available codes of a campaign are also a Redis list, filled by generation jobs
+and imports after their codes are committed, and with codes added before the switch by
+`backfill_available_codes`. A claim is `SET NX` of the user key, against a second code
+for the same user, and an O(1) `LPOP` of the list. Until `backfill_user_keys` has run, the
+first claim of a user also looks up a code fetched through SQL before the switch. Claimed
+codes are queued in Redis and moved from available to fetched codes in SQL by a background
+persister, in batches, with their events in the outbox. Lookups see a claimed code before
+it's persisted through the user key. `DISCOUNT_CODE_STORE_REDIS_URL` of `memory://` is an
+in-process stand-in of Redis.
+"""
+import threading
+import uuid
+from collections import Counter
+from itertools import groupby, islice
+from operator import itemgetter
+from typing import Iterable, List, NamedTuple, Optional, Protocol
+
+import orjson
+from flask import Flask
+from sqlalchemy import delete, false, literal, select
+from sqlalchemy.exc import IntegrityError
+from structlog import get_logger
+
+from .. import db, executor
+from ..config import get_settings
+from ..models import (
+    AvailableDiscountCode,
+    DiscountCodeFetchedOutbox,
+    FetchedDiscountCode,
+)
+from ..util.redis_client import create_redis_client
+from .code_lease import discount_code_lease_pool, is_not_fetched, not_fetched_filter
+from .counters import increment_campaign_counters
+from .events import discount_code_event_relay
+from .exceptions import DiscountCodeAlreadyExistsError
+
+logger = get_logger(__name__)
+
+available_discount_codes = AvailableDiscountCode.__table__
+fetched_discount_codes = FetchedDiscountCode.__table__
+discount_code_fetched_outbox = DiscountCodeFetchedOutbox.__table__
+
+
+class ClaimedDiscountCode(NamedTuple):
+    id: str
+    campaign_id: int
+
+
+class CodeStore(Protocol):
+    name: str
+
+    def claim(self, campaign_id: int, user_id: int) -> Optional[ClaimedDiscountCode]:
+        """Claims a code for the user, returns None when the campaign has no codes left.
+
+        Raises DiscountCodeAlreadyExistsError when the user already claimed a code.
+        """
+
+    def get_claimed_code_id(self, campaign_id: int, user_id: int) -> Optional[str]:
+        """Code claimed by the user, if the store knows about it before it's in SQL."""
+
+    def codes_added(self, campaign_id: int, codes: List[str]) -> None:
+        """Called with new codes once they're committed to `available_discount_codes`."""
+
+    def schedule_persistence(self) -> None:
+        """Called after claims, persists them and their events in the background."""
+
+    def persist_claimed(self) -> int:
+        """Persists claims not yet in SQL, returns the persisted count."""
+
+
+def _claim_statement(campaign_id: int, user_id: int):
+    """Single PostgreSQL statement that moves one unlocked available code to fetched codes
+    and writes the discount code fetched event to the outbox.
+
+    Returns no rows when the campaign has no available codes left. A second code for
+    the same user is rejected by the unique (campaign_id, user_id) constraint, which
+    rolls back the whole statement, including the DELETE.
+    """
+    locked_code_id = (
+        select(available_discount_codes.c.id)
+        .where(
+            available_discount_codes.c.campaign_id == campaign_id,
+            available_discount_codes.c.leased_by.is_(None),
+            not_fetched_filter(),
+        )
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    claimed = (
+        delete(available_discount_codes)
+        .where(
+            available_discount_codes.c.id == locked_code_id,
+            available_discount_codes.c.campaign_id == campaign_id,
+        )
+        .returning(available_discount_codes.c.id, available_discount_codes.c.campaign_id)
+        .cte("claimed")
+    )
+    fetched = (
+        fetched_discount_codes.insert()
+        .from_select(
+            ["id", "campaign_id", "user_id", "is_used", "is_fetched_event_sent"],
+            select(claimed.c.id, claimed.c.campaign_id, literal(user_id), false(), false()),
+        )
+        .returning(
+            fetched_discount_codes.c.id,
+            fetched_discount_codes.c.campaign_id,
+            fetched_discount_codes.c.user_id,
+        )
+        .cte("fetched")
+    )
+    return (
+        discount_code_fetched_outbox.insert()
+        .from_select(
+            ["discount_code_id", "campaign_id", "user_id"],
+            select(fetched.c.id, fetched.c.campaign_id, fetched.c.user_id),
+        )
+        .returning(
+            discount_code_fetched_outbox.c.discount_code_id,
+            discount_code_fetched_outbox.c.campaign_id,
+        )
+    )
+
+
+def _select_available_code_statement(campaign_id: int):
+    return (
+        select(available_discount_codes.c.id, available_discount_codes.c.campaign_id)
+        .where(
+            available_discount_codes.c.campaign_id == campaign_id,
+            available_discount_codes.c.leased_by.is_(None),
+            not_fetched_filter(),
+        )
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+
+
+def _delete_available_code_statement(available_discount_code):
+    return delete(available_discount_codes).where(
+        available_discount_codes.c.id == available_discount_code.id,
+        available_discount_codes.c.campaign_id == available_discount_code.campaign_id,
+    )
+
+
+def _claim_discount_code(campaign_id: int, user_id: int) -> Optional[ClaimedDiscountCode]:
+    """Moves one available code to fetched codes in the current transaction.
+
+    Returns None if no code is available.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        row = connection.execute(_claim_statement(campaign_id, user_id)).first()
+        return ClaimedDiscountCode(*row) if row else None
+
+    # Portable fallback, e.g. for SQLite that does not support DML in CTEs
+    available_discount_code = connection.execute(
+        _select_available_code_statement(campaign_id)
+    ).first()
+    if not available_discount_code:
+        return None
+    connection.execute(_delete_available_code_statement(available_discount_code))
+    _insert_fetched_discount_code(
+        available_discount_code.id, available_discount_code.campaign_id, user_id
+    )
+    return ClaimedDiscountCode(available_discount_code.id, available_discount_code.campaign_id)
+
+
+def _insert_fetched_discount_code_statements(code_id: str, campaign_id: int, user_id: int):
+    return [
+        fetched_discount_codes.insert().values(
+            id=code_id,
+            campaign_id=campaign_id,
+            user_id=user_id,
+            is_used=False,
+            is_fetched_event_sent=False,
+        ),
+        discount_code_fetched_outbox.insert().values(
+            discount_code_id=code_id, campaign_id=campaign_id, user_id=user_id
+        ),
+    ]
+
+
+def _insert_fetched_discount_code(code_id: str, campaign_id: int, user_id: int) -> None:
+    for statement in _insert_fetched_discount_code_statements(code_id, campaign_id, user_id):
+        db.session.execute(statement)
+
+
+def _is_already_fetched(campaign_id: int, user_id: int) -> bool:
+    return (
+        db.session.execute(
+            select(fetched_discount_codes.c.id).where(
+                fetched_discount_codes.c.campaign_id == campaign_id,
+                fetched_discount_codes.c.user_id == user_id,
+            )
+        ).first()
+        is not None
+    )
+
+
+class SqlCodeStore:
+    name = "sql"
+
+    def claim(self, campaign_id: int, user_id: int) -> Optional[ClaimedDiscountCode]:
+        leased_discount_code = None
+        if discount_code_lease_pool.enabled:
+            leased_discount_code = discount_code_lease_pool.take(campaign_id)
+        try:
+            if leased_discount_code:
+                # Code is already reserved by this worker - a single INSERT claims it
+                _insert_fetched_discount_code(
+                    leased_discount_code.id, leased_discount_code.campaign_id, user_id
+                )
+                claimed_discount_code = ClaimedDiscountCode(*leased_discount_code)
+            else:
+                claimed_discount_code = _claim_discount_code(campaign_id, user_id)
+        except IntegrityError as exc:
+            db.session.rollback()
+            if _is_already_fetched(campaign_id, user_id):
+                if leased_discount_code:
+                    discount_code_lease_pool.put_back(leased_discount_code)
+                raise DiscountCodeAlreadyExistsError from exc
+            if not leased_discount_code:
+                raise
+            # Lease expired while the code was handed out and another worker issued it
+            logger.warning("discount_code_leased_code_already_issued", id=leased_discount_code.id)
+            return self.claim(campaign_id, user_id)
+        if not claimed_discount_code:
+            db.session.rollback()
+            return None
+        increment_campaign_counters(campaign_id, available=-1, issued=1)
+        db.session.commit()
+        return claimed_discount_code
+
+    def get_claimed_code_id(self, campaign_id: int, user_id: int) -> Optional[str]:
+        return None
+
+    def codes_added(self, campaign_id: int, codes: List[str]) -> None:
+        pass
+
+    def schedule_persistence(self) -> None:
+        # Codes are already in SQL - only their events are relayed
+        discount_code_event_relay.schedule()
+
+    def persist_claimed(self) -> int:
+        return 0
+
+
+class RedisCodeStore:
+    name = "redis"
+
+    # Value of the user key until the claimed code id is known, expires if the claim dies
+    CLAIMING = b""
+    CLAIMING_TTL_SECONDS = 10
+    # Renewed before every persisted batch, expires when the persister dies
+    PERSIST_LOCK_TTL_SECONDS = 60
+
+    def __init__(
+        self,
+        url: str,
+        persist_batch: int = 500,
+        persist_in_background: bool = True,
+        prefix: str = "discounts",
+    ) -> None:
+        self.redis = create_redis_client(url)
+        self.persist_batch = persist_batch
+        self.persist_in_background = persist_in_background
+        self.prefix = prefix
+        self.claimed_key = f"{prefix}:claimed"
+        self.persist_lock_key = f"{prefix}:claimed:lock"
+        self.users_backfilled_key = f"{prefix}:users:backfilled"
+        self.available_backfilled_key = f"{prefix}:available:backfilled"
+        self._are_users_backfilled = False
+        self._is_persisting = False
+        self._is_pending = False
+        self._lock = threading.Lock()
+
+    def available_key(self, campaign_id: int) -> str:
+        return f"{self.prefix}:{campaign_id}:available"
+
+    def user_key(self, campaign_id: int, user_id: int) -> str:
+        return f"{self.prefix}:{campaign_id}:users:{user_id}"
+
+    def claim(self, campaign_id: int, user_id: int) -> Optional[ClaimedDiscountCode]:
+        user_key = self.user_key(campaign_id, user_id)
+        if not self.redis.set(user_key, self.CLAIMING, nx=True, ex=self.CLAIMING_TTL_SECONDS):
+            raise DiscountCodeAlreadyExistsError
+        code_id = None
+        try:
+            if not self.are_users_backfilled():
+                self._check_fetched_in_sql(campaign_id, user_id)
+            popped_code_id = self.redis.lpop(self.available_key(campaign_id))
+            if popped_code_id is None:
+                self.redis.delete(user_key)
+                return None
+            code_id = popped_code_id.decode()
+            record = orjson.dumps([code_id, int(campaign_id), user_id])
+            # Overwritten without a TTL
+            with self.redis.pipeline(transaction=True) as pipeline:
+                pipeline.set(user_key, code_id).rpush(self.claimed_key, record).execute()
+        except DiscountCodeAlreadyExistsError:
+            raise
+        except Exception:
+            # The user can claim again, a popped code stays available in SQL only
+            self.redis.delete(user_key)
+            logger.exception("discount_code_store_claim_failed", popped_code_id=code_id)
+            raise
+        return ClaimedDiscountCode(code_id, int(campaign_id))
+
+    def _check_fetched_in_sql(self, campaign_id: int, user_id: int) -> None:
+        # Users who claimed through SQL, e.g. before the switch to this store, have no user key
+        fetched_code_id = db.session.execute(
+            select(fetched_discount_codes.c.id).where(
+                fetched_discount_codes.c.campaign_id == campaign_id,
+                fetched_discount_codes.c.user_id == user_id,
+            )
+        ).scalar()
+        if fetched_code_id is not None:
+            self.redis.set(self.user_key(campaign_id, user_id), fetched_code_id)
+            raise DiscountCodeAlreadyExistsError
+
+    def are_users_backfilled(self) -> bool:
+        if not self._are_users_backfilled:
+            self._are_users_backfilled = self.redis.get(self.users_backfilled_key) is not None
+        return self._are_users_backfilled
+
+    def backfill_user_keys(self, chunk_size: int = 10000) -> int:
+        """Sets user keys of all codes fetched in SQL, so claims stop looking them up there.
+        Run once no worker claims through the sql store any more. Returns the count of codes."""
+        connection = db.session.connection().execution_options(
+            stream_results=True, max_row_buffer=chunk_size
+        )
+        result = connection.execute(
+            select(
+                fetched_discount_codes.c.id,
+                fetched_discount_codes.c.campaign_id,
+                fetched_discount_codes.c.user_id,
+            )
+        )
+        count = 0
+        try:
+            for rows in result.partitions(chunk_size):
+                with self.redis.pipeline(transaction=False) as pipeline:
+                    for code_id, campaign_id, user_id in rows:
+                        pipeline.set(self.user_key(campaign_id, user_id), code_id, nx=True)
+                    pipeline.execute()
+                count += len(rows)
+        finally:
+            result.close()
+        self.redis.set(self.users_backfilled_key, 1)
+        self._are_users_backfilled = True
+        return count
+
+    def backfill_available_codes(self, chunk_size: int = 10000) -> int:
+        """Pushes codes available in SQL, not leased and not fetched, to the lists of their
+        campaigns. Run once, before the switch to this store, while generation jobs and imports
+        are paused. Returns the count of codes, raises RuntimeError when run again."""
+        if not self.redis.set(self.available_backfilled_key, 1, nx=True):
+            raise RuntimeError("Available codes are already backfilled")
+        connection = db.session.connection().execution_options(
+            stream_results=True, max_row_buffer=chunk_size
+        )
+        result = connection.execute(
+            select(available_discount_codes.c.id, available_discount_codes.c.campaign_id)
+            .where(available_discount_codes.c.leased_by.is_(None), is_not_fetched)
+            .order_by(available_discount_codes.c.campaign_id)
+        )
+        count = 0
+        try:
+            for rows in result.partitions(chunk_size):
+                with self.redis.pipeline(transaction=False) as pipeline:
+                    for campaign_id, codes in groupby(rows, key=itemgetter(1)):
+                        pipeline.rpush(
+                            self.available_key(campaign_id), *(code for code, _ in codes)
+                        )
+                    pipeline.execute()
+                count += len(rows)
+        finally:
+            result.close()
+        return count
+
+    def get_claimed_code_id(self, campaign_id: int, user_id: int) -> Optional[str]:
+        code_id = self.redis.get(self.user_key(campaign_id, user_id))
+        return code_id.decode() if code_id else None
+
+    def codes_added(self, campaign_id: int, codes: List[str]) -> None:
+        key = self.available_key(campaign_id)
+        for offset in range(0, len(codes), self.persist_batch):
+            self.redis.rpush(key, *islice(codes, offset, offset + self.persist_batch))
+
+    def available_count(self, campaign_id: int) -> int:
+        return self.redis.llen(self.available_key(campaign_id))
+
+    def schedule_persistence(self) -> None:
+        if not self.persist_in_background:
+            return
+        with self._lock:
+            if self._is_persisting:
+                self._is_pending = True
+                return
+            self._is_persisting = True
+        executor.submit(self._persist_in_background)
+
+    def _persist_in_background(self) -> None:
+        try:
+            while True:
+                if self.persist_claimed():
+                    discount_code_event_relay.schedule()
+                with self._lock:
+                    if not self._is_pending:
+                        self._is_persisting = False
+                        return
+                    self._is_pending = False
+        except Exception:  # pylint: disable=broad-except
+            db.session.rollback()
+            logger.exception("discount_code_store_persist_failed")
+            with self._lock:
+                self._is_persisting = False
+
+    def persist_claimed(self) -> int:
+        """Persists queued claims of all workers, returns the persisted count.
+
+        One persister at a time holds the lock key, so a batch is read, committed to SQL and
+        only then trimmed from the queue. The lock is renewed before every batch, a persister
+        whose lock expired stops. A batch committed again after a crash before the trim skips
+        its already fetched codes.
+        """
+        token = uuid.uuid4().hex
+        if not self.redis.set(
+            self.persist_lock_key, token, nx=True, ex=self.PERSIST_LOCK_TTL_SECONDS
+        ):
+            return 0
+        persisted_count = 0
+        try:
+            while True:
+                if not self._renew_persist_lock(token):
+                    logger.warning("discount_code_store_persist_lock_lost")
+                    break
+                records = self.redis.lrange(self.claimed_key, 0, self.persist_batch - 1)
+                if not records:
+                    break
+                persisted_count += self._persist_batch(orjson.loads(record) for record in records)
+                self.redis.ltrim(self.claimed_key, len(records), -1)
+                if len(records) < self.persist_batch:
+                    break
+        finally:
+            if self.redis.get(self.persist_lock_key) == token.encode():
+                self.redis.delete(self.persist_lock_key)
+        if persisted_count:
+            logger.info("discount_code_store_claims_persisted", count=persisted_count)
+        return persisted_count
+
+    def _renew_persist_lock(self, token: str) -> bool:
+        if self.redis.get(self.persist_lock_key) != token.encode():
+            return False
+        self.redis.set(self.persist_lock_key, token, ex=self.PERSIST_LOCK_TTL_SECONDS)
+        return True
+
+    @staticmethod
+    def _persist_batch(claims: Iterable[list]) -> int:
+        claims = list(claims)
+        already_fetched_ids = set(
+            db.session.execute(
+                select(fetched_discount_codes.c.id).where(
+                    fetched_discount_codes.c.id.in_([code_id for code_id, _, _ in claims])
+                )
+            ).scalars()
+        )
+        claims = [claim for claim in claims if claim[0] not in already_fetched_ids]
+        if claims:
+            db.session.execute(
+                delete(available_discount_codes).where(
+                    available_discount_codes.c.id.in_([code_id for code_id, _, _ in claims])
+                )
+            )
+            db.session.execute(
+                fetched_discount_codes.insert(),
+                [
+                    {
+                        "id": code_id,
+                        "campaign_id": campaign_id,
+                        "user_id": user_id,
+                        "is_used": False,
+                        "is_fetched_event_sent": False,
+                    }
+                    for code_id, campaign_id, user_id in claims
+                ],
+            )
+            db.session.execute(
+                discount_code_fetched_outbox.insert(),
+                [
+                    {"discount_code_id": code_id, "campaign_id": campaign_id, "user_id": user_id}
+                    for code_id, campaign_id, user_id in claims
+                ],
+            )
+            for campaign_id, count in Counter(campaign_id for _, campaign_id, _ in claims).items():
+                increment_campaign_counters(campaign_id, available=-count, issued=count)
+        db.session.commit()
+        return len(claims)
+
+
+def create_code_store(store_type: str) -> CodeStore:
+    if store_type == "sql":
+        return SqlCodeStore()
+    if store_type == "redis":
+        app_config = get_settings()
+        return RedisCodeStore(
+            app_config.DISCOUNT_CODE_STORE_REDIS_URL,
+            app_config.DISCOUNT_CODE_STORE_PERSIST_BATCH,
+            app_config.DISCOUNT_CODE_STORE_PERSIST_IN_BACKGROUND,
+        )
+    raise ValueError(f"Unknown discount code store: {store_type}")
+
+
+class DiscountCodeStore:
+    """Code store of the app, configured by `DISCOUNT_CODE_STORE`."""
+
+    def __init__(self) -> None:
+        self.store: CodeStore = SqlCodeStore()
+
+    def init_app(self, app: Flask) -> None:  # pylint: disable=unused-argument
+        self.store = create_code_store(get_settings().DISCOUNT_CODE_STORE)
+
+    @property
+    def name(self) -> str:
+        return self.store.name
+
+    def claim(self, campaign_id: int, user_id: int) -> Optional[ClaimedDiscountCode]:
+        return self.store.claim(campaign_id, user_id)
+
+    def get_claimed_code_id(self, campaign_id: int, user_id: int) -> Optional[str]:
+        return self.store.get_claimed_code_id(campaign_id, user_id)
+
+    def codes_added(self, campaign_id: int, codes: List[str]) -> None:
+        if codes:
+            self.store.codes_added(campaign_id, codes)
+
+    def schedule_persistence(self) -> None:
+        self.store.schedule_persistence()
+
+    def persist_claimed(self) -> int:
+        return self.store.persist_claimed()
+
+
+discount_code_store = DiscountCodeStore()
@@ -0,0 +1,148 @@
+"""Inventory counters of campaigns - available, issued and redeemed codes.
+
+Counters are incremented in the same transaction as the claims, generation batches, imports
+and redemptions that change them, so reading them needs no `COUNT(*)` over the code tables.
+Every increment goes to a random one of `CAMPAIGN_COUNTER_STRIPES` rows of the campaign -
+concurrent claims seldom wait for the row lock of another - and reads sum the rows.
+Codes added or removed without these functions are corrected by `repair_campaign_counters`.
+"""
+import random
+from typing import Dict, List, Optional
+
+from sqlalchemy import exists, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from structlog import get_logger
+
+from .. import db
+from ..config import get_settings
+from ..models import (
+    AvailableDiscountCode,
+    Campaign,
+    CampaignCounter,
+    FetchedDiscountCode,
+)
+from .exceptions import CampaignNotFoundError
+
+logger = get_logger(__name__)
+
+available_discount_codes = AvailableDiscountCode.__table__
+fetched_discount_codes = FetchedDiscountCode.__table__
+campaign_counters = CampaignCounter.__table__
+
+COUNTERS = ("available", "issued", "redeemed")
+
+
+def increment_statement(
+    dialect_name: str,
+    campaign_id: int,
+    available: int = 0,
+    issued: int = 0,
+    redeemed: int = 0,
+    stripe: Optional[int] = None,
+):
+    """Upsert adding the counts to a stripe of the campaign counters, a random one by default.
+
+    PostgreSQL and SQLite both support `INSERT ... ON CONFLICT DO UPDATE`.
+    """
+    if stripe is None:
+        stripe = random.randrange(get_settings().CAMPAIGN_COUNTER_STRIPES)
+    insert = (postgresql if dialect_name == "postgresql" else sqlite).insert(campaign_counters)
+    statement = insert.values(
+        campaign_id=campaign_id,
+        stripe=stripe,
+        available_count=available,
+        issued_count=issued,
+        redeemed_count=redeemed,
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[campaign_counters.c.campaign_id, campaign_counters.c.stripe],
+        set_={
+            f"{name}_count": campaign_counters.c[f"{name}_count"]
+            + statement.excluded[f"{name}_count"]
+            for name in COUNTERS
+        },
+    )
+
+
+def increment_campaign_counters(
+    campaign_id: int,
+    available: int = 0,
+    issued: int = 0,
+    redeemed: int = 0,
+    connection: Optional[Connection] = None,
+) -> None:
+    """Adds the counts to the campaign counters in the current transaction of the given
+    connection, or of the session."""
+    if not (available or issued or redeemed):
+        return
+    connection = connection or db.session.connection()
+    connection.execute(
+        increment_statement(connection.dialect.name, campaign_id, available, issued, redeemed)
+    )
+
+
+def get_campaign_counts(campaign_id: int) -> Dict[str, int]:
+    """Counts of available (not yet issued), issued and redeemed codes of the campaign."""
+    if not db.session.get(Campaign, campaign_id):
+        raise CampaignNotFoundError
+    row = db.session.execute(
+        select(
+            *(func.coalesce(func.sum(campaign_counters.c[f"{name}_count"]), 0) for name in COUNTERS)
+        ).where(campaign_counters.c.campaign_id == campaign_id)
+    ).one()
+    return dict(zip(COUNTERS, row))
+
+
+def _count_statement(campaign_id: int):
+    # Codes handed out from a worker lease stay in the available table until it's refilled
+    available = (
+        select(func.count())
+        .where(
+            available_discount_codes.c.campaign_id == campaign_id,
+            ~exists().where(fetched_discount_codes.c.id == available_discount_codes.c.id),
+        )
+        .scalar_subquery()
+    )
+    issued = select(func.count()).where(fetched_discount_codes.c.campaign_id == campaign_id)
+    redeemed = issued.where(fetched_discount_codes.c.is_used.is_(True))
+    return select(available, issued.scalar_subquery(), redeemed.scalar_subquery())
+
+
+def recompute_campaign_counters(connection: Connection, campaign_id: int) -> Dict[str, int]:
+    """Replaces the counters of the campaign with counts of the code tables, in the current
+    transaction of the connection. Returns the counts.
+
+    The stripes are deleted before counting - concurrent transactions incrementing them wait
+    for the row locks and add their counts to the recomputed ones afterwards, while those
+    committed before are in the counts.
+    """
+    connection.execute(
+        campaign_counters.delete().where(campaign_counters.c.campaign_id == campaign_id)
+    )
+    counts = dict(zip(COUNTERS, connection.execute(_count_statement(campaign_id)).one()))
+    connection.execute(
+        increment_statement(connection.dialect.name, campaign_id, stripe=0, **counts)
+    )
+    return counts
+
+
+def repair_campaign_counters(campaign_ids: Optional[List[int]] = None) -> Dict[int, dict]:
+    """Recomputes counters of the campaigns, or of all campaigns, from the code tables,
+    one transaction per campaign. Returns counts of the campaigns which were off."""
+    if campaign_ids is None:
+        campaign_ids = db.session.execute(select(Campaign.id).order_by(Campaign.id)).scalars()
+    repaired = {}
+    for campaign_id in list(campaign_ids):
+        counted = get_campaign_counts(campaign_id)
+        counts = recompute_campaign_counters(db.session.connection(), campaign_id)
+        db.session.commit()
+        if counts != counted:
+            repaired[campaign_id] = counts
+            logger.warning(
+                "campaign_counters_repaired",
+                campaign_id=campaign_id,
+                **{f"previous_{name}": counted[name] for name in COUNTERS},
+                **counts,
+            )
+    return repaired
@@ -1,20 +1,180 @@
+"""Relay of discount code fetched events from the transactional outbox.
+
+Claims write events to `discount_code_fetched_outbox` in the same transaction as the fetched
+code. The relay takes outbox rows in batches with `FOR UPDATE SKIP LOCKED`, so relays of
+several workers never publish the same rows, publishes them to the configured sink, marks
+the codes with one bulk UPDATE and deletes the published rows. Events are delivered at least
+once - a batch is published again if the relay dies before the commit.
+"""
+import json
+import threading
+from typing import List, Optional, Protocol
+
+from flask import Flask, has_request_context
+from sqlalchemy import delete, select, update
 from structlog import get_logger
 
 from .. import db, executor
-from ..models import FetchedDiscountCode
+from ..config import get_settings
+from ..metrics import observe_fetched_event_lag
+from ..models import DiscountCodeFetchedOutbox, FetchedDiscountCode
 
 logger = get_logger(__name__)
 
+discount_code_fetched_outbox = DiscountCodeFetchedOutbox.__table__
+fetched_discount_codes = FetchedDiscountCode.__table__
+
+
+class EventSink(Protocol):
+    def publish(self, events: List[dict]) -> None:
+        ...
+
+
+class LogEventSink:
+    """Stand-in for the message queue - events are only logged."""
+
+    def publish(self, events: List[dict]) -> None:
+        for event in events:
+            logger.info("send_discount_code_fetched_event", **event)
+
+
+class InMemoryEventSink:
+    def __init__(self) -> None:
+        self.events: List[dict] = []
+
+    def publish(self, events: List[dict]) -> None:
+        self.events.extend(events)
+
+
+class FileEventSink:
+    """Appends events as newline delimited JSON, one write per batch."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def publish(self, events: List[dict]) -> None:
+        lines = "".join(json.dumps(event) + "\n" for event in events)
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(lines)
+
+
+def create_event_sink(sink_type: str) -> EventSink:
+    if sink_type == "log":
+        return LogEventSink()
+    if sink_type == "memory":
+        return InMemoryEventSink()
+    if sink_type == "file":
+        return FileEventSink(get_settings().DISCOUNT_CODE_EVENT_SINK_FILE)
+    raise ValueError(f"Unknown discount code event sink: {sink_type}")
+
+
+class DiscountCodeEventRelay:
+    def __init__(self) -> None:
+        self.sink: EventSink = LogEventSink()
+        self.batch_size = 500
+        self.run_in_background = True
+        self._is_running = False
+        self._is_pending = False
+        self._lock = threading.Lock()
+        self._app: Optional[Flask] = None
+
+    def init_app(self, app: Flask) -> None:
+        self._app = app
+        app_config = get_settings()
+        self.sink = create_event_sink(app_config.DISCOUNT_CODE_EVENT_SINK)
+        self.batch_size = app_config.DISCOUNT_CODE_EVENT_RELAY_BATCH
+        self.run_in_background = app_config.DISCOUNT_CODE_EVENT_RELAY_IN_BACKGROUND
+        self._is_running = False
+        self._is_pending = False
+
+    def schedule(self) -> None:
+        """Starts the relay in the background unless it is already running.
+
+        Claims made while the relay is running are picked up by its next batch,
+        so under load many events are published with a single commit. Outside of a request,
+        e.g. in the ASGI app, the relay runs in its own thread with an app context.
+        """
+        if not self.run_in_background:
+            return
+        with self._lock:
+            if self._is_running:
+                self._is_pending = True
+                return
+            self._is_running = True
+        if has_request_context():
+            executor.submit(self._relay_in_background)
+        else:
+            threading.Thread(
+                target=self._relay_in_app_context, name="discount-code-event-relay", daemon=True
+            ).start()
+
+    def _relay_in_app_context(self) -> None:
+        with self._app.app_context():
+            self._relay_in_background()
+
+    def _relay_in_background(self) -> None:
+        try:
+            while True:
+                self.relay()
+                with self._lock:
+                    if not self._is_pending:
+                        self._is_running = False
+                        return
+                    self._is_pending = False
+        except Exception:  # pylint: disable=broad-except
+            db.session.rollback()
+            logger.exception("discount_code_event_relay_failed")
+            with self._lock:
+                self._is_running = False
+
+    def relay(self) -> int:
+        """Publishes outbox events until the outbox is empty, returns the published count."""
+        published_count = 0
+        while True:
+            batch_count = self.relay_batch()
+            published_count += batch_count
+            if batch_count < self.batch_size:
+                return published_count
+
+    def relay_batch(self) -> int:
+        rows = db.session.execute(
+            select(discount_code_fetched_outbox)
+            .order_by(discount_code_fetched_outbox.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not rows:
+            db.session.commit()
+            return 0
+
+        self.sink.publish(
+            [
+                {
+                    "discount_code_id": row.discount_code_id,
+                    "campaign_id": row.campaign_id,
+                    "user_id": row.user_id,
+                    "created_at": row.created_at.isoformat(),
+                }
+                for row in rows
+            ]
+        )
+        db.session.execute(
+            update(fetched_discount_codes)
+            .where(fetched_discount_codes.c.id.in_([row.discount_code_id for row in rows]))
+            .values(is_fetched_event_sent=True)
+        )
+        db.session.execute(
+            delete(discount_code_fetched_outbox).where(
+                discount_code_fetched_outbox.c.id.in_([row.id for row in rows])
+            )
+        )
+        db.session.commit()
+
+        # Cached codes stay - the sent flag isn't part of the cached payload
+        observe_fetched_event_lag(row.created_at for row in rows)
+        logger.info("discount_code_fetched_events_relayed", count=len(rows))
+        return len(rows)
+
 
-@executor.job
-def send_discount_code_fetched_event(discount_code: FetchedDiscountCode):
-    # Placing event to a queue asynchronously
-    logger.info(
-        "send_discount_code_fetched_event",
-        discount_code_id=discount_code.id,
-        campaign_id=discount_code.campaign_id,
-        user_id=discount_code.user_id,
-    )
-    discount_code.is_fetched_event_sent = True
-    db.session.add(discount_code)
-    db.session.commit()
+discount_code_event_relay = DiscountCodeEventRelay()
@@ -8,3 +8,15 @@ class DiscountCodeAlreadyExistsError(Exception):
 
 class CampaignNotFoundError(Exception):
     pass
+
+
+class GenerationJobNotFoundError(Exception):
+    pass
+
+
+class GenerationJobAlreadyFinishedError(Exception):
+    pass
+
+
+class GenerationJobAlreadyRunningError(Exception):
+    pass
@@ -0,0 +1,91 @@
+"""Export of issued discount codes of a campaign, streamed from a server-side cursor.
+
+Rows are fetched in chunks of `DISCOUNT_CODE_EXPORT_CHUNK_SIZE` and each chunk is encoded and
+written before the next one is fetched, so a worker holds one chunk whatever the campaign
+size. Codes are ordered by user id - the index of the unique `(campaign_id, user_id)`
+constraint serves both the order and the keyset cursor an interrupted export resumes from.
+"""
+import csv
+import io
+from typing import Iterator, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.engine import Row
+
+from .. import db
+from ..models import Campaign, FetchedDiscountCode
+from ..util.serialization import NDJSON_MIMETYPE, dumps
+from .exceptions import CampaignNotFoundError
+
+fetched_discount_codes = FetchedDiscountCode.__table__
+
+EXPORT_COLUMNS = ("id", "campaign_id", "user_id", "is_used", "is_fetched_event_sent")
+
+
+def export_discount_codes(
+    campaign_id: int,
+    chunk_size: int,
+    is_used: Optional[bool] = None,
+    is_fetched_event_sent: Optional[bool] = None,
+    after_user_id: Optional[int] = None,
+) -> Iterator[List[Row]]:
+    """Issued codes of the campaign ordered by user id, the returned iterator yields them in
+    chunks as they are fetched. Resumes after the user id of the last exported code."""
+    if not db.session.get(Campaign, campaign_id):
+        raise CampaignNotFoundError
+    statement = (
+        select(*(fetched_discount_codes.c[column] for column in EXPORT_COLUMNS))
+        .where(fetched_discount_codes.c.campaign_id == campaign_id)
+        .order_by(fetched_discount_codes.c.user_id)
+    )
+    if is_used is not None:
+        statement = statement.where(fetched_discount_codes.c.is_used.is_(is_used))
+    if is_fetched_event_sent is not None:
+        statement = statement.where(
+            fetched_discount_codes.c.is_fetched_event_sent.is_(is_fetched_event_sent)
+        )
+    if after_user_id is not None:
+        statement = statement.where(fetched_discount_codes.c.user_id > after_user_id)
+    return _fetch_chunks(statement, chunk_size)
+
+
+def _fetch_chunks(statement, chunk_size: int) -> Iterator[List[Row]]:
+    # Named cursor with psycopg2 - rows stay on the server until a chunk is fetched
+    connection = db.session.connection().execution_options(
+        stream_results=True, max_row_buffer=chunk_size
+    )
+    result = connection.execute(statement)
+    try:
+        yield from result.partitions(chunk_size)
+    finally:
+        result.close()
+
+
+def encode_ndjson(chunks: Iterator[List[Row]]) -> Iterator[bytes]:
+    for rows in chunks:
+        yield b"".join(dumps(dict(row._mapping)) + b"\n" for row in rows)
+
+
+def _csv_row(row: Row) -> tuple:
+    # Booleans as in the NDJSON export and the filters
+    return tuple(str(value).lower() if isinstance(value, bool) else value for value in row)
+
+
+def encode_csv(chunks: Iterator[List[Row]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows(map(_csv_row, rows))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # Header of an export without codes
+        yield buffer.getvalue().encode()
+
+
+EXPORT_FORMATS = {
+    "ndjson": (encode_ndjson, NDJSON_MIMETYPE),
+    "csv": (encode_csv, "text/csv"),
+}
@@ -0,0 +1,151 @@
+"""Responses of requests with an `Idempotency-Key` header, replayed to retries of the client.
+
+The first request with a key takes it with `SET NX` and runs the view, its response is then
+stored under the key for `IDEMPOTENCY_TTL_SECONDS`. A retry gets the stored status and body
+without running the view, and a retry arriving while the first request is still running polls
+the key until the response is stored. Keys are scoped to the user and the path, so a key
+reused by another user or for another campaign is a different request.
+
+Responses are stored in Redis at `IDEMPOTENCY_REDIS_URL`, shared by all workers - bounded by
+the TTL and the `maxmemory` of the server. `memory://` URLs, the default, are per process, so
+a retry reaching another worker would claim again - `check_shared_store` refuses them for more
+than one worker, and refuses a Redis server it can't reach instead of failing every claim.
+"""
+import time
+import uuid
+from functools import wraps
+from typing import Callable, Optional, Tuple
+
+from flask import Flask, Response, current_app, request
+from structlog import get_logger
+
+from ..auth import current_user
+from ..config import get_settings
+from ..errors.exceptions import AppError
+from ..util.redis_client import create_redis_client
+from ..util.serialization import json_response
+
+logger = get_logger(__name__)
+
+IN_FLIGHT = b"in-flight:"
+
+
+class IdempotentResponses:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.redis = None
+        self.ttl_seconds = 86400
+        self.lock_ttl_seconds = 10.0
+        self.wait_seconds = 5.0
+        self.poll_interval_seconds = 0.01
+        self.max_key_length = 255
+
+    def init_app(self, app: Flask) -> None:  # pylint: disable=unused-argument
+        app_config = get_settings()
+        self.enabled = app_config.IDEMPOTENCY_ENABLED
+        self.redis = create_redis_client(app_config.IDEMPOTENCY_REDIS_URL)
+        self.ttl_seconds = app_config.IDEMPOTENCY_TTL_SECONDS
+        self.lock_ttl_seconds = app_config.IDEMPOTENCY_LOCK_TTL_SECONDS
+        self.wait_seconds = app_config.IDEMPOTENCY_WAIT_SECONDS
+        self.poll_interval_seconds = app_config.IDEMPOTENCY_POLL_INTERVAL_MS / 1000
+        self.max_key_length = app_config.IDEMPOTENCY_MAX_KEY_LENGTH
+
+    @staticmethod
+    def key(user_id: int, path: str, idempotency_key: str) -> str:
+        return f"idempotency:{user_id}:{path}:{idempotency_key}"
+
+    def respond(self, key: str, view: Callable[[], Response]) -> Response:
+        """Stored response of the key, or the response of the view stored under the key."""
+        token = IN_FLIGHT + uuid.uuid4().hex.encode()
+        stored_response = self._wait_for_response(key, token)
+        if stored_response:
+            status_code, body = stored_response
+            logger.info("idempotent_response_replayed", status_code=status_code)
+            response = json_response(body, status_code)
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            response = current_app.make_response(view())
+        except AppError as exc:
+            # Error responses are the outcome of the request too, retries get them as well
+            response = current_app.make_response(current_app.handle_user_exception(exc))
+        except Exception:
+            self._release(key, token)
+            raise
+        if response.status_code >= 500:
+            # Retries run the view again
+            self._release(key, token)
+        else:
+            value = b"%d:%s" % (response.status_code, response.get_data())
+            self.redis.set(key, value, ex=self.ttl_seconds)
+        return response
+
+    def _wait_for_response(self, key: str, token: bytes) -> Optional[Tuple[int, bytes]]:
+        """Takes the key and returns None, or returns the response stored under the key."""
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            # A worker dying with the key taken doesn't block the key for longer than the lock TTL
+            if self.redis.set(key, token, nx=True, px=int(self.lock_ttl_seconds * 1000)):
+                return None
+            value = self.redis.get(key)
+            if value is not None and not value.startswith(IN_FLIGHT):
+                status_code, _, body = value.partition(b":")
+                return int(status_code), body
+            if time.monotonic() >= deadline:
+                raise AppError(error_code="IDEMPOTENCY_KEY_IN_USE", status_code=409)
+            time.sleep(self.poll_interval_seconds)
+
+    def _release(self, key: str, token: bytes) -> None:
+        if self.redis.get(key) == token:
+            self.redis.delete(key)
+
+
+idempotent_responses = IdempotentResponses()
+
+
+def check_shared_store(workers_count: int) -> None:
+    """Raises RuntimeError when responses of more than one worker would be stored per process,
+    or when the Redis server of responses can't be reached."""
+    app_config = get_settings()
+    url = app_config.IDEMPOTENCY_REDIS_URL
+    if not app_config.IDEMPOTENCY_ENABLED:
+        return
+    if url.startswith("memory://"):
+        if workers_count > 1:
+            raise RuntimeError(
+                f"IDEMPOTENCY_REDIS_URL {url} is per process, "
+                f"set a redis:// URL shared by the {workers_count} workers"
+            )
+        return
+    try:
+        create_redis_client(url).ping()
+    except Exception as exc:
+        raise RuntimeError(
+            f"IDEMPOTENCY_REDIS_URL {url} can't be reached, start the server "
+            "or set IDEMPOTENCY_ENABLED=false"
+        ) from exc
+
+
+def idempotent(view: Callable) -> Callable:
+    """Replays the response of the view to retries with the same `Idempotency-Key` header."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if not idempotency_key or not idempotent_responses.enabled:
+            return view(*args, **kwargs)
+        if len(idempotency_key) > idempotent_responses.max_key_length:
+            raise AppError(
+                error_code="REQUEST_VALIDATION_FAILED",
+                error_message=(
+                    "'Idempotency-Key' header must be at most "
+                    f"{idempotent_responses.max_key_length} characters"
+                ),
+                status_code=400,
+            )
+        user = current_user()
+        key = idempotent_responses.key(user["id"], request.path, idempotency_key)
+        return idempotent_responses.respond(key, lambda: view(*args, **kwargs))
+
+    return wrapper
@@ -0,0 +1,114 @@
+"""Redemptions of issued discount codes reported by marketplaces, in bulk.
+
+Code ids are read from the request body one line at a time, see `bulk.parse_code_ids`, and
+redeemed in chunks of `DISCOUNT_CODE_REDEMPTION_CHUNK_SIZE`, one bulk `UPDATE` and commit per chunk.
+Only the current chunk is held in memory, whatever the size of the body.
+"""
+from collections import Counter
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Set
+
+from sqlalchemy import select, update
+from structlog import get_logger
+
+from .. import db
+from ..metrics import DISCOUNT_CODE_REDEMPTIONS
+from ..models import Campaign, FetchedDiscountCode
+from .code_cache import fetched_discount_code_cache
+from .counters import increment_campaign_counters
+from .exceptions import CampaignNotFoundError
+
+logger = get_logger(__name__)
+
+fetched_discount_codes = FetchedDiscountCode.__table__
+
+OUTCOMES = ("redeemed", "already_used", "unknown", "invalid")
+
+
+def _redeem_chunk(campaign_id: int, code_ids: List[str]) -> List[tuple]:
+    """Marks not used codes of the chunk as used, returns their id and user_id rows."""
+    not_used = (
+        fetched_discount_codes.c.campaign_id == campaign_id,
+        fetched_discount_codes.c.id.in_(code_ids),
+        fetched_discount_codes.c.is_used.is_(False),
+    )
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        return connection.execute(
+            update(fetched_discount_codes)
+            .where(*not_used)
+            .values(is_used=True)
+            .returning(fetched_discount_codes.c.id, fetched_discount_codes.c.user_id)
+        ).all()
+
+    # Other databases (SQLite in tests) select the codes first, in the same transaction
+    redeemed = connection.execute(
+        select(fetched_discount_codes.c.id, fetched_discount_codes.c.user_id).where(*not_used)
+    ).all()
+    if redeemed:
+        connection.execute(
+            update(fetched_discount_codes)
+            .where(fetched_discount_codes.c.id.in_([code_id for code_id, _ in redeemed]))
+            .values(is_used=True)
+        )
+    return redeemed
+
+
+def _select_issued_ids(campaign_id: int, code_ids: List[str]) -> Set[str]:
+    return set(
+        db.session.execute(
+            select(fetched_discount_codes.c.id).where(
+                fetched_discount_codes.c.campaign_id == campaign_id,
+                fetched_discount_codes.c.id.in_(code_ids),
+            )
+        ).scalars()
+    )
+
+
+def redeem_discount_codes(
+    campaign_id: int, code_ids: Iterable[Optional[str]], chunk_size: int
+) -> Iterator[dict]:
+    """Redeems issued codes of the campaign, the returned iterator yields counts of every
+    committed chunk as it redeems them.
+
+    Counts - redeemed, already_used (including repeats of a code redeemed in the chunk),
+    unknown (not issued for the campaign) and invalid (not a code id).
+    """
+    if not db.session.get(Campaign, campaign_id):
+        raise CampaignNotFoundError
+    return _redeem_chunks(campaign_id, iter(code_ids), chunk_size)
+
+
+def _redeem_chunks(
+    campaign_id: int, code_ids: Iterator[Optional[str]], chunk_size: int
+) -> Iterator[dict]:
+    while chunk := list(islice(code_ids, chunk_size)):
+        occurrences = Counter(code_id for code_id in chunk if code_id is not None)
+        redeemed = _redeem_chunk(campaign_id, list(occurrences)) if occurrences else []
+        redeemed_ids = {code_id for code_id, _ in redeemed}
+        not_redeemed_ids = [code_id for code_id in occurrences if code_id not in redeemed_ids]
+        used_ids = _select_issued_ids(campaign_id, not_redeemed_ids) if not_redeemed_ids else set()
+        increment_campaign_counters(campaign_id, redeemed=len(redeemed))
+        db.session.commit()
+
+        for code_id, user_id in redeemed:
+            discount_code = {
+                "id": code_id,
+                "campaign_id": int(campaign_id),
+                "user_id": user_id,
+                "is_used": True,
+            }
+            fetched_discount_code_cache.set(campaign_id, user_id, discount_code)
+        counts = {
+            "redeemed": len(redeemed),
+            "already_used": sum(occurrences[code_id] for code_id in redeemed_ids | used_ids)
+            - len(redeemed),
+            "unknown": sum(
+                occurrences[code_id] for code_id in not_redeemed_ids if code_id not in used_ids
+            ),
+            "invalid": len(chunk) - sum(occurrences.values()),
+        }
+        for outcome, count in counts.items():
+            DISCOUNT_CODE_REDEMPTIONS.labels(outcome).inc(count)
+        logger.info("discount_codes_redeemed", campaign_id=campaign_id, **counts)
+        yield counts
@@ -1,26 +1,65 @@
-from flask import jsonify, request
+from flask import request
 from structlog import get_logger
 
 from ..auth import current_user
 from ..config import get_settings
 from ..errors.exceptions import AppError
+from ..metrics import DISCOUNT_CODE_CLAIMS
+from ..util.serialization import (
+    encode_fetched_discount_code,
+    json_response,
+    ndjson_response,
+    streamed_response,
+)
 from . import bp
-from .code_fetch import create_discount_code, get_already_created_discount_code
-from .code_generation import start_generate_discount_codes_job
-from .events import send_discount_code_fetched_event
+from .availability import campaign_availability_cache
+from .bulk import CSV_CONTENT_TYPES, NDJSON_CONTENT_TYPES, parse_code_ids, with_totals
+from .claim_batching import discount_code_claim_coalescer
+from .code_cache import fetched_discount_code_cache
+from .code_fetch import (
+    create_discount_code,
+    create_discount_codes_batch,
+    get_already_created_discount_code_dict,
+)
+from .code_generation import (
+    get_generate_discount_codes_job,
+    resume_generate_discount_codes_job,
+    start_generate_discount_codes_job,
+)
+from .code_import import OUTCOMES as IMPORT_OUTCOMES
+from .code_import import import_discount_codes
+from .counters import get_campaign_counts
 from .exceptions import (
     CampaignNotFoundError,
     DiscountCodeAlreadyExistsError,
     DiscountCodeNotAvailableError,
+    GenerationJobAlreadyFinishedError,
+    GenerationJobAlreadyRunningError,
+    GenerationJobNotFoundError,
 )
+from .export import EXPORT_FORMATS, export_discount_codes
+from .idempotency import idempotent
+from .redemption import OUTCOMES as REDEMPTION_OUTCOMES
+from .redemption import redeem_discount_codes
 
 logger = get_logger(__name__)
 
+# Per-user status and error code of batch claim results - same error codes as for single claim
+BATCH_CLAIM_ERRORS = {
+    DiscountCodeAlreadyExistsError: ("already_fetched", "DISCOUNT_CODE_ALREADY_FETCHED"),
+    DiscountCodeNotAvailableError: ("not_available", "DISCOUNT_CODE_NOT_AVAILABLE"),
+}
+
 
 @bp.post("/<campaign_id>")
+@idempotent
 def create_discount_code_route(campaign_id: int):
     """Create new discount code for given campaign and given user.
 
+    Request headers:
+        - Idempotency-Key (optional) - retries with the same key get the status and body of
+          the first response, with an `Idempotent-Replayed: true` header.
+
     Response status code:
         - 201 - discount code created.
     Response body:
@@ -33,19 +72,76 @@ def create_discount_code_route(campaign_id: int):
         - INVALID_ACCESS_TOKEN (HTTP 401)
         - DISCOUNT_CODE_NOT_AVAILABLE (HTTP 404)
         - DISCOUNT_CODE_ALREADY_FETCHED (HTTP 409)
+        - IDEMPOTENCY_KEY_IN_USE (HTTP 409) - the first request with the key is still running.
+        - REQUEST_VALIDATION_FAILED (HTTP 400) - the idempotency key is too long.
     """
     user = current_user()
     try:
-        discount_code = create_discount_code(
-            campaign_id=campaign_id,
-            user_id=user["id"],
-            code_fetched_event=send_discount_code_fetched_event,
-        )
+        if discount_code_claim_coalescer.enabled:
+            discount_code = discount_code_claim_coalescer.claim(
+                campaign_id=campaign_id, user_id=user["id"]
+            )
+        else:
+            discount_code = create_discount_code(campaign_id=campaign_id, user_id=user["id"])
     except DiscountCodeNotAvailableError as exc:
+        DISCOUNT_CODE_CLAIMS.labels("not_available").inc()
         raise AppError(error_code="DISCOUNT_CODE_NOT_AVAILABLE", status_code=404) from exc
     except DiscountCodeAlreadyExistsError as exc:
+        DISCOUNT_CODE_CLAIMS.labels("already_fetched").inc()
         raise AppError(error_code="DISCOUNT_CODE_ALREADY_FETCHED", status_code=409) from exc
-    return jsonify(discount_code.to_dict()), 201
+    DISCOUNT_CODE_CLAIMS.labels("created").inc()
+    return json_response(encode_fetched_discount_code(discount_code), 201)
+
+
+@bp.post("/<campaign_id>/batch")
+def create_discount_codes_batch_route(campaign_id: int):
+    """Create new discount codes for given campaign and many users in one transaction.
+
+    Request body:
+        - user_ids (list[int]) - users to claim discount codes for.
+
+    Response status code:
+        - 200 - claim results for every unique user id.
+    Response body:
+        - results (list) - user_id (int) and status (str), one of:
+            - created - with discount_code (dict) - id, campaign_id, user_id, is_used.
+            - already_fetched - with error_code DISCOUNT_CODE_ALREADY_FETCHED.
+            - not_available - with error_code DISCOUNT_CODE_NOT_AVAILABLE.
+
+    Error codes:
+        - INVALID_ACCESS_TOKEN (HTTP 401)
+        - REQUEST_VALIDATION_FAILED (HTTP 400)
+    """
+    current_user()
+    data = request.get_json()
+    max_users = get_settings().DISCOUNT_CODE_BATCH_CLAIM_MAX_USERS
+    user_ids = data.get("user_ids") if isinstance(data, dict) else None
+    # Strings and objects would be iterated, booleans are integers to Python
+    if (
+        not isinstance(user_ids, list)
+        or not 0 < len(user_ids) <= max_users
+        or not all(
+            isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids
+        )
+    ):
+        raise AppError(
+            error_code="REQUEST_VALIDATION_FAILED",
+            error_message=f"'user_ids' must be a non-empty list of at most {max_users} integers",
+            status_code=400,
+        )
+
+    results = []
+    for user_id, result in create_discount_codes_batch(campaign_id, user_ids).items():
+        if isinstance(result, Exception):
+            status, error_code = BATCH_CLAIM_ERRORS[type(result)]
+            results.append({"user_id": user_id, "status": status, "error_code": error_code})
+        else:
+            status = "created"
+            results.append(
+                {"user_id": user_id, "status": status, "discount_code": result.to_dict()}
+            )
+        DISCOUNT_CODE_CLAIMS.labels(status).inc()
+    return json_response({"results": results})
 
 
 @bp.get("/<campaign_id>")
@@ -65,10 +161,12 @@ def get_discount_code_route(campaign_id: int):
         - DISCOUNT_CODE_NOT_FOUND (HTTP 404)
     """
     user = current_user()
-    discount_code = get_already_created_discount_code(campaign_id=campaign_id, user_id=user["id"])
+    discount_code = get_already_created_discount_code_dict(
+        campaign_id=campaign_id, user_id=user["id"]
+    )
     if not discount_code:
         raise AppError(error_code="DISCOUNT_CODE_NOT_FOUND", status_code=404)
-    return jsonify(discount_code.to_dict())
+    return json_response(discount_code)
 
 
 @bp.post("/<campaign_id>/manage/generate-codes")
@@ -111,4 +209,250 @@ def generate_discount_codes_route(campaign_id: int):
         )
     except CampaignNotFoundError as exc:
         raise AppError(error_code="CAMPAIGN_NOT_FOUND", status_code=404) from exc
-    return jsonify({"job_id": job_id}), 202
+    return json_response({"job_id": job_id}, 202)
+
+
+@bp.get("/<campaign_id>/manage/jobs/<job_id>")
+def get_generate_discount_codes_job_route(campaign_id: int, job_id: str):
+    """Get status and progress of a discount code generation job.
+
+    Response status code:
+        - 200
+    Response body:
+        - id (str)
+        - campaign_id (int)
+        - status (str) - pending, running, finished or failed.
+        - target_count (int)
+        - generated_count (int) - codes committed so far.
+        - rows_per_second (float) - throughput of the latest run.
+        - error (str)
+        - created_at, started_at, updated_at, finished_at (str) - ISO 8601 timestamps.
+
+    Error codes:
+        - INVALID_ACCESS_TOKEN (HTTP 401)
+        - GENERATION_JOB_NOT_FOUND (HTTP 404)
+    """
+    current_user()
+    try:
+        job = get_generate_discount_codes_job(campaign_id=campaign_id, job_id=job_id)
+    except GenerationJobNotFoundError as exc:
+        raise AppError(error_code="GENERATION_JOB_NOT_FOUND", status_code=404) from exc
+    return json_response(job.to_dict())
+
+
+@bp.post("/<campaign_id>/manage/jobs/<job_id>/resume")
+def resume_generate_discount_codes_job_route(campaign_id: int, job_id: str):
+    """Resume failed or interrupted discount code generation job from its generated count.
+    The job will be processed in the background.
+
+    Response status code:
+        - 202 - job has been resubmitted.
+    Response body:
+        - job_id (str)
+
+    Error codes:
+        - INVALID_ACCESS_TOKEN (HTTP 401)
+        - GENERATION_JOB_NOT_FOUND (HTTP 404)
+        - GENERATION_JOB_ALREADY_FINISHED (HTTP 409)
+        - GENERATION_JOB_ALREADY_RUNNING (HTTP 409)
+    """
+    current_user()
+    try:
+        job = resume_generate_discount_codes_job(
+            campaign_id=campaign_id,
+            job_id=job_id,
+            commit_batch=get_settings().DISCOUNT_CODE_GENERATION_COMMIT_BATCH,
+        )
+    except GenerationJobNotFoundError as exc:
+        raise AppError(error_code="GENERATION_JOB_NOT_FOUND", status_code=404) from exc
+    except GenerationJobAlreadyFinishedError as exc:
+        raise AppError(error_code="GENERATION_JOB_ALREADY_FINISHED", status_code=409) from exc
+    except GenerationJobAlreadyRunningError as exc:
+        raise AppError(error_code="GENERATION_JOB_ALREADY_RUNNING", status_code=409) from exc
+    return json_response({"job_id": job.id}, 202)
+
+
+@bp.post("/<campaign_id>/manage/redemptions")
+def redeem_discount_codes_route(campaign_id: int):
+    """Mark issued discount codes of a campaign as used, as reported by the marketplace.
+    The body is streamed and codes are redeemed in chunks, each committed on its own.
+
+    Request body (Content-Type application/x-ndjson or text/csv):
+        - NDJSON - a code id string or an object with id (str) per line.
+        - CSV - code id in the first column of each row, with an optional header row.
+
+    Response status code:
+        - 200 - NDJSON stream, a line per committed chunk as it is committed:
+            - chunk (int) - 1-based chunk number.
+            - redeemed, already_used, unknown, invalid (int) - counts of the chunk lines.
+        - The last line is totals (dict) with the same counts of all chunks, or an error_code
+          if redeeming failed - chunks before it are committed.
+
+    Error codes:
+        - INVALID_ACCESS_TOKEN (HTTP 401)
+        - REQUEST_VALIDATION_FAILED (HTTP 400) - unsupported Content-Type.
+        - CAMPAIGN_NOT_FOUND (HTTP 404)
+    """
+    current_user()
+    content_type = _bulk_content_type()
+    try:
+        chunks = redeem_discount_codes(
+            campaign_id=campaign_id,
+            code_ids=parse_code_ids(request.stream, content_type),
+            chunk_size=get_settings().DISCOUNT_CODE_REDEMPTION_CHUNK_SIZE,
+        )
+    except CampaignNotFoundError as exc:
+        raise AppError(error_code="CAMPAIGN_NOT_FOUND", status_code=404) from exc
+    return ndjson_response(with_totals(chunks, REDEMPTION_OUTCOMES))
+
+
+@bp.post("/<campaign_id>/manage/import")
+def import_discount_codes_route(campaign_id: int):
+    """Add discount codes supplied by the marketplace to the available codes of a campaign.
+    The body is streamed and codes are imported in chunks, each committed on its own.
+
+    Request body (Content-Type application/x-ndjson or text/csv):
+        - NDJSON - a code id string or an object with id (str) per line.
+        - CSV - code id in the first column of each row, with an optional header row.
+        - Code ids are 1-10 letters, digits, dashes or underscores.
+
+    Response status code:
+        - 200 - NDJSON stream, a line per committed chunk as it is committed:
+            - chunk (int) - 1-based chunk number.
+            - accepted, duplicate, invalid (int) - counts of the chunk lines.
+        - The last line is totals (dict) with the same counts of all chunks, or an error_code
+          if importing failed - chunks before it are committed.
+
+    Error codes:
+        - INVALID_ACCESS_TOKEN (HTTP 401)
+        - REQUEST_VALIDATION_FAILED (HTTP 400) - unsupported Content-Type.
+        - CAMPAIGN_NOT_FOUND (HTTP 404)
+    """
+    current_user()
+    content_type = _bulk_content_type()
+    try:
+        chunks = import_discount_codes(
+            campaign_id=campaign_id,
+            code_ids=parse_code_ids(request.stream, content_type),
+            chunk_size=get_settings().DISCOUNT_CODE_IMPORT_CHUNK_SIZE,
+        )
+    except CampaignNotFoundError as exc:
+        raise AppError(error_code="CAMPAIGN_NOT_FOUND", status_code=404) from exc
+    return ndjson_response(with_totals(chunks, IMPORT_OUTCOMES))
+
+
+def _bulk_content_type() -> str:
+    content_type = request.mimetype
+    if content_type not in NDJSON_CONTENT_TYPES + CSV_CONTENT_TYPES:
+        raise AppError(
+            error_code="REQUEST_VALIDATION_FAILED",
+            error_message="Content-Type must be application/x-ndjson or text/csv",
+            status_code=400,
+        )
+    return content_type
+
+
+@bp.get("/<campaign_id>/manage/export")
+def export_discount_codes_route(campaign_id: int):
+    """Export issued discount codes of a campaign with their users, ordered by user_id.
+    Rows are streamed from a server-side cursor in chunks.
+
+    Query parameters:
+        - format (str) - ndjson (default) or csv.
+        - is_used (bool) - true or false, only codes with the given value.
+        - is_fetched_event_sent (bool) - true or false, only codes with the given value.
+        - after (int) - resume after the user_id of the last received code.
+
+    Response status code:
+        - 200 - NDJSON lines or CSV rows with a header, columns:
+            id (str), campaign_id (int), user_id (int), is_used (bool),
+            is_fetched_event_sent (bool). An interrupted export ends with an incomplete body.
+
+    Error codes:
+        - INVALID_ACCESS_TOKEN (HTTP 401)
+        - REQUEST_VALIDATION_FAILED (HTTP 400)
+        - CAMPAIGN_NOT_FOUND (HTTP 404)
+    """
+    current_user()
+    try:
+        encode, mimetype = EXPORT_FORMATS[request.args.get("format", "ndjson")]
+        filters = {
+            name: _parse_bool(request.args[name])
+            for name in ("is_used", "is_fetched_event_sent")
+            if name in request.args
+        }
+        after_user_id = int(request.args["after"]) if "after" in request.args else None
+    except (KeyError, ValueError) as exc:
+        raise AppError(
+            error_code="REQUEST_VALIDATION_FAILED",
+            error_message=(
+                "'format' must be ndjson or csv, 'is_used' and 'is_fetched_event_sent' "
+                "true or false, 'after' an integer"
+            ),
+            status_code=400,
+        ) from exc
+
+    try:
+        chunks = export_discount_codes(
+            campaign_id=campaign_id,
+            chunk_size=get_settings().DISCOUNT_CODE_EXPORT_CHUNK_SIZE,
+            after_user_id=after_user_id,
+            **filters,
+        )
+    except CampaignNotFoundError as exc:
+        raise AppError(error_code="CAMPAIGN_NOT_FOUND", status_code=404) from exc
+    return streamed_response(encode(chunks), mimetype)
+
+
+def _parse_bool(value: str) -> bool:
+    if value not in ("true", "false"):
+        raise ValueError
+    return value == "true"
+
+
+@bp.get("/<campaign_id>/manage/stats")
+def campaign_stats_route(campaign_id: int):
+    """Get inventory counts of a campaign, read from its counters instead of counting codes.
+
+    Response status code:
+        - 200
+    Response body:
+        - campaign_id (int)
+        - available (int) - codes not issued yet
+        - issued (int)
+        - redeemed (int)
+
+    Error codes:
+        - INVALID_ACCESS_TOKEN (HTTP 401)
+        - CAMPAIGN_NOT_FOUND (HTTP 404)
+    """
+    current_user()
+    try:
+        counts = get_campaign_counts(campaign_id)
+    except CampaignNotFoundError as exc:
+        raise AppError(error_code="CAMPAIGN_NOT_FOUND", status_code=404) from exc
+    return json_response({"campaign_id": int(campaign_id), **counts})
+
+
+@bp.get("/manage/cache-stats")
+def cache_stats_route():
+    """Get hit and miss counters of the in-process caches of the worker serving the request.
+
+    Response status code:
+        - 200
+    Response body:
+        - campaign_availability (dict) - hits (int), misses (int), exhausted_campaigns (int)
+        - fetched_discount_codes (dict) - hits (int), misses (int), size (int), negative_size (int)
+        - claim_batching (dict) - batches (int), claims (int) - claims coalesced into batches
+
+    Error codes:
+        - INVALID_ACCESS_TOKEN (HTTP 401)
+    """
+    current_user()
+    return json_response(
+        {
+            "campaign_availability": campaign_availability_cache.stats(),
+            "fetched_discount_codes": fetched_discount_code_cache.stats(),
+            "claim_batching": discount_code_claim_coalescer.stats(),
+        }
+    )
@@ -4,13 +4,13 @@
 """
 from typing import Optional, Union
 
-from flask import jsonify
 from flask.wrappers import Response
 from structlog import get_logger
 from werkzeug.exceptions import HTTPException, InternalServerError
 from werkzeug.http import HTTP_STATUS_CODES
 
 from .. import db
+from ..util.serialization import encode_error, json_response
 from . import bp
 from .exceptions import AppError
 
@@ -20,12 +20,7 @@ logger = get_logger(__name__)
 def api_error_response(
     error_code: Union[int, str], error_message: Optional[str] = None, status_code: int = 500
 ) -> Response:
-    payload = {"error_code": error_code}
-    if error_message is not None:
-        payload["error_message"] = error_message
-    response = jsonify(payload)
-    response.status_code = status_code
-    return response
+    return json_response(encode_error(error_code, error_message), status_code)
 
 
 @bp.app_errorhandler(HTTPException)
@@ -0,0 +1,233 @@
+"""Prometheus metrics of the app, served in text format at `GET /metrics`.
+
+With `PROMETHEUS_MULTIPROC_DIR` set before the app is imported, every process writes its
+samples to mmap files in the directory and `/metrics` aggregates the files of all gunicorn
+workers, generation shard processes and uvicorn workers - see deploy/gunicorn_config.py.
+Recording a sample is an in-memory or mmap update, nothing is collected until a scrape.
+"""
+import os
+import time
+from datetime import datetime
+from typing import Dict, Iterable, Tuple
+
+from flask import Flask, Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool
+
+from .config import get_settings
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENT_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Latency of HTTP requests",
+    ["route", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "Served HTTP requests", ["route", "method", "status"]
+)
+HTTP_REQUEST_DB_STATEMENTS = Histogram(
+    "http_request_db_statements",
+    "Database statements executed per HTTP request",
+    ["route", "method"],
+    buckets=STATEMENT_COUNT_BUCKETS,
+)
+HTTP_REQUEST_DB_DURATION = Histogram(
+    "http_request_db_duration_seconds",
+    "Time spent executing database statements per HTTP request",
+    ["route", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time waited for a connection from the pool",
+    buckets=LATENCY_BUCKETS,
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out_connections",
+    "Connections checked out from the pool",
+    multiprocess_mode="livesum",
+)
+DB_POOL_MAX_CONNECTIONS = Gauge(
+    "db_pool_max_connections",
+    "Pool size with overflow - the checked out connections limit",
+    multiprocess_mode="livesum",
+)
+DISCOUNT_CODE_CLAIMS = Counter(
+    "discount_code_claims_total",
+    "Discount code claims by outcome - created, already_fetched or not_available",
+    ["outcome"],
+)
+DISCOUNT_CODE_REDEMPTIONS = Counter(
+    "discount_code_redemptions_total",
+    "Reported discount code redemptions by outcome - redeemed, already_used, unknown or invalid",
+    ["outcome"],
+)
+DISCOUNT_CODE_IMPORTED_CODES = Counter(
+    "discount_code_imported_codes_total",
+    "Imported discount codes by outcome - accepted, duplicate or invalid",
+    ["outcome"],
+)
+DISCOUNT_CODE_GENERATED_CODES = Counter(
+    "discount_code_generated_codes_total", "Committed discount codes of generation jobs"
+)
+DISCOUNT_CODE_GENERATION_JOBS = Counter(
+    "discount_code_generation_jobs_total", "Finished generation job runs by status", ["status"]
+)
+DISCOUNT_CODE_FETCHED_EVENT_LAG = Histogram(
+    "discount_code_fetched_event_lag_seconds",
+    "Time from the claim until the fetched event is published",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+
+LOG_EVENTS_DROPPED = Counter(
+    "log_events_dropped_total", "Log events dropped because the async log queue was full"
+)
+LOG_EVENTS_SAMPLED_OUT = Counter("log_events_sampled_out_total", "Log events left out by sampling")
+
+_request_metrics_by_labels: Dict[Tuple[str, str, int], tuple] = {}
+
+
+def observe_fetched_event_lag(created_at: Iterable[datetime]) -> None:
+    """Outbox `created_at` is the database clock - expected to be UTC."""
+    now = datetime.utcnow()
+    for event_created_at in created_at:
+        DISCOUNT_CODE_FETCHED_EVENT_LAG.observe(max((now - event_created_at).total_seconds(), 0))
+
+
+class MeasuredQueuePool(QueuePool):
+    """QueuePool that records how long a checkout waited for a free connection."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._max_connections = self.size() + max(self._max_overflow, 0)
+        DB_POOL_MAX_CONNECTIONS.inc(self._max_connections)
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started_at)
+
+    def dispose(self) -> None:
+        super().dispose()
+        # Disposed pool is replaced with a recreated one, which counts its own connections
+        DB_POOL_MAX_CONNECTIONS.dec(self._max_connections)
+        self._max_connections = 0
+
+
+@event.listens_for(MeasuredQueuePool, "checkout")
+def _connection_checked_out(dbapi_connection, connection_record, connection_proxy) -> None:
+    DB_POOL_CHECKED_OUT.inc()
+
+
+@event.listens_for(MeasuredQueuePool, "checkin")
+def _connection_checked_in(dbapi_connection, connection_record) -> None:
+    DB_POOL_CHECKED_OUT.dec()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    context.metrics_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    request_timer = g.get("request_timer") if has_request_context() else None
+    if request_timer:
+        request_timer.db_statements += 1
+        request_timer.db_seconds += time.perf_counter() - context.metrics_started_at
+
+
+class RequestTimer:
+    __slots__ = ("started_at", "db_statements", "db_seconds")
+
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.db_statements = 0
+        self.db_seconds = 0.0
+
+
+def _start_request_metrics() -> None:
+    g.request_timer = RequestTimer()
+
+
+def _request_metrics(route: str, method: str, status_code: int) -> tuple:
+    """Labelled metrics of the request, looked up once per route, method and status code."""
+    key = (route, method, status_code)
+    request_metrics = _request_metrics_by_labels.get(key)
+    if request_metrics is None:
+        request_metrics = _request_metrics_by_labels[key] = (
+            HTTP_REQUEST_DURATION.labels(route, method),
+            HTTP_REQUESTS.labels(route, method, status_code),
+            HTTP_REQUEST_DB_STATEMENTS.labels(route, method),
+            HTTP_REQUEST_DB_DURATION.labels(route, method),
+        )
+    return request_metrics
+
+
+def _record_request_metrics(response: Response) -> Response:
+    request_timer = g.pop("request_timer", None)
+    if request_timer is None:
+        return response
+    # Proxies of the request context are resolved once, they are slow on the hot path
+    current_request = request._get_current_object()  # pylint: disable=protected-access
+    url_rule = current_request.url_rule
+    duration, requests_count, db_statements, db_duration = _request_metrics(
+        url_rule.rule if url_rule else "<unmatched>",
+        current_request.method,
+        response.status_code,
+    )
+    duration.observe(time.perf_counter() - request_timer.started_at)
+    requests_count.inc()
+    db_statements.observe(request_timer.db_statements)
+    db_duration.observe(request_timer.db_seconds)
+    return response
+
+
+def metrics_route():
+    """Get metrics of all processes in Prometheus text format."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.enabled = False
+
+    def init_app(self, app: Flask) -> None:
+        app_config = get_settings()
+        self.enabled = app_config.METRICS_ENABLED
+        if not self.enabled:
+            return
+
+        app.before_request(_start_request_metrics)
+        app.after_request(_record_request_metrics)
+        app.add_url_rule("/metrics", view_func=metrics_route, methods=["GET"])
+        # Listeners are global - only statements executed in a request are recorded
+        if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        # SQLite uses a pool without waiting for connections
+        if make_url(app_config.SQLALCHEMY_DATABASE_URI).get_backend_name() != "sqlite":
+            app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+            app.config["SQLALCHEMY_ENGINE_OPTIONS"].setdefault("poolclass", MeasuredQueuePool)
+
+
+metrics = Metrics()
@@ -1,17 +1,24 @@
-import uuid
+import os
 
 import structlog
 from flask import request
 
 
 def enrich_structlog_with_request_context():
+    # Request context proxies are resolved once - every access is a context lookup
+    current_request = request._get_current_object()  # pylint: disable=protected-access
+    environ = current_request.environ
+    remote_addr = environ.get("REMOTE_ADDR")
+    forwarded_for = environ.get("HTTP_X_FORWARDED_FOR")
     structlog.threadlocal.clear_threadlocal()
     structlog.threadlocal.bind_threadlocal(
-        blueprint=request.blueprint,
-        view=request.path,
-        method=request.method,
-        scheme=request.scheme,
-        request_id=str(uuid.uuid4()),
-        peer=request.access_route[0],
-        remote_addr=request.remote_addr,
+        blueprint=current_request.blueprint,
+        view=current_request.path,
+        method=current_request.method,
+        scheme=current_request.scheme,
+        # Request id of the load balancer, or 64 random bits - cheaper than uuid4
+        request_id=environ.get("HTTP_X_REQUEST_ID") or os.urandom(8).hex(),
+        # First hop without parsing the whole forwarded chain
+        peer=forwarded_for.partition(",")[0].strip() if forwarded_for else remote_addr,
+        remote_addr=remote_addr,
     )
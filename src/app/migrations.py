@@ -0,0 +1,247 @@
+"""Versioned schema migrations.
+
+New databases get the latest schema from the models with `db.create_all()` and are stamped
+with the latest version. Existing databases are upgraded by applying, in order, migrations
+newer than the latest version recorded in `schema_migrations`. Run with
+`python scripts/migrate.py`.
+"""
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import func, insert, inspect, select, text
+from sqlalchemy.engine import Connection
+from structlog import get_logger
+
+from . import db
+from .models import AvailableDiscountCode, SchemaMigration
+
+logger = get_logger(__name__)
+
+schema_migrations = SchemaMigration.__table__
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    upgrade: Callable[[Connection], None]
+
+
+# Migrations spell out their DDL - they must keep producing the schema of their version
+# after the models change.
+SQLITE_TABLES_0001 = {
+    "available_discount_codes": [
+        """
+        CREATE TABLE available_discount_codes (
+            id VARCHAR(10) NOT NULL,
+            campaign_id INTEGER NOT NULL,
+            leased_by VARCHAR(64),
+            lease_expires_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(campaign_id) REFERENCES campaigns (id)
+        )
+        """,
+        """
+        CREATE INDEX ix_available_discount_codes_campaign_id_not_leased
+            ON available_discount_codes (campaign_id) WHERE leased_by IS NULL
+        """,
+        """
+        CREATE INDEX ix_available_discount_codes_leased_by
+            ON available_discount_codes (leased_by) WHERE leased_by IS NOT NULL
+        """,
+    ],
+    "fetched_discount_codes": [
+        """
+        CREATE TABLE fetched_discount_codes (
+            id VARCHAR(10) NOT NULL,
+            campaign_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            is_used BOOLEAN NOT NULL,
+            is_fetched_event_sent BOOLEAN NOT NULL,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_fetched_discount_codes_campaign_id_user_id UNIQUE (campaign_id, user_id),
+            FOREIGN KEY(campaign_id) REFERENCES campaigns (id)
+        )
+        """,
+    ],
+}
+
+
+def _rebuild_table(connection: Connection, table_name: str, statements: List[str]) -> None:
+    """Recreates the table with the statements and copies the rows over,
+    for databases that can't alter primary keys and constraints, i.e. SQLite."""
+    legacy_name = f"legacy_{table_name}"
+    inspector = inspect(connection)
+    for index in inspector.get_indexes(table_name):
+        connection.execute(text(f"DROP INDEX {index['name']}"))
+    connection.execute(text(f"ALTER TABLE {table_name} RENAME TO {legacy_name}"))
+    legacy_columns = [column["name"] for column in inspect(connection).get_columns(legacy_name)]
+    for statement in statements:
+        connection.execute(text(statement))
+    table_columns = {column["name"] for column in inspect(connection).get_columns(table_name)}
+    columns = ", ".join(column for column in legacy_columns if column in table_columns)
+    connection.execute(
+        text(f"INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {legacy_name}")
+    )
+    connection.execute(text(f"DROP TABLE {legacy_name}"))
+
+
+def _upgrade_0001_claim_optimized_indexes(connection: Connection) -> None:
+    """Primary keys on the code id alone instead of composite keys starting with it,
+    drops redundant unique indexes on the code id and adds claim and lookup indexes."""
+    if connection.dialect.name != "postgresql":
+        for table_name, statements in SQLITE_TABLES_0001.items():
+            _rebuild_table(connection, table_name, statements)
+        return
+
+    connection.execute(
+        text(
+            """
+            ALTER TABLE available_discount_codes
+                ADD COLUMN IF NOT EXISTS leased_by VARCHAR(64),
+                ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITHOUT TIME ZONE,
+                DROP CONSTRAINT IF EXISTS available_discount_codes_id_key,
+                DROP CONSTRAINT available_discount_codes_pkey,
+                ADD CONSTRAINT available_discount_codes_pkey PRIMARY KEY (id)
+            """
+        )
+    )
+    connection.execute(
+        text(
+            """
+            ALTER TABLE fetched_discount_codes
+                DROP CONSTRAINT IF EXISTS fetched_discount_codes_id_key,
+                DROP CONSTRAINT fetched_discount_codes_pkey,
+                ADD CONSTRAINT fetched_discount_codes_pkey PRIMARY KEY (id)
+            """
+        )
+    )
+    unique_constraints = {
+        constraint["name"]
+        for constraint in inspect(connection).get_unique_constraints("fetched_discount_codes")
+    }
+    if "uq_fetched_discount_codes_campaign_id_user_id" not in unique_constraints:
+        connection.execute(
+            text(
+                "ALTER TABLE fetched_discount_codes "
+                "ADD CONSTRAINT uq_fetched_discount_codes_campaign_id_user_id "
+                "UNIQUE (campaign_id, user_id)"
+            )
+        )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_available_discount_codes_campaign_id_not_leased "
+            "ON available_discount_codes (campaign_id) WHERE leased_by IS NULL"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_available_discount_codes_leased_by "
+            "ON available_discount_codes (leased_by) WHERE leased_by IS NOT NULL"
+        )
+    )
+
+
+def _upgrade_0002_campaign_discount_code_counter(connection: Connection) -> None:
+    """Counter of the permutation code generator, see util/code_generators.py."""
+    columns = {column["name"] for column in inspect(connection).get_columns("campaigns")}
+    if "discount_code_counter" not in columns:
+        connection.execute(
+            text("ALTER TABLE campaigns ADD COLUMN discount_code_counter BIGINT NOT NULL DEFAULT 0")
+        )
+
+
+def _upgrade_0003_campaign_counters(connection: Connection) -> None:
+    """Inventory counters of campaigns, filled from the code tables, see discounts/counters.py."""
+    connection.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS campaign_counters (
+                campaign_id INTEGER NOT NULL,
+                stripe SMALLINT NOT NULL,
+                available_count BIGINT DEFAULT '0' NOT NULL,
+                issued_count BIGINT DEFAULT '0' NOT NULL,
+                redeemed_count BIGINT DEFAULT '0' NOT NULL,
+                PRIMARY KEY (campaign_id, stripe),
+                FOREIGN KEY(campaign_id) REFERENCES campaigns (id)
+            )
+            """
+        )
+    )
+    connection.execute(text("DELETE FROM campaign_counters"))
+    # Codes handed out from a worker lease stay in the available codes table
+    connection.execute(
+        text(
+            """
+            INSERT INTO campaign_counters
+                (campaign_id, stripe, available_count, issued_count, redeemed_count)
+            SELECT
+                campaigns.id,
+                0,
+                (
+                    SELECT count(*) FROM available_discount_codes
+                    WHERE available_discount_codes.campaign_id = campaigns.id
+                        AND NOT EXISTS (
+                            SELECT 1 FROM fetched_discount_codes
+                            WHERE fetched_discount_codes.id = available_discount_codes.id
+                        )
+                ),
+                (
+                    SELECT count(*) FROM fetched_discount_codes
+                    WHERE fetched_discount_codes.campaign_id = campaigns.id
+                ),
+                (
+                    SELECT count(*) FROM fetched_discount_codes
+                    WHERE fetched_discount_codes.campaign_id = campaigns.id
+                        AND fetched_discount_codes.is_used
+                )
+            FROM campaigns
+            """
+        )
+    )
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "claim_optimized_indexes", _upgrade_0001_claim_optimized_indexes),
+    Migration(2, "campaign_discount_code_counter", _upgrade_0002_campaign_discount_code_counter),
+    Migration(3, "campaign_counters", _upgrade_0003_campaign_counters),
+]
+
+
+def get_current_version(connection: Connection) -> int:
+    return connection.execute(
+        select(func.coalesce(func.max(schema_migrations.c.version), 0))
+    ).scalar()
+
+
+def stamp(connection: Connection) -> None:
+    """Records all migrations as applied, for a database created from the latest models."""
+    current_version = get_current_version(connection)
+    for migration in MIGRATIONS:
+        if migration.version > current_version:
+            connection.execute(
+                insert(schema_migrations).values(version=migration.version, name=migration.name)
+            )
+
+
+def migrate(connection: Connection) -> List[int]:
+    """Brings the database schema up to date, returns versions of the applied migrations."""
+    if not inspect(connection).has_table(AvailableDiscountCode.__tablename__):
+        db.metadata.create_all(connection)
+        stamp(connection)
+        logger.info("schema_created")
+        return []
+
+    schema_migrations.create(connection, checkfirst=True)
+    current_version = get_current_version(connection)
+    applied_versions = []
+    for migration in MIGRATIONS:
+        if migration.version <= current_version:
+            continue
+        logger.info("schema_migration_started", version=migration.version, name=migration.name)
+        migration.upgrade(connection)
+        connection.execute(
+            insert(schema_migrations).values(version=migration.version, name=migration.name)
+        )
+        applied_versions.append(migration.version)
+    # Tables added to the models without a migration of existing tables
+    db.metadata.create_all(connection)
+    return applied_versions
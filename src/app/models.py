@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-import uuid
+import datetime
 
 from . import db
+from .util.code_generators import get_code_generator
 
 
 class Marketplace(db.Model):
@@ -34,6 +35,8 @@ class Campaign(db.Model):
     )
     name = db.Column(db.String(256), nullable=False)
     active_until = db.Column(db.DateTime, nullable=True)
+    # Codes issued by the permutation code generator, see util/code_generators.py
+    discount_code_counter = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
     marketplace_id = db.Column(db.Integer, db.ForeignKey("marketplace.id"), nullable=False)
     marketplace = db.relationship("Marketplace", backref="campaigns", lazy=True)
 
@@ -43,29 +46,45 @@ class Campaign(db.Model):
 
 class AvailableDiscountCode(db.Model):
     __tablename__ = "available_discount_codes"
+    # Index changes need a migration in migrations.py
+    __table_args__ = (
+        # Claim - next not leased code of the campaign, see discounts/code_fetch.py
+        db.Index(
+            "ix_available_discount_codes_campaign_id_not_leased",
+            "campaign_id",
+            postgresql_where=db.text("leased_by IS NULL"),
+            sqlite_where=db.text("leased_by IS NULL"),
+        ),
+        # Lease refill and release - codes leased by a worker, see discounts/code_lease.py
+        db.Index(
+            "ix_available_discount_codes_leased_by",
+            "leased_by",
+            postgresql_where=db.text("leased_by IS NOT NULL"),
+            sqlite_where=db.text("leased_by IS NOT NULL"),
+        ),
+    )
 
     id = db.Column(
         db.String(10),
         primary_key=True,
         # pylint: disable=unnecessary-lambda
-        default=lambda: AvailableDiscountCode.generate_new_code_id(),
-        unique=True,
+        default=lambda context: AvailableDiscountCode.generate_new_code_id(context),
         nullable=False,
     )
-    campaign_id = db.Column(
-        db.Integer, db.ForeignKey("campaigns.id"), primary_key=True, nullable=False
-    )
+    campaign_id = db.Column(db.Integer, db.ForeignKey("campaigns.id"), nullable=False)
+    # Set while the code is reserved by a single app worker, see discounts/code_lease.py
+    leased_by = db.Column(db.String(64), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
     campaign = db.relationship("Campaign", backref="available_discount_codes", lazy=True)
 
     def __repr__(self):
         return f"<AvailableDiscountCode> {self.id} - {self.campaign_id}"
 
     @staticmethod
-    def generate_new_code_id() -> str:
-        """Returns new 10 char discount code good enough for demo purposes."""
-        id_1 = str(uuid.uuid4()).upper()
-        id_2 = str(uuid.uuid4()).upper()
-        return id_1[:8] + id_2[:2]
+    def generate_new_code_id(context) -> str:
+        """Returns new discount code from the configured code generator, as the column default."""
+        campaign_id = context.get_current_parameters()["campaign_id"]
+        return get_code_generator().generate(context.connection, campaign_id, 1)[0]
 
     # In the real-world app, schema returned to the client would be separated from DB model
     def to_dict(self) -> dict:
@@ -77,18 +96,18 @@ class AvailableDiscountCode(db.Model):
 
 class FetchedDiscountCode(db.Model):
     __tablename__ = "fetched_discount_codes"
-
-    id = db.Column(
-        db.String(10),
-        primary_key=True,
-        unique=True,
-        nullable=False,
-    )
-    campaign_id = db.Column(
-        db.Integer, db.ForeignKey("campaigns.id"), primary_key=True, nullable=False
+    # One discount code per user and campaign - enforced by the claim INSERT.
+    # The constraint index also serves the lookup of the code by campaign and user
+    __table_args__ = (
+        db.UniqueConstraint(
+            "campaign_id", "user_id", name="uq_fetched_discount_codes_campaign_id_user_id"
+        ),
     )
+
+    id = db.Column(db.String(10), primary_key=True, nullable=False)
+    campaign_id = db.Column(db.Integer, db.ForeignKey("campaigns.id"), nullable=False)
     # Getting user_id from authentication microservice
-    user_id = db.Column(db.Integer, primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
     is_used = db.Column(db.Boolean, nullable=False, default=False)
     is_fetched_event_sent = db.Column(db.Boolean, nullable=False, default=False)
     campaign = db.relationship("Campaign", backref="fetched_discount_codes", lazy=True)
@@ -104,3 +123,91 @@ class FetchedDiscountCode(db.Model):
             "user_id": self.user_id,
             "is_used": self.is_used,
         }
+
+
+class DiscountCodeGenerationJob(db.Model):
+    __tablename__ = "discount_code_generation_jobs"
+
+    id = db.Column(db.String(36), primary_key=True, nullable=False)
+    campaign_id = db.Column(db.Integer, db.ForeignKey("campaigns.id"), nullable=False)
+    # pending, running, finished or failed
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    target_count = db.Column(db.Integer, nullable=False)
+    # Updated in the same transaction as every committed batch of codes
+    generated_count = db.Column(db.Integer, nullable=False, default=0)
+    rows_per_second = db.Column(db.Float, nullable=True)
+    error = db.Column(db.String(512), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self) -> str:
+        return f"<DiscountCodeGenerationJob> {self.id} - {self.status}"
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "campaign_id": self.campaign_id,
+            "status": self.status,
+            "target_count": self.target_count,
+            "generated_count": self.generated_count,
+            "rows_per_second": self.rows_per_second,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "updated_at": self.updated_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class DiscountCodeFetchedOutbox(db.Model):
+    """Discount code fetched events written in the same transaction as the claim,
+    deleted by the relay once published - see discounts/events.py."""
+
+    __tablename__ = "discount_code_fetched_outbox"
+
+    id = db.Column(
+        db.Integer,
+        db.Sequence("discount_code_fetched_outbox_id_seq", start=1, increment=1),
+        primary_key=True,
+        nullable=False,
+    )
+    discount_code_id = db.Column(db.String(10), nullable=False)
+    campaign_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    def __repr__(self) -> str:
+        return f"<DiscountCodeFetchedOutbox> {self.id} - {self.discount_code_id}"
+
+
+class CampaignCounter(db.Model):
+    """Stripe of the inventory counters of a campaign, a campaign's counts are the sums of its
+    stripes - see discounts/counters.py."""
+
+    __tablename__ = "campaign_counters"
+
+    campaign_id = db.Column(
+        db.Integer, db.ForeignKey("campaigns.id"), primary_key=True, autoincrement=False
+    )
+    stripe = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    available_count = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+    issued_count = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+    redeemed_count = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+
+    def __repr__(self) -> str:
+        return f"<CampaignCounter> {self.campaign_id} - {self.stripe}"
+
+
+class SchemaMigration(db.Model):
+    """Applied schema migrations, see migrations.py."""
+
+    __tablename__ = "schema_migrations"
+
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False, nullable=False)
+    name = db.Column(db.String(128), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    def __repr__(self) -> str:
+        return f"<SchemaMigration> {self.version} - {self.name}"
@@ -0,0 +1,170 @@
+"""Generators of new discount code ids.
+
+`RandomCodeGenerator` encodes one `os.urandom` call per chunk of codes and drops duplicates
+within the chunk. Collisions with existing codes are caught by the primary key and the chunk
+is generated again, see discounts/code_generation.py. The code space of the default 10 chars
+of base32 is 2^50.
+
+`PermutationCodeGenerator` encrypts a per-campaign counter with a keyed Feistel permutation,
+so codes never collide and need no uniqueness retries, yet can't be guessed without the key.
+"""
+import hashlib
+import os
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Dict, List
+
+from sqlalchemy import column, select, table, update
+from sqlalchemy.engine import Connection
+
+from ..config import get_settings
+
+# Crockford's base32 - no I, L, O and U, which are easily confused when typed in
+CROCKFORD_BASE32_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+# Not the model, models.py uses the generators for the default code id
+campaigns = table("campaigns", column("id"), column("discount_code_counter"))
+
+
+class CodeGenerator(ABC):
+    def __init__(self, alphabet: str = CROCKFORD_BASE32_ALPHABET, length: int = 10) -> None:
+        if len(set(alphabet)) != len(alphabet) or not 2 <= len(alphabet) <= 256:
+            raise ValueError("Alphabet must have 2 to 256 distinct characters")
+        if not alphabet.isascii():
+            raise ValueError("Alphabet must have only ASCII characters")
+        self.alphabet = alphabet
+        self.length = length
+
+    @abstractmethod
+    def generate(self, connection: Connection, campaign_id: int, count: int) -> List[str]:
+        """Returns `count` distinct new codes for the campaign.
+
+        Generators that keep state in the database use the given connection,
+        so the state is committed together with the inserted codes.
+        """
+
+
+class RandomCodeGenerator(CodeGenerator):
+    def __init__(self, alphabet: str = CROCKFORD_BASE32_ALPHABET, length: int = 10) -> None:
+        super().__init__(alphabet, length)
+        # Bytes above the largest multiple of the alphabet size are dropped,
+        # so every character is equally likely
+        self._accepted_bytes = 256 - 256 % len(alphabet)
+        self._translation = bytes(ord(alphabet[byte % len(alphabet)]) for byte in range(256))
+        self._rejected = bytes(range(self._accepted_bytes, 256))
+
+    def generate(self, connection: Connection, campaign_id: int, count: int) -> List[str]:
+        codes: Dict[str, None] = {}
+        while len(codes) < count:
+            chars_count = (count - len(codes)) * self.length
+            random_bytes = os.urandom(chars_count * 256 // self._accepted_bytes + self.length)
+            chars = random_bytes.translate(self._translation, self._rejected).decode("ascii")
+            starts = range(0, len(chars) - self.length + 1, self.length)
+            ends = range(self.length, len(chars) + 1, self.length)
+            codes.update(dict.fromkeys(chars[start:end] for start, end in zip(starts, ends)))
+        return list(codes)[:count]
+
+
+class PermutationCodeGenerator(CodeGenerator):
+    """Codes are the encrypted `campaign_id << counter_bits | counter`, so they are unique
+    across campaigns as long as campaign ids and counters fit into the code space."""
+
+    ROUNDS = 4
+
+    def __init__(
+        self,
+        key: str,
+        alphabet: str = CROCKFORD_BASE32_ALPHABET,
+        length: int = 10,
+        counter_bits: int = 30,
+    ) -> None:
+        super().__init__(alphabet, length)
+        if not key:
+            raise ValueError("Permutation code generator requires a key")
+        self.counter_bits = counter_bits
+        self.domain_size = len(alphabet) ** length
+        if self.domain_size <= 1 << counter_bits:
+            raise ValueError("Code space is too small for the counter")
+        # Feistel network permutes an even number of bits, values outside of the code space
+        # are encrypted again until they fall into it - cycle walking
+        half_bits = ((self.domain_size - 1).bit_length() + 1) // 2
+        self._half_bits = half_bits
+        self._half_mask = (1 << half_bits) - 1
+        self._round_hashes = [
+            hashlib.blake2b(
+                key=hashlib.blake2b(key.encode(), person=f"round{index}".encode()).digest(),
+                digest_size=8,
+            )
+            for index in range(self.ROUNDS)
+        ]
+
+    def generate(self, connection: Connection, campaign_id: int, count: int) -> List[str]:
+        return self.codes_for(
+            campaign_id, self.reserve_counter(connection, campaign_id, count), count
+        )
+
+    @staticmethod
+    def reserve_counter(connection: Connection, campaign_id: int, count: int) -> int:
+        """Returns the first counter value of the reserved range. The campaign row stays locked
+        until the transaction ends, a rolled back range is reused by the next reservation."""
+        connection.execute(
+            update(campaigns)
+            .where(campaigns.c.id == campaign_id)
+            .values(discount_code_counter=campaigns.c.discount_code_counter + count)
+        )
+        counter = connection.execute(
+            select(campaigns.c.discount_code_counter).where(campaigns.c.id == campaign_id)
+        ).scalar_one()
+        return counter - count
+
+    def codes_for(self, campaign_id: int, start: int, count: int) -> List[str]:
+        if start + count > 1 << self.counter_bits:
+            raise ValueError(f"Campaign {campaign_id} has run out of permutation code counter")
+        prefix = int(campaign_id) << self.counter_bits
+        if prefix + (1 << self.counter_bits) > self.domain_size:
+            raise ValueError(f"Campaign id {campaign_id} doesn't fit into the code space")
+        return [
+            self._encode(self.permute(prefix | counter)) for counter in range(start, start + count)
+        ]
+
+    def permute(self, value: int) -> int:
+        while True:
+            left, right = value >> self._half_bits, value & self._half_mask
+            for round_hash in self._round_hashes:
+                digest = round_hash.copy()
+                digest.update(right.to_bytes(8, "big"))
+                left, right = right, left ^ (
+                    int.from_bytes(digest.digest(), "big") & self._half_mask
+                )
+            value = (left << self._half_bits) | right
+            if value < self.domain_size:
+                return value
+
+    def _encode(self, value: int) -> str:
+        alphabet_size = len(self.alphabet)
+        chars = []
+        for _ in range(self.length):
+            value, index = divmod(value, alphabet_size)
+            chars.append(self.alphabet[index])
+        return "".join(reversed(chars))
+
+
+@lru_cache
+def create_code_generator(kind: str, alphabet: str, length: int, key: str) -> CodeGenerator:
+    if kind == "random":
+        return RandomCodeGenerator(alphabet, length)
+    if kind == "permutation":
+        return PermutationCodeGenerator(key, alphabet, length)
+    raise ValueError(f"Unknown discount code generator: {kind}")
+
+
+def get_code_generator() -> CodeGenerator:
+    """Discount code generator configured in the settings."""
+    app_config = get_settings()
+    return create_code_generator(
+        app_config.DISCOUNT_CODE_GENERATOR,
+        app_config.DISCOUNT_CODE_ALPHABET,
+        app_config.DISCOUNT_CODE_LENGTH,
+        # Required by the permutation generator, see Settings.check_permutation_key
+        app_config.DISCOUNT_CODE_PERMUTATION_KEY or "",
+    )
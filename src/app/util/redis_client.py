@@ -0,0 +1,173 @@
+"""Redis clients, with an in-process stand-in for tests and local runs without a server.
+
+`memory://` URLs give an `InProcessRedis` - only the commands the code stores and idempotency
+call, with the same return values as redis-py (bytes, counts, None), checked against fakeredis
+by tests/test_redis_client.py. One instance per URL is shared by the process, like a server
+would be, but not by other processes - so not by gunicorn workers.
+`memory://<name>?max_keys=<n>` bounds the string keys, the oldest one is evicted when a new
+one doesn't fit - like a server with `maxmemory`.
+"""
+import threading
+import time
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+Value = Union[bytes, str, int, float]
+
+
+def _encode(value: Value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _range(length: int, start: int, end: int) -> Tuple[int, int]:
+    """Start and stop of a Redis inclusive range, where negative indexes count from the end."""
+    start = min(max(start + length if start < 0 else start, 0), length)
+    end = end + length if end < 0 else end
+    return start, max(min(end + 1, length), start)
+
+
+class InProcessRedis:
+    def __init__(self, max_keys: Optional[int] = None) -> None:
+        self.max_keys = max_keys
+        self._strings: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self._lists: Dict[str, Deque[bytes]] = {}
+        self._lock = threading.RLock()
+
+    def flushall(self) -> None:
+        with self._lock:
+            self._strings.clear()
+            self._lists.clear()
+
+    def pipeline(self, transaction: bool = True) -> "InProcessPipeline":
+        return InProcessPipeline(self)
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._strings.get(name)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._strings[name]
+                return None
+            return value
+
+    def set(
+        self,
+        name: str,
+        value: Value,
+        ex: Optional[float] = None,
+        px: Optional[int] = None,
+        nx: bool = False,
+    ) -> Optional[bool]:
+        with self._lock:
+            if nx and self.get(name) is not None:
+                return None
+            ttl = ex if ex is not None else (px / 1000 if px is not None else None)
+            expires_at = time.monotonic() + ttl if ttl is not None else None
+            if self.max_keys is not None and name not in self._strings:
+                while len(self._strings) >= self.max_keys:
+                    # Keys keep the order they were created in
+                    del self._strings[next(iter(self._strings))]
+            self._strings[name] = (_encode(value), expires_at)
+            return True
+
+    def delete(self, *names: str) -> int:
+        with self._lock:
+            deleted = 0
+            for name in names:
+                deleted += self.get(name) is not None or name in self._lists
+                self._strings.pop(name, None)
+                self._lists.pop(name, None)
+            return deleted
+
+    def rpush(self, name: str, *values: Value) -> int:
+        with self._lock:
+            items = self._lists.setdefault(name, deque())
+            items.extend(_encode(value) for value in values)
+            return len(items)
+
+    def lpop(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            items = self._lists.get(name)
+            if not items:
+                return None
+            value = items.popleft()
+            if not items:
+                del self._lists[name]
+            return value
+
+    def llen(self, name: str) -> int:
+        with self._lock:
+            return len(self._lists.get(name, ()))
+
+    def lrange(self, name: str, start: int, end: int) -> List[bytes]:
+        with self._lock:
+            items = self._lists.get(name, deque())
+            return list(islice(items, *_range(len(items), start, end)))
+
+    def ltrim(self, name: str, start: int, end: int) -> bool:
+        with self._lock:
+            items = self._lists.get(name)
+            if items is None:
+                return True
+            start, stop = _range(len(items), start, end)
+            # Trimming the head, as after a consumed batch, is O(trimmed items)
+            for _ in range(len(items) - stop):
+                items.pop()
+            for _ in range(start):
+                items.popleft()
+            if not items:
+                del self._lists[name]
+            return True
+
+
+class InProcessPipeline:
+    """Queued commands run together under the lock of the instance, like MULTI/EXEC."""
+
+    def __init__(self, redis: InProcessRedis) -> None:
+        self._redis = redis
+        self._commands: List[Tuple[str, tuple, dict]] = []
+
+    def __enter__(self) -> "InProcessPipeline":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._commands = []
+
+    def __getattr__(self, name: str):
+        # Unsupported commands fail when queued, not in the middle of execute
+        getattr(self._redis, name)
+
+        def queue(*args, **kwargs) -> "InProcessPipeline":
+            self._commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self) -> List[Any]:
+        with self._redis._lock:  # pylint: disable=protected-access
+            results = [
+                getattr(self._redis, name)(*args, **kwargs) for name, args, kwargs in self._commands
+            ]
+        self._commands = []
+        return results
+
+
+_in_process_servers: Dict[str, InProcessRedis] = {}
+
+
+def create_redis_client(url: str):
+    if url.startswith("memory://"):
+        if url not in _in_process_servers:
+            max_keys = parse_qs(urlsplit(url).query).get("max_keys")
+            _in_process_servers[url] = InProcessRedis(int(max_keys[0]) if max_keys else None)
+        return _in_process_servers[url]
+
+    import redis  # noqa # pylint: disable=import-outside-toplevel
+
+    return redis.Redis.from_url(url)
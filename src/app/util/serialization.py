@@ -0,0 +1,84 @@
+"""JSON response bodies encoded with orjson instead of Flask `jsonify`.
+
+Error bodies are the same few error codes and messages over and over - each is encoded once
+and reused. Fetched discount codes, the body of every successful claim, are encoded straight
+into a bytes template without an intermediate dict.
+"""
+from functools import lru_cache
+from typing import Any, Iterable, Iterator, Optional, Union
+
+import orjson
+from flask import Response, stream_with_context
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+FETCHED_DISCOUNT_CODE_TEMPLATE = b'{"id":"%s","campaign_id":%d,"user_id":%d,"is_used":%s}'
+
+
+def dumps(payload: Any) -> bytes:
+    return orjson.dumps(payload, default=str)
+
+
+def json_response(body: Union[bytes, Any], status_code: int = 200) -> Response:
+    """Response of already encoded bytes, or of a payload encoded here."""
+    if not isinstance(body, bytes):
+        body = dumps(body)
+    return Response(body, status=status_code, mimetype="application/json")
+
+
+def streamed_response(chunks: Iterable[bytes], mimetype: str, status_code: int = 200) -> Response:
+    """Streamed response of the encoded chunks, written as the iterable yields them.
+
+    An error while streaming aborts the response, so the client gets an incomplete body.
+    """
+    return Response(stream_with_context(chunks), status=status_code, mimetype=mimetype)
+
+
+def _ndjson_lines(payloads: Iterable[Any]) -> Iterator[bytes]:
+    try:
+        for payload in payloads:
+            yield dumps(payload) + b"\n"
+    except Exception:  # pylint: disable=broad-except
+        # Status is already sent - the last line tells the client the stream is incomplete
+        logger.exception("streamed_response_failed")
+        yield encode_error("Internal Server Error", "The response stream was interrupted") + b"\n"
+
+
+def ndjson_response(payloads: Iterable[Any], status_code: int = 200) -> Response:
+    """Streamed response of one JSON line per payload, encoded as the iterable yields them.
+
+    An error while streaming ends the stream with an error line instead of the next payload.
+    """
+    return streamed_response(_ndjson_lines(payloads), NDJSON_MIMETYPE, status_code)
+
+
+def encode_fetched_discount_code(fetched_discount_code) -> bytes:
+    """Body of a `FetchedDiscountCode` or of a row with the same columns, same as
+    `dumps(fetched_discount_code.to_dict())`."""
+    code_id = fetched_discount_code.id
+    # Codes of the generators need no escaping, anything else goes through the encoder
+    if not (code_id.isascii() and code_id.isalnum()):
+        return dumps(
+            {
+                "id": code_id,
+                "campaign_id": fetched_discount_code.campaign_id,
+                "user_id": fetched_discount_code.user_id,
+                "is_used": fetched_discount_code.is_used,
+            }
+        )
+    return FETCHED_DISCOUNT_CODE_TEMPLATE % (
+        code_id.encode(),
+        int(fetched_discount_code.campaign_id),
+        int(fetched_discount_code.user_id),
+        b"true" if fetched_discount_code.is_used else b"false",
+    )
+
+
+@lru_cache(maxsize=1024)
+def encode_error(error_code: Union[int, str], error_message: Optional[str] = None) -> bytes:
+    payload = {"error_code": error_code}
+    if error_message is not None:
+        payload["error_message"] = error_message
+    return dumps(payload)
@@ -1,12 +1,194 @@
+import atexit
 import logging
+import os
+import random
 import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, TextIO
 
+import orjson
 import structlog
 
+from ..metrics import LOG_EVENTS_DROPPED, LOG_EVENTS_SAMPLED_OUT
+
+
+class EventSampler:
+    """Structlog processor keeping only a share of events with the given names, e.g. events
+    of the success path. Events without a rate are always kept."""
+
+    def __init__(self, sample_rates: Dict[str, float]) -> None:
+        self.sample_rates = sample_rates
+        self.sampled_out_count = 0
+
+    def __call__(self, logger, method_name: str, event_dict: dict) -> dict:
+        sample_rate = self.sample_rates.get(event_dict.get("event"))
+        if sample_rate is not None and random.random() >= sample_rate:  # nosec
+            self.sampled_out_count += 1
+            LOG_EVENTS_SAMPLED_OUT.inc()
+            raise structlog.DropEvent
+        return event_dict
+
+
+class AsyncLogWriter:
+    """Writes events from a bounded queue in a background thread, rendered in batches as JSON
+    lines. Events are dropped, never waited for, when the queue is full.
+
+    The queue is a deque - appending takes no lock and wakes no thread, the writer polls it
+    every `flush_interval` seconds while it's empty.
+    """
+
+    def __init__(
+        self,
+        stream: TextIO,
+        queue_size: int = 10000,
+        batch_size: int = 500,
+        flush_interval: float = 0.05,
+    ) -> None:
+        self.stream = stream
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped_count = 0
+        self.written_count = 0
+        self._reported_dropped_count = 0
+        self._events: Deque[dict] = deque()
+        self._thread: Optional[threading.Thread] = None
+        self._is_stopped = False
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def restart_after_fork(self) -> None:
+        """The writer thread doesn't survive a fork, events queued before it are dropped."""
+        if self._is_stopped:
+            return
+        self._events = deque()
+        self.start()
+
+    def put(self, event_dict: dict) -> None:
+        if len(self._events) >= self.queue_size:
+            self.dropped_count += 1
+            return
+        self._events.append(event_dict)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Writes the queued events and stops the writer thread."""
+        self._is_stopped = True
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._events),
+            "written": self.written_count,
+            "dropped": self.dropped_count,
+        }
+
+    def _run(self) -> None:
+        while True:
+            batch: List[dict] = []
+            while self._events and len(batch) < self.batch_size:
+                batch.append(self._events.popleft())
+            if batch or self.dropped_count != self._reported_dropped_count:
+                self._write(batch)
+            elif self._is_stopped:
+                return
+            else:
+                time.sleep(self.flush_interval)
+
+    def _write(self, batch: List[dict]) -> None:
+        dropped_count = self.dropped_count - self._reported_dropped_count
+        if dropped_count:
+            self._reported_dropped_count += dropped_count
+            LOG_EVENTS_DROPPED.inc(dropped_count)
+            batch.append(
+                {
+                    "event": "log_events_dropped",
+                    "level": "warning",
+                    "timestamp": time.time(),
+                    "count": dropped_count,
+                }
+            )
+        if not batch:
+            return
+        lines = [self._render(event_dict) for event_dict in batch]
+        try:
+            self.stream.write(b"\n".join(lines).decode() + "\n")
+            self.stream.flush()
+        except Exception:  # pylint: disable=broad-except
+            # Nowhere to report it - the batch is lost, the writer keeps going
+            self.dropped_count += len(batch)
+            return
+        self.written_count += len(batch)
+
+    @staticmethod
+    def _render(event_dict: dict) -> bytes:
+        timestamp = event_dict.get("timestamp")
+        if isinstance(timestamp, float):
+            event_dict["timestamp"] = datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+        return orjson.dumps(event_dict, default=str)
+
+
+class QueueLogger:
+    """Structlog logger handing rendered-later event dicts to the async writer."""
+
+    def __init__(self, writer: AsyncLogWriter, name: Optional[str] = None) -> None:
+        self.writer = writer
+        self.name = name
+
+    def msg(self, **event_dict) -> None:
+        self.writer.put(event_dict)
+
+    log = debug = info = warn = warning = error = err = critical = exception = msg
+
+
+class QueueLoggerFactory:
+    def __init__(self, writer: AsyncLogWriter) -> None:
+        self.writer = writer
+
+    def __call__(self, name: Optional[str] = None, *args) -> QueueLogger:
+        return QueueLogger(self.writer, name)
+
+
+def add_timestamp(logger, method_name: str, event_dict: dict) -> dict:
+    """Only the time is taken on the request thread, it's formatted by the writer."""
+    event_dict["timestamp"] = time.time()
+    return event_dict
+
+
+def return_event_dict(logger, method_name: str, event_dict: dict) -> dict:
+    return event_dict
+
+
+event_sampler = EventSampler({})
+async_log_writer: Optional[AsyncLogWriter] = None
+
+
+def configure_structlog_logging(
+    is_production: bool = True,
+    log_level: int = logging.INFO,
+    async_logging: bool = False,
+    queue_size: int = 10000,
+    batch_size: int = 500,
+    sample_rates: Optional[Dict[str, float]] = None,
+) -> None:
+    global async_log_writer  # pylint: disable=global-statement,invalid-name
+
+    event_sampler.sample_rates = sample_rates or {}
+    if async_logging:
+        configure_async_structlog_logging(log_level, queue_size, batch_size)
+        return
+    if async_log_writer:
+        async_log_writer.stop()
+        async_log_writer = None
 
-def configure_structlog_logging(is_production: bool = True, log_level: int = logging.INFO) -> None:
     processors = [
         structlog.stdlib.filter_by_level,
+        event_sampler,
         structlog.stdlib.add_logger_name,
         structlog.stdlib.add_log_level,
         structlog.threadlocal.merge_threadlocal,
@@ -32,3 +214,35 @@ def configure_structlog_logging(is_production: bool = True, log_level: int = log
         wrapper_class=structlog.stdlib.BoundLogger,
         cache_logger_on_first_use=True,
     )
+
+
+def configure_async_structlog_logging(log_level: int, queue_size: int, batch_size: int) -> None:
+    """Events are only filtered, sampled and collected on the calling thread - rendered and
+    written by the background writer. Stdlib logging of libraries is left synchronous."""
+    global async_log_writer  # pylint: disable=global-statement,invalid-name
+
+    # One writer per process - queue and batch sizes of the first configuration are kept
+    if async_log_writer is None:
+        async_log_writer = AsyncLogWriter(sys.stdout, queue_size, batch_size)
+        async_log_writer.start()
+        os.register_at_fork(after_in_child=async_log_writer.restart_after_fork)
+        atexit.register(async_log_writer.stop)
+
+    logging.basicConfig(format="%(message)s", stream=sys.stdout, level=log_level)
+    structlog.configure(
+        processors=[
+            event_sampler,
+            structlog.stdlib.add_logger_name,
+            structlog.processors.add_log_level,
+            structlog.threadlocal.merge_threadlocal,
+            add_timestamp,
+            structlog.processors.StackInfoRenderer(),
+            # Exception info is only available on the calling thread
+            structlog.processors.format_exc_info,
+            return_event_dict,
+        ],
+        context_class=dict,
+        logger_factory=QueueLoggerFactory(async_log_writer),
+        wrapper_class=structlog.make_filtering_bound_logger(log_level),
+        cache_logger_on_first_use=True,
+    )
@@ -0,0 +1,126 @@
+"""Warm-up of a worker before it takes traffic.
+
+The first requests of a new worker would pay for the mapper configuration, compilation of
+the claim and lookup statements and connecting to the database. With `WARMUP_ENABLED` the
+gunicorn `post_worker_init` hook (deploy/gunicorn_config.py) opens `WARMUP_POOL_CONNECTIONS`
+pool connections and runs the claim and lookup statements once, so their compiled forms are
+in the statement cache of the engine. The worker accepts requests only after the hook.
+
+`GET /ready` responds 200 once the worker is warmed up and 503 before, or when the warm-up
+failed - a failed warm-up is retried by the next `/ready` request.
+"""
+import threading
+import time
+from typing import List
+
+from flask import Flask, current_app
+from sqlalchemy.engine import Connection
+from sqlalchemy.pool import QueuePool
+from structlog import get_logger
+
+from . import db
+from .config import get_settings
+from .discounts.code_fetch import get_already_created_discount_code
+from .discounts.code_store import _claim_discount_code
+from .errors.exceptions import AppError
+from .util.serialization import json_response
+
+logger = get_logger(__name__)
+
+# No codes are ever added for it - the claim finds none, and is rolled back anyway.
+# Campaign ids come from the URL as strings - bind types are part of the statement cache key
+WARMUP_CAMPAIGN_ID = "-1"
+WARMUP_USER_ID = -1
+
+
+def dispose_engine_after_fork(app: Flask) -> None:
+    """Connections of a parent process must not be used by the forked worker - the pool of
+    the preloaded app is replaced, without closing the parent's connections."""
+    with app.app_context():
+        db.get_engine(app).dispose(close=False)
+
+
+def ready_route():
+    """Get readiness of the worker.
+
+    Responses:
+        200:
+            Worker is warmed up.
+        503:
+            - WORKER_NOT_READY
+    """
+    if not warmup.is_ready and warmup.has_failed:
+        warmup.warm_up(current_app)
+    if not warmup.is_ready:
+        raise AppError(error_code="WORKER_NOT_READY", status_code=503)
+    return json_response({"status": "ready"})
+
+
+class Warmup:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.pool_connections = 0
+        self.is_ready = True
+        self.has_failed = False
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask) -> None:
+        app_config = get_settings()
+        self.enabled = app_config.WARMUP_ENABLED
+        self.pool_connections = app_config.WARMUP_POOL_CONNECTIONS
+        # Without the warm-up the worker is ready as soon as the app is created
+        self.is_ready = not self.enabled
+        self.has_failed = False
+        app.add_url_rule("/ready", view_func=ready_route, methods=["GET"])
+
+    def warm_up(self, app: Flask) -> None:
+        if not self.enabled:
+            return
+        with self._lock, app.app_context():
+            if self.is_ready:
+                return
+            started_at = time.perf_counter()
+            try:
+                connections_count = self._open_pool_connections()
+                self._run_statements()
+            except Exception:  # pylint: disable=broad-except
+                # The worker still serves requests, only cold
+                self.has_failed = True
+                logger.exception("worker_warm_up_failed")
+                return
+            finally:
+                db.session.remove()
+            self.is_ready = True
+            self.has_failed = False
+            logger.info(
+                "worker_warmed_up",
+                connections=connections_count,
+                duration_ms=round((time.perf_counter() - started_at) * 1000, 1),
+            )
+
+    def _open_pool_connections(self) -> int:
+        """Connections are opened at once, so the pool keeps all of them when they're returned.
+        Other pools than a QueuePool, e.g. of SQLite, get one connection."""
+        engine = db.engine
+        connections_count = 1
+        if isinstance(engine.pool, QueuePool):
+            connections_count = min(self.pool_connections, engine.pool.size())
+        connections: List[Connection] = []
+        try:
+            for _ in range(connections_count):
+                connections.append(engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
+        return len(connections)
+
+    @staticmethod
+    def _run_statements() -> None:
+        try:
+            _claim_discount_code(WARMUP_CAMPAIGN_ID, WARMUP_USER_ID)
+            get_already_created_discount_code(WARMUP_CAMPAIGN_ID, WARMUP_USER_ID)
+        finally:
+            db.session.rollback()
+
+
+warmup = Warmup()
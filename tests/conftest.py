@@ -1,16 +1,25 @@
+from pathlib import Path
+
 import pytest
 from flask import Flask
 from pytest import MonkeyPatch
 
 from app import create_app, db
+from app.config import get_settings
 
 
 @pytest.fixture(name="set_envvars_for_testing", autouse=True)
-def set_envvars_for_testing_fixture(monkeypatch: MonkeyPatch) -> None:
+def set_envvars_for_testing_fixture(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
     monkeypatch.setenv("ENV", "testing")
     monkeypatch.setenv("DEBUG", "false")
     monkeypatch.setenv("TESTING", "true")
-    monkeypatch.setenv("SQLALCHEMY_DATABASE_URI", "sqlite://")
+    # File database - background jobs get their own connection instead of sharing
+    # the single connection of in-memory SQLite with the test
+    monkeypatch.setenv("SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path / 'test.db'}")
+    # In-process stand-in of the Redis server of idempotency keys, whatever the environment sets
+    monkeypatch.setenv("IDEMPOTENCY_REDIS_URL", "memory://idempotency")
+    # Settings are cached - tests can override them with environment variables
+    get_settings.cache_clear()
 
 
 @pytest.fixture(name="app")
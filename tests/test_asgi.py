@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+from typing import List, Optional, Tuple
+
+import pytest
+from flask import Flask
+from pytest import MonkeyPatch
+
+from app import db
+from app.asgi import AsyncDiscountsApp, create_asgi_app
+from app.config import get_settings
+from app.discounts.events import discount_code_event_relay
+from app.models import (
+    AvailableDiscountCode,
+    Campaign,
+    DiscountCodeFetchedOutbox,
+    FetchedDiscountCode,
+    Marketplace,
+)
+
+TEST_CAMPAIGN_ID = 1
+TEST_USER_ID = "123456"
+
+
+@pytest.fixture(name="create_test_discount_codes", autouse=True)
+def create_test_discount_codes_fixture(app: Flask):
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="Shop", website_url="https://shop.com"))
+        db.session.add(Campaign(id=TEST_CAMPAIGN_ID, name="Campaign", marketplace_id=1))
+        db.session.add_all(
+            [
+                AvailableDiscountCode(id=f"CODE{index}", campaign_id=TEST_CAMPAIGN_ID)
+                for index in range(2)
+            ]
+        )
+        db.session.commit()
+
+
+async def call(
+    asgi_app: AsyncDiscountsApp, method: str, path: str, user_id: Optional[str] = TEST_USER_ID
+) -> Tuple[int, dict]:
+    messages: List[dict] = []
+    headers = [(b"authorization", user_id.encode())] if user_id else []
+    scope = {"type": "http", "method": method, "path": path, "headers": headers}
+
+    async def receive() -> dict:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: dict) -> None:
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    return messages[0]["status"], json.loads(messages[1]["body"])
+
+
+def run_requests(*requests: Tuple[str, str, Optional[str]]) -> List[Tuple[int, dict]]:
+    async def run() -> List[Tuple[int, dict]]:
+        asgi_app = create_asgi_app()
+        try:
+            return [await call(asgi_app, *request) for request in requests]
+        finally:
+            await asgi_app.engine.dispose()
+
+    return asyncio.run(run())
+
+
+def test_discount_code_created_and_fetched(app: Flask):
+    (created_status, created), (fetched_status, fetched) = run_requests(
+        ("POST", f"/api/discounts/{TEST_CAMPAIGN_ID}", TEST_USER_ID),
+        ("GET", f"/api/discounts/{TEST_CAMPAIGN_ID}", TEST_USER_ID),
+    )
+
+    assert created_status == 201
+    assert created["campaign_id"] == TEST_CAMPAIGN_ID
+    assert created["user_id"] == int(TEST_USER_ID)
+    assert created["is_used"] is False
+    assert fetched_status == 200
+    assert fetched == created
+    with app.app_context():
+        assert FetchedDiscountCode.query.get(created["id"])
+        assert not AvailableDiscountCode.query.get(created["id"])
+
+
+def test_fetched_event_relayed_in_background(app: Flask, monkeypatch: MonkeyPatch):
+    monkeypatch.setenv("DISCOUNT_CODE_EVENT_SINK", "memory")
+    get_settings.cache_clear()
+
+    [(_, created)] = run_requests(("POST", f"/api/discounts/{TEST_CAMPAIGN_ID}", TEST_USER_ID))
+
+    with app.app_context():
+        deadline = time.monotonic() + 5
+        # Events are published before their outbox rows are deleted
+        while DiscountCodeFetchedOutbox.query.count() and time.monotonic() < deadline:
+            db.session.rollback()
+            time.sleep(0.01)
+
+        assert DiscountCodeFetchedOutbox.query.count() == 0
+    assert [event["discount_code_id"] for event in discount_code_event_relay.sink.events] == [
+        created["id"]
+    ]
+
+
+def test_409_if_discount_code_already_fetched():
+    _, (status, data) = run_requests(
+        ("POST", f"/api/discounts/{TEST_CAMPAIGN_ID}", TEST_USER_ID),
+        ("POST", f"/api/discounts/{TEST_CAMPAIGN_ID}", TEST_USER_ID),
+    )
+
+    assert status == 409
+    assert data == {"error_code": "DISCOUNT_CODE_ALREADY_FETCHED"}
+
+
+def test_404_if_discount_codes_not_available():
+    *_, (status, data) = run_requests(
+        ("POST", f"/api/discounts/{TEST_CAMPAIGN_ID}", "1"),
+        ("POST", f"/api/discounts/{TEST_CAMPAIGN_ID}", "2"),
+        ("POST", f"/api/discounts/{TEST_CAMPAIGN_ID}", "3"),
+    )
+
+    assert status == 404
+    assert data == {"error_code": "DISCOUNT_CODE_NOT_AVAILABLE"}
+
+
+def test_404_if_discount_code_not_fetched():
+    [(status, data)] = run_requests(("GET", f"/api/discounts/{TEST_CAMPAIGN_ID}", TEST_USER_ID))
+
+    assert status == 404
+    assert data == {"error_code": "DISCOUNT_CODE_NOT_FOUND"}
+
+
+def test_401_if_authorization_token_is_not_sent():
+    [(status, data)] = run_requests(("POST", f"/api/discounts/{TEST_CAMPAIGN_ID}", None))
+
+    assert status == 401
+    assert data == {"error_code": "INVALID_ACCESS_TOKEN"}
+
+
+def test_404_if_path_is_not_served():
+    [(status, data)] = run_requests(("GET", "/api/unknown", TEST_USER_ID))
+
+    assert status == 404
+    assert data["error_code"] == "Not Found"
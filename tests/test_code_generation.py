@@ -0,0 +1,184 @@
+import io
+import os
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Iterator, List
+
+import pytest
+import structlog
+from flask import Flask
+from pytest import MonkeyPatch
+
+from app import db
+from app.config import get_settings
+from app.discounts import code_generation
+from app.discounts.code_generation import (
+    generate_discount_codes_job,
+    generate_discount_codes_shard,
+    insert_discount_codes,
+)
+from app.models import (
+    AvailableDiscountCode,
+    Campaign,
+    DiscountCodeGenerationJob,
+    Marketplace,
+)
+
+TEST_CAMPAIGN_ID = 1
+
+
+@pytest.fixture(name="campaign", autouse=True)
+def campaign_fixture(app: Flask) -> None:
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="My Test Shop", website_url="https://example.com"))
+        db.session.add(Campaign(id=TEST_CAMPAIGN_ID, name="Campaign", marketplace_id=1))
+        db.session.commit()
+
+
+class CopyConnection:
+    """PostgreSQL connection stand-in recording `COPY` payloads and executed statements."""
+
+    dialect = SimpleNamespace(name="postgresql")
+
+    def __init__(self) -> None:
+        self.copies: List[tuple] = []
+        self.statements: list = []
+        self.connection = self
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    def copy_expert(self, sql: str, buffer: io.StringIO) -> None:
+        self.copies.append((sql, buffer.getvalue()))
+
+    def execute(self, statement) -> None:
+        self.statements.append(statement)
+
+
+class ChunksGenerator:
+    """Code generator returning the given chunks in order."""
+
+    def __init__(self, chunks: List[List[str]]) -> None:
+        self.chunks: Iterator[List[str]] = iter(chunks)
+
+    def generate(self, connection, campaign_id: int, count: int) -> List[str]:
+        return next(self.chunks)
+
+
+def exit_after_first_batch(
+    database_uri: str,
+    job_id: str,
+    campaign_id: int,
+    discount_codes_count: int,
+    commit_batch: int,
+    chunk_size: int,
+) -> dict:
+    """Shard of a worker process dying after its first committed batch, once per test."""
+    try:
+        os.close(os.open(os.environ["EXITED_SHARD_MARKER"], os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return generate_discount_codes_shard(
+            database_uri, job_id, campaign_id, discount_codes_count, commit_batch, chunk_size
+        )
+    generate_discount_codes_shard(
+        database_uri, job_id, campaign_id, commit_batch, commit_batch, chunk_size
+    )
+    os._exit(1)  # pylint: disable=protected-access
+
+
+def test_codes_inserted_in_bulk(app: Flask) -> None:
+    codes = [f"CODE{index}" for index in range(250)]
+    with app.app_context():
+        insert_discount_codes(TEST_CAMPAIGN_ID, codes)
+        db.session.commit()
+
+        assert AvailableDiscountCode.query.filter_by(campaign_id=TEST_CAMPAIGN_ID).count() == 250
+
+
+def test_codes_copied_on_postgresql() -> None:
+    connection = CopyConnection()
+
+    insert_discount_codes(TEST_CAMPAIGN_ID, ["A1", "B2"], connection)
+
+    assert connection.copies == [
+        ("COPY available_discount_codes (id, campaign_id) FROM STDIN", "A1\t1\nB2\t1\n")
+    ]
+    # The campaign counters upsert, no INSERT of the codes
+    assert len(connection.statements) == 1
+
+
+def test_job_logs_rows_per_second(app: Flask, monkeypatch: MonkeyPatch) -> None:
+    log_capture = structlog.testing.LogCapture()
+    monkeypatch.setattr(
+        code_generation, "logger", structlog.wrap_logger(None, processors=[log_capture])
+    )
+    with app.app_context():
+        db.session.add(
+            DiscountCodeGenerationJob(id="job", campaign_id=TEST_CAMPAIGN_ID, target_count=500)
+        )
+        db.session.commit()
+
+        generate_discount_codes_job("job", commit_batch=200)
+
+        assert AvailableDiscountCode.query.filter_by(campaign_id=TEST_CAMPAIGN_ID).count() == 500
+        job = db.session.get(DiscountCodeGenerationJob, "job")
+        assert job.generated_count == 500
+        assert job.rows_per_second > 0
+    (finished,) = [entry for entry in log_capture.entries if entry.get("finished")]
+    assert finished["discount_codes_count"] == 500
+    assert finished["rows_per_second"] == job.rows_per_second
+    assert finished["finished_in_seconds"] > 0
+
+
+def test_only_colliding_chunk_generated_again(app: Flask, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("DISCOUNT_CODE_GENERATION_CHUNK_SIZE", "2")
+    get_settings.cache_clear()
+    chunks = [["A1", "A2"], ["A3", "TAKEN"], ["A3", "A4"], ["A5", "A6"]]
+    monkeypatch.setattr(code_generation, "get_code_generator", lambda: ChunksGenerator(chunks))
+    with app.app_context():
+        db.session.add(AvailableDiscountCode(id="TAKEN", campaign_id=TEST_CAMPAIGN_ID))
+        db.session.add(
+            DiscountCodeGenerationJob(id="job", campaign_id=TEST_CAMPAIGN_ID, target_count=6)
+        )
+        db.session.commit()
+
+        generate_discount_codes_job("job", commit_batch=100)
+
+        codes = AvailableDiscountCode.query.filter_by(campaign_id=TEST_CAMPAIGN_ID)
+        assert sorted(code.id for code in codes) == ["A1", "A2", "A3", "A4", "A5", "A6", "TAKEN"]
+        job = db.session.get(DiscountCodeGenerationJob, "job")
+        assert (job.status, job.generated_count) == ("finished", 6)
+
+
+def test_shards_of_dead_worker_generated_again(
+    app: Flask, monkeypatch: MonkeyPatch, tmp_path
+) -> None:
+    monkeypatch.setenv("DISCOUNT_CODE_GENERATION_PROCESSES", "2")
+    monkeypatch.setenv("DISCOUNT_CODE_GENERATION_SHARD_SIZE", "500")
+    # Inherited by the spawned worker processes
+    monkeypatch.setenv("EXITED_SHARD_MARKER", str(tmp_path / "exited"))
+    get_settings.cache_clear()
+    monkeypatch.setattr(code_generation, "generate_discount_codes_shard", exit_after_first_batch)
+    log_capture = structlog.testing.LogCapture()
+    monkeypatch.setattr(
+        code_generation, "logger", structlog.wrap_logger(None, processors=[log_capture])
+    )
+    with app.app_context():
+        db.session.add(
+            DiscountCodeGenerationJob(id="job", campaign_id=TEST_CAMPAIGN_ID, target_count=2000)
+        )
+        db.session.commit()
+
+        generate_discount_codes_job("job", commit_batch=200)
+
+        job = db.session.get(DiscountCodeGenerationJob, "job")
+        assert (job.status, job.generated_count) == ("finished", 2000)
+        assert AvailableDiscountCode.query.filter_by(campaign_id=TEST_CAMPAIGN_ID).count() == 2000
+    (lost,) = [
+        entry
+        for entry in log_capture.entries
+        if entry["event"] == "generate_discount_codes_shards_lost"
+    ]
+    # The dead worker committed its first batch before exiting
+    assert lost["generated_count"] >= 200
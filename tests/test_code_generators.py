@@ -0,0 +1,101 @@
+import pytest
+from flask import Flask
+from pydantic import ValidationError
+from pytest import MonkeyPatch
+
+from app import create_app, db
+from app.config import get_settings
+from app.models import AvailableDiscountCode, Campaign, Marketplace
+from app.util.code_generators import (
+    CROCKFORD_BASE32_ALPHABET,
+    PermutationCodeGenerator,
+    RandomCodeGenerator,
+)
+
+TEST_KEY = "test-key"
+
+
+@pytest.fixture(name="campaign_id")
+def campaign_id_fixture(app: Flask) -> int:
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="Shop", website_url="https://shop.com"))
+        db.session.add(Campaign(id=1, name="Campaign", marketplace_id=1))
+        db.session.commit()
+    return 1
+
+
+def test_random_codes_are_distinct_and_use_alphabet():
+    codes = RandomCodeGenerator(alphabet="AB", length=20).generate(None, 1, 5000)
+
+    assert len(codes) == len(set(codes)) == 5000
+    assert all(len(code) == 20 and set(code) <= {"A", "B"} for code in codes)
+
+
+def test_random_codes_use_whole_alphabet():
+    codes = RandomCodeGenerator().generate(None, 1, 1000)
+
+    assert set("".join(codes)) == set(CROCKFORD_BASE32_ALPHABET)
+
+
+def test_permutation_codes_unique_across_campaigns():
+    code_generator = PermutationCodeGenerator(TEST_KEY)
+
+    codes = code_generator.codes_for(1, 0, 5000) + code_generator.codes_for(2, 0, 5000)
+
+    assert len(set(codes)) == 10000
+    assert all(len(code) == 10 and set(code) <= set(CROCKFORD_BASE32_ALPHABET) for code in codes)
+
+
+def test_permutation_codes_depend_on_key():
+    codes = PermutationCodeGenerator(TEST_KEY).codes_for(1, 0, 10)
+
+    assert PermutationCodeGenerator(TEST_KEY).codes_for(1, 0, 10) == codes
+    assert PermutationCodeGenerator("other-key").codes_for(1, 0, 10) != codes
+
+
+def test_permutation_stays_in_code_space_with_cycle_walking():
+    code_generator = PermutationCodeGenerator(TEST_KEY, alphabet="0123456789", length=10)
+
+    values = [code_generator.permute(value) for value in range(1 << 30, (1 << 30) + 1000)]
+
+    assert len(set(values)) == 1000
+    assert all(value < 10**10 for value in values)
+
+
+def test_permutation_counter_overflow_fails():
+    with pytest.raises(ValueError):
+        PermutationCodeGenerator(TEST_KEY).codes_for(1, (1 << 30) - 1, 2)
+
+
+def test_permutation_counter_reserved_in_campaign(app: Flask, campaign_id: int):
+    code_generator = PermutationCodeGenerator(TEST_KEY)
+    with app.app_context(), db.engine.begin() as connection:
+        first_codes = code_generator.generate(connection, campaign_id, 3)
+        second_codes = code_generator.generate(connection, campaign_id, 2)
+
+        assert first_codes + second_codes == code_generator.codes_for(campaign_id, 0, 5)
+    with app.app_context():
+        assert db.session.get(Campaign, campaign_id).discount_code_counter == 5
+
+
+def test_configured_generator_used_as_code_id_default(
+    app: Flask, campaign_id: int, monkeypatch: MonkeyPatch
+):
+    monkeypatch.setenv("DISCOUNT_CODE_GENERATOR", "permutation")
+    monkeypatch.setenv("DISCOUNT_CODE_PERMUTATION_KEY", TEST_KEY)
+    get_settings.cache_clear()
+    with app.app_context():
+        db.session.add_all([AvailableDiscountCode(campaign_id=campaign_id) for _ in range(3)])
+        db.session.commit()
+
+        assert {code.id for code in AvailableDiscountCode.query.all()} == set(
+            PermutationCodeGenerator(TEST_KEY).codes_for(campaign_id, 0, 3)
+        )
+
+
+def test_app_not_started_with_permutation_generator_without_key(monkeypatch: MonkeyPatch):
+    monkeypatch.setenv("DISCOUNT_CODE_GENERATOR", "permutation")
+    get_settings.cache_clear()
+
+    with pytest.raises(ValidationError, match="DISCOUNT_CODE_PERMUTATION_KEY"):
+        create_app()
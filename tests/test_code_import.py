@@ -0,0 +1,145 @@
+import datetime
+import importlib
+import sys
+from pathlib import Path
+from typing import List
+
+import orjson
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from pytest import MonkeyPatch
+
+from app import db
+from app.config import get_settings
+from app.models import AvailableDiscountCode, Campaign, FetchedDiscountCode, Marketplace
+
+TEST_CAMPAIGN_ID = "1"
+OTHER_CAMPAIGN_ID = "2"
+
+
+@pytest.fixture(name="campaigns", autouse=True)
+def campaigns_fixture(app: Flask, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("DISCOUNT_CODE_IMPORT_CHUNK_SIZE", "4")
+    get_settings.cache_clear()
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="My Test Shop", website_url="https://example.com"))
+        db.session.add(
+            Campaign(
+                id=TEST_CAMPAIGN_ID,
+                name="Campaign",
+                active_until=datetime.datetime.utcnow() + datetime.timedelta(days=1),
+                marketplace_id=1,
+            )
+        )
+        db.session.add(Campaign(id=OTHER_CAMPAIGN_ID, name="Other campaign", marketplace_id=1))
+        db.session.add(AvailableDiscountCode(id="AVAILABLE", campaign_id=OTHER_CAMPAIGN_ID))
+        db.session.add(FetchedDiscountCode(id="FETCHED", campaign_id=OTHER_CAMPAIGN_ID, user_id=1))
+        db.session.commit()
+
+
+def import_codes(client: FlaskClient, body: bytes, content_type: str = "application/x-ndjson"):
+    return client.post(
+        f"/api/discounts/{TEST_CAMPAIGN_ID}/manage/import",
+        data=body,
+        headers={"Authorization": "1", "Content-Type": content_type},
+    )
+
+
+def response_lines(res) -> List[dict]:
+    return [orjson.loads(line) for line in res.data.splitlines()]
+
+
+def imported_code_ids(app: Flask) -> List[str]:
+    with app.app_context():
+        return sorted(
+            code.id for code in AvailableDiscountCode.query.filter_by(campaign_id=TEST_CAMPAIGN_ID)
+        )
+
+
+def test_ndjson_imported_in_chunks(app: Flask, client: FlaskClient) -> None:
+    code_ids = [f"CODE{index}" for index in range(5)]
+    lines = [orjson.dumps(code_id) for code_id in code_ids]
+    lines.append(orjson.dumps({"id": "CODE5"}))
+
+    res = import_codes(client, b"\n".join(lines) + b"\n")
+
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    assert response_lines(res) == [
+        {"chunk": 1, "accepted": 4, "duplicate": 0, "invalid": 0},
+        {"chunk": 2, "accepted": 2, "duplicate": 0, "invalid": 0},
+        {"totals": {"accepted": 6, "duplicate": 0, "invalid": 0}},
+    ]
+    assert imported_code_ids(app) == code_ids + ["CODE5"]
+
+
+def test_duplicates_and_invalid_counted(app: Flask, client: FlaskClient) -> None:
+    import_codes(client, orjson.dumps("EXISTING"))
+    body = b"\n".join(
+        [
+            orjson.dumps("EXISTING"),  # imported before
+            orjson.dumps("AVAILABLE"),  # available in another campaign
+            orjson.dumps("FETCHED"),  # issued in another campaign
+            orjson.dumps("NEW"),
+            orjson.dumps("NEW"),  # repeated in the chunk
+            orjson.dumps("bad code"),
+            orjson.dumps("X" * 11),  # longer than any code id
+            b"not json",
+        ]
+    )
+
+    res = import_codes(client, body)
+
+    assert response_lines(res)[-1] == {"totals": {"accepted": 1, "duplicate": 4, "invalid": 3}}
+    assert imported_code_ids(app) == ["EXISTING", "NEW"]
+
+
+def test_csv_imported(app: Flask, client: FlaskClient) -> None:
+    body = "code,note\r\nCSV-1,a\r\nCSV_2,b\r\n"
+
+    res = import_codes(client, body.encode(), content_type="text/csv")
+
+    assert response_lines(res)[-1]["totals"]["accepted"] == 2
+    assert imported_code_ids(app) == ["CSV-1", "CSV_2"]
+
+
+def test_imported_codes_claimable(client: FlaskClient) -> None:
+    import_codes(client, orjson.dumps("IMPORTED"))
+
+    res = client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": "7"})
+
+    assert res.status_code == 201
+    assert res.get_json()["id"] == "IMPORTED"
+
+
+def test_unsupported_content_type(client: FlaskClient) -> None:
+    res = import_codes(client, b"{}", content_type="application/json")
+
+    assert res.status_code == 400
+    assert res.get_json()["error_code"] == "REQUEST_VALIDATION_FAILED"
+
+
+def test_unknown_campaign(client: FlaskClient) -> None:
+    res = client.post(
+        "/api/discounts/999/manage/import",
+        data=b"",
+        headers={"Authorization": "1", "Content-Type": "application/x-ndjson"},
+    )
+
+    assert res.status_code == 404
+    assert res.get_json()["error_code"] == "CAMPAIGN_NOT_FOUND"
+
+
+def test_import_script(app: Flask, monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.syspath_prepend(str(Path(__file__).parents[1] / "scripts"))
+    script = importlib.import_module("import_codes")
+    path = tmp_path / "codes.csv"
+    path.write_text("code\nFILE1\nFILE2\nFILE1\n")
+    monkeypatch.setattr(
+        sys, "argv", ["import_codes.py", "--campaign-id", TEST_CAMPAIGN_ID, str(path)]
+    )
+
+    script.main()
+
+    assert imported_code_ids(app) == ["FILE1", "FILE2"]
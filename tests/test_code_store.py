@@ -0,0 +1,268 @@
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from pytest import MonkeyPatch
+from werkzeug.test import TestResponse
+
+from app import db
+from app.config import get_settings
+from app.discounts.code_cache import fetched_discount_code_cache
+from app.discounts.code_generation import generate_discount_codes_job
+from app.discounts.code_store import RedisCodeStore, discount_code_store
+from app.models import (
+    AvailableDiscountCode,
+    Campaign,
+    DiscountCodeFetchedOutbox,
+    DiscountCodeGenerationJob,
+    FetchedDiscountCode,
+    Marketplace,
+)
+from app.util.redis_client import create_redis_client
+
+TEST_CAMPAIGN_ID = "1"
+TEST_USER_ID = "123456"
+CODES_COUNT = 5
+
+
+@pytest.fixture(name="code_store", params=["in-process", "fakeredis"])
+def code_store_fixture(request, app: Flask, monkeypatch: MonkeyPatch) -> RedisCodeStore:
+    monkeypatch.setenv("DISCOUNT_CODE_STORE", "redis")
+    monkeypatch.setenv("DISCOUNT_CODE_STORE_REDIS_URL", "memory://test")
+    monkeypatch.setenv("DISCOUNT_CODE_STORE_PERSIST_BATCH", "2")
+    # Claims are persisted by the tests, not by a background job racing them
+    monkeypatch.setenv("DISCOUNT_CODE_STORE_PERSIST_IN_BACKGROUND", "false")
+    get_settings.cache_clear()
+    discount_code_store.init_app(app)
+    code_store = discount_code_store.store
+    if request.param == "fakeredis":
+        fakeredis = pytest.importorskip("fakeredis")
+        code_store.redis = fakeredis.FakeRedis()
+    else:
+        create_redis_client("memory://test").flushall()
+
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="My Test Shop", website_url="https://example.com"))
+        db.session.add(Campaign(id=TEST_CAMPAIGN_ID, name="Campaign", marketplace_id=1))
+        codes = [AvailableDiscountCode(campaign_id=TEST_CAMPAIGN_ID) for _ in range(CODES_COUNT)]
+        db.session.add_all(codes)
+        db.session.flush()
+        code_ids = [code.id for code in codes]
+        db.session.commit()
+    discount_code_store.codes_added(TEST_CAMPAIGN_ID, code_ids)
+    yield code_store
+
+    monkeypatch.setenv("DISCOUNT_CODE_STORE", "sql")
+    get_settings.cache_clear()
+    discount_code_store.init_app(app)
+
+
+def create_discount_code(client: FlaskClient, user_id: str = TEST_USER_ID) -> TestResponse:
+    return client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": user_id})
+
+
+def test_code_popped_from_store_and_persisted_later(
+    app: Flask, client: FlaskClient, code_store: RedisCodeStore
+) -> None:
+    res = create_discount_code(client)
+    code_id = res.get_json()["id"]
+
+    assert res.status_code == 201
+    assert code_store.available_count(TEST_CAMPAIGN_ID) == CODES_COUNT - 1
+    with app.app_context():
+        # Still available in SQL until the claim is persisted
+        assert db.session.get(AvailableDiscountCode, code_id)
+        assert not db.session.get(FetchedDiscountCode, code_id)
+
+        assert code_store.persist_claimed() == 1
+
+        assert not db.session.get(AvailableDiscountCode, code_id)
+        assert db.session.get(FetchedDiscountCode, code_id).user_id == int(TEST_USER_ID)
+        assert DiscountCodeFetchedOutbox.query.filter_by(discount_code_id=code_id).count() == 1
+
+
+def test_claimed_code_found_before_it_is_persisted(
+    client: FlaskClient, code_store: RedisCodeStore
+) -> None:
+    code_id = create_discount_code(client).get_json()["id"]
+    # As seen by another worker, which does not have the code in its cache
+    fetched_discount_code_cache.invalidate(TEST_CAMPAIGN_ID, int(TEST_USER_ID))
+    res = client.get(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": TEST_USER_ID})
+
+    assert res.status_code == 200
+    assert res.get_json()["id"] == code_id
+
+
+def test_409_does_not_pop_code(client: FlaskClient, code_store: RedisCodeStore) -> None:
+    create_discount_code(client)
+
+    res = create_discount_code(client)
+
+    assert res.status_code == 409
+    assert res.get_json()["error_code"] == "DISCOUNT_CODE_ALREADY_FETCHED"
+    assert code_store.available_count(TEST_CAMPAIGN_ID) == CODES_COUNT - 1
+
+
+def test_404_when_store_is_empty_and_user_can_claim_later(
+    client: FlaskClient, code_store: RedisCodeStore
+) -> None:
+    code_store.redis.delete(code_store.available_key(TEST_CAMPAIGN_ID))
+
+    res = create_discount_code(client)
+
+    assert res.status_code == 404
+    assert res.get_json()["error_code"] == "DISCOUNT_CODE_NOT_AVAILABLE"
+    assert code_store.get_claimed_code_id(TEST_CAMPAIGN_ID, int(TEST_USER_ID)) is None
+
+
+def test_409_when_code_was_fetched_before_the_store_switch(
+    app: Flask, client: FlaskClient, code_store: RedisCodeStore
+) -> None:
+    with app.app_context():
+        db.session.add(
+            FetchedDiscountCode(id="SQLCODE", campaign_id=TEST_CAMPAIGN_ID, user_id=TEST_USER_ID)
+        )
+        db.session.commit()
+
+    res = create_discount_code(client)
+
+    assert res.status_code == 409
+    assert code_store.available_count(TEST_CAMPAIGN_ID) == CODES_COUNT
+    assert code_store.get_claimed_code_id(TEST_CAMPAIGN_ID, int(TEST_USER_ID)) == "SQLCODE"
+
+
+def test_user_keys_backfilled_from_sql(
+    app: Flask, client: FlaskClient, code_store: RedisCodeStore
+) -> None:
+    with app.app_context():
+        db.session.add(FetchedDiscountCode(id="SQLCODE", campaign_id=TEST_CAMPAIGN_ID, user_id=1))
+        db.session.commit()
+        assert not code_store.are_users_backfilled()
+
+        assert code_store.backfill_user_keys(chunk_size=1) == 1
+
+    assert code_store.are_users_backfilled()
+    assert code_store.get_claimed_code_id(TEST_CAMPAIGN_ID, 1) == "SQLCODE"
+    assert create_discount_code(client, "1").status_code == 409
+    assert create_discount_code(client, "2").status_code == 201
+
+
+def test_code_generated_before_the_switch_claimed_after_backfill(
+    app: Flask, client: FlaskClient, code_store: RedisCodeStore
+) -> None:
+    # Codes generated while the sql store was configured never reached the list
+    code_store.redis.delete(code_store.available_key(TEST_CAMPAIGN_ID))
+    with app.app_context():
+        available_ids = {code.id for code in AvailableDiscountCode.query.all()}
+        leased_code = AvailableDiscountCode.query.first()
+        leased_code.leased_by = "worker"
+        leased_code_id = leased_code.id
+        db.session.commit()
+
+        assert code_store.backfill_available_codes(chunk_size=2) == CODES_COUNT - 1
+        with pytest.raises(RuntimeError):
+            code_store.backfill_available_codes()
+
+    res = create_discount_code(client, "1")
+    assert res.status_code == 201
+    assert res.get_json()["id"] in available_ids - {leased_code_id}
+    assert code_store.available_count(TEST_CAMPAIGN_ID) == CODES_COUNT - 2
+
+
+def test_user_can_claim_again_after_failed_claim(
+    app: Flask, client: FlaskClient, code_store: RedisCodeStore, monkeypatch: MonkeyPatch
+) -> None:
+    user_key = code_store.user_key(TEST_CAMPAIGN_ID, int(TEST_USER_ID))
+    placeholders = []
+
+    def failing_lpop(name: str):
+        placeholders.append(code_store.redis.get(user_key))
+        if hasattr(code_store.redis, "ttl"):
+            assert 0 < code_store.redis.ttl(user_key) <= code_store.CLAIMING_TTL_SECONDS
+        raise ConnectionError("Redis went away")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(code_store.redis, "lpop", failing_lpop)
+        with app.app_context(), pytest.raises(ConnectionError):
+            code_store.claim(TEST_CAMPAIGN_ID, int(TEST_USER_ID))
+
+    assert placeholders == [code_store.CLAIMING]
+    assert code_store.redis.get(user_key) is None
+    res = create_discount_code(client)
+    assert res.status_code == 201
+    assert (
+        code_store.get_claimed_code_id(TEST_CAMPAIGN_ID, int(TEST_USER_ID)) == res.get_json()["id"]
+    )
+    if hasattr(code_store.redis, "ttl"):
+        # No expiry
+        assert code_store.redis.ttl(user_key) == -1
+
+
+def test_claims_persisted_in_batches_once(
+    app: Flask, client: FlaskClient, code_store: RedisCodeStore
+) -> None:
+    for user_id in range(1, CODES_COUNT + 1):
+        assert create_discount_code(client, str(user_id)).status_code == 201
+    assert create_discount_code(client, "999").status_code == 404
+    # Batch replayed after a persister died before trimming it from the queue
+    first_record = code_store.redis.lrange(code_store.claimed_key, 0, 0)[0]
+    code_store.redis.rpush(code_store.claimed_key, first_record)
+
+    with app.app_context():
+        assert code_store.persist_claimed() == CODES_COUNT
+        assert code_store.persist_claimed() == 0
+        assert FetchedDiscountCode.query.count() == CODES_COUNT
+        assert AvailableDiscountCode.query.count() == 0
+    assert code_store.redis.llen(code_store.claimed_key) == 0
+
+
+def test_persister_stops_when_its_lock_expired(
+    app: Flask, client: FlaskClient, code_store: RedisCodeStore, monkeypatch: MonkeyPatch
+) -> None:
+    for user_id in range(1, CODES_COUNT + 1):
+        create_discount_code(client, str(user_id))
+    persist_batch = code_store._persist_batch
+
+    def persist_batch_and_lose_lock(claims) -> int:
+        # Lock expired during the batch and was taken by another persister
+        code_store.redis.set(code_store.persist_lock_key, "other")
+        return persist_batch(claims)
+
+    monkeypatch.setattr(code_store, "_persist_batch", persist_batch_and_lose_lock)
+
+    with app.app_context():
+        assert code_store.persist_claimed() == 2
+    assert code_store.redis.llen(code_store.claimed_key) == CODES_COUNT - 2
+    assert code_store.redis.get(code_store.persist_lock_key) == b"other"
+
+
+def test_batch_claims_popped_from_store(client: FlaskClient, code_store: RedisCodeStore) -> None:
+    create_discount_code(client, "1")
+
+    res = client.post(
+        f"/api/discounts/{TEST_CAMPAIGN_ID}/batch",
+        json={"user_ids": list(range(1, CODES_COUNT + 2))},
+        headers={"Authorization": "1"},
+    )
+    statuses = [result["status"] for result in res.get_json()["results"]]
+
+    assert res.status_code == 200
+    assert statuses == ["already_fetched"] + ["created"] * (CODES_COUNT - 1) + ["not_available"]
+    assert code_store.available_count(TEST_CAMPAIGN_ID) == 0
+
+
+def test_generated_codes_added_to_store_once_committed(
+    app: Flask, code_store: RedisCodeStore
+) -> None:
+    with app.app_context():
+        job = DiscountCodeGenerationJob(
+            id="job", campaign_id=TEST_CAMPAIGN_ID, status="pending", target_count=7
+        )
+        db.session.add(job)
+        db.session.commit()
+
+        generate_discount_codes_job("job", commit_batch=3)
+
+        assert code_store.available_count(TEST_CAMPAIGN_ID) == CODES_COUNT + 7
+        available_ids = {code.id for code in AvailableDiscountCode.query.all()}
+    stored_ids = code_store.redis.lrange(code_store.available_key(TEST_CAMPAIGN_ID), 0, -1)
+    assert {code_id.decode() for code_id in stored_ids} == available_ids
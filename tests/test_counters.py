@@ -0,0 +1,130 @@
+import datetime
+
+import orjson
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from pytest import MonkeyPatch
+
+from app import db
+from app.config import get_settings
+from app.discounts.code_lease import discount_code_lease_pool
+from app.discounts.counters import (
+    get_campaign_counts,
+    increment_campaign_counters,
+    repair_campaign_counters,
+)
+from app.models import AvailableDiscountCode, Campaign, CampaignCounter, Marketplace
+
+TEST_CAMPAIGN_ID = "1"
+CODE_IDS = [f"CODE{index}" for index in range(6)]
+
+
+@pytest.fixture(name="campaign", autouse=True)
+def campaign_fixture(app: Flask, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("CAMPAIGN_COUNTER_STRIPES", "4")
+    get_settings.cache_clear()
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="My Test Shop", website_url="https://example.com"))
+        db.session.add(
+            Campaign(
+                id=TEST_CAMPAIGN_ID,
+                name="Campaign",
+                active_until=datetime.datetime.utcnow() + datetime.timedelta(days=1),
+                marketplace_id=1,
+            )
+        )
+        db.session.commit()
+
+
+def post(client: FlaskClient, path: str, body: bytes = b"", user_id: str = "1"):
+    return client.post(
+        f"/api/discounts/{TEST_CAMPAIGN_ID}{path}",
+        data=body,
+        headers={"Authorization": user_id, "Content-Type": "application/x-ndjson"},
+    )
+
+
+def import_codes(client: FlaskClient) -> None:
+    post(client, "/manage/import", b"\n".join(orjson.dumps(code_id) for code_id in CODE_IDS))
+
+
+def get_stats(client: FlaskClient, campaign_id: str = TEST_CAMPAIGN_ID):
+    return client.get(f"/api/discounts/{campaign_id}/manage/stats", headers={"Authorization": "1"})
+
+
+def test_counters_updated_by_imports_claims_and_redemptions(client: FlaskClient) -> None:
+    import_codes(client)
+    claimed_ids = [post(client, "", user_id=str(user_id)).get_json()["id"] for user_id in (1, 2)]
+    client.post(
+        f"/api/discounts/{TEST_CAMPAIGN_ID}/batch",
+        json={"user_ids": [3, 4]},
+        headers={"Authorization": "1"},
+    )
+    post(client, "/manage/redemptions", b"\n".join(orjson.dumps(code) for code in claimed_ids))
+
+    res = get_stats(client)
+
+    assert res.status_code == 200
+    assert res.get_json() == {"campaign_id": 1, "available": 2, "issued": 4, "redeemed": 2}
+
+
+def test_not_available_claim_not_counted(client: FlaskClient) -> None:
+    assert post(client, "").status_code == 404
+
+    assert get_stats(client).get_json()["issued"] == 0
+
+
+def test_leased_claims_counted(app: Flask, client: FlaskClient, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("DISCOUNT_CODE_LEASE_ENABLED", "true")
+    monkeypatch.setenv("DISCOUNT_CODE_LEASE_REFILL_THRESHOLD", "-1")
+    get_settings.cache_clear()
+    discount_code_lease_pool.init_app(app)
+    import_codes(client)
+
+    post(client, "", user_id="1")
+
+    assert get_stats(client).get_json()["available"] == len(CODE_IDS) - 1
+    with app.app_context():
+        # Leased code stays in the available codes table until the lease is refilled
+        assert AvailableDiscountCode.query.count() == len(CODE_IDS)
+        assert repair_campaign_counters() == {}
+
+
+def test_increments_striped(app: Flask) -> None:
+    with app.app_context():
+        for _ in range(50):
+            increment_campaign_counters(TEST_CAMPAIGN_ID, available=2, issued=1)
+        db.session.commit()
+
+        stripes = CampaignCounter.query.filter_by(campaign_id=TEST_CAMPAIGN_ID).count()
+        assert 1 < stripes <= 4
+        assert get_campaign_counts(TEST_CAMPAIGN_ID) == {
+            "available": 100,
+            "issued": 50,
+            "redeemed": 0,
+        }
+
+
+def test_repair_recomputes_from_code_tables(app: Flask, client: FlaskClient) -> None:
+    import_codes(client)
+    post(client, "", user_id="1")
+    with app.app_context():
+        # Added without the counters
+        db.session.add(AvailableDiscountCode(id="ADDED", campaign_id=TEST_CAMPAIGN_ID))
+        db.session.commit()
+
+        repaired = repair_campaign_counters()
+
+        counts = {"available": len(CODE_IDS), "issued": 1, "redeemed": 0}
+        assert repaired == {1: counts}
+        assert CampaignCounter.query.filter_by(campaign_id=TEST_CAMPAIGN_ID).count() == 1
+        assert repair_campaign_counters([TEST_CAMPAIGN_ID]) == {}
+    assert get_stats(client).get_json() == {"campaign_id": 1, **counts}
+
+
+def test_unknown_campaign(client: FlaskClient) -> None:
+    res = get_stats(client, campaign_id="999")
+
+    assert res.status_code == 404
+    assert res.get_json()["error_code"] == "CAMPAIGN_NOT_FOUND"
@@ -1,14 +1,39 @@
 import datetime
 import re
+import threading
 import time
+from types import SimpleNamespace
+from typing import List
 
 import pytest
 from flask import Flask
 from flask.testing import FlaskClient
+from pytest import MonkeyPatch
+from sqlalchemy.dialects import postgresql
 from werkzeug.test import TestResponse
 
 from app import db
-from app.models import AvailableDiscountCode, Campaign, FetchedDiscountCode, Marketplace
+from app.config import get_settings
+from app.discounts import code_generation
+from app.discounts.availability import campaign_availability_cache
+from app.discounts.claim_batching import discount_code_claim_coalescer
+from app.discounts.code_cache import fetched_discount_code_cache
+from app.discounts.code_generation import (
+    generate_discount_codes_job,
+    generate_discount_codes_shard,
+)
+from app.discounts.code_lease import discount_code_lease_pool
+from app.discounts.code_store import _claim_statement
+from app.discounts.events import InMemoryEventSink, discount_code_event_relay
+from app.models import (
+    AvailableDiscountCode,
+    Campaign,
+    DiscountCodeFetchedOutbox,
+    DiscountCodeGenerationJob,
+    FetchedDiscountCode,
+    Marketplace,
+)
+from app.util.cache import MISSING, LRUCache
 
 TEST_CAMPAIGN_ID = "1"
 TEST_USER_ID = "123456"
@@ -72,6 +97,37 @@ class TestCreateDiscountCode:
             assert res.status_code == 404
             assert data["error_code"] == "DISCOUNT_CODE_NOT_AVAILABLE"
 
+    def test_404_served_from_cache_while_campaign_is_exhausted(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            AvailableDiscountCode.query.delete()
+            db.session.commit()
+            self.create_discount_code(client)
+            # Codes added without the generation job do not invalidate the cache
+            db.session.add(AvailableDiscountCode(campaign_id=TEST_CAMPAIGN_ID))
+            db.session.commit()
+
+            res = self.create_discount_code(client)
+            data = res.get_json()
+
+            assert res.status_code == 404
+            assert data["error_code"] == "DISCOUNT_CODE_NOT_AVAILABLE"
+            assert campaign_availability_cache.stats()["hits"] == 1
+            assert campaign_availability_cache.stats()["exhausted_campaigns"] == 1
+
+    def test_exhausted_campaign_cache_invalidated_when_codes_generated(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            AvailableDiscountCode.query.delete()
+            db.session.commit()
+            self.create_discount_code(client)
+
+            campaign_availability_cache.codes_added(TEST_CAMPAIGN_ID)
+
+            assert not campaign_availability_cache.is_exhausted(TEST_CAMPAIGN_ID)
+
     def test_discount_code_created_for_user_first_time(
         self, app: Flask, client: FlaskClient
     ) -> None:
@@ -106,6 +162,364 @@ class TestCreateDiscountCode:
             assert create_second.status_code == 409
             assert data["error_code"] == "DISCOUNT_CODE_ALREADY_FETCHED"
 
+    def test_409_does_not_consume_available_discount_code(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            self.create_discount_code(client)
+            available_count_before = AvailableDiscountCode.query.count()
+
+            res = self.create_discount_code(client)
+
+            assert res.status_code == 409
+            assert AvailableDiscountCode.query.count() == available_count_before
+
+    def test_409_if_discount_code_has_been_already_created_and_campaign_is_exhausted(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            self.create_discount_code(client)
+            AvailableDiscountCode.query.delete()
+            db.session.commit()
+
+            res = self.create_discount_code(client)
+            data = res.get_json()
+
+            assert res.status_code == 409
+            assert data["error_code"] == "DISCOUNT_CODE_ALREADY_FETCHED"
+
+    def test_postgresql_claim_is_a_single_statement(self) -> None:
+        statement = str(
+            _claim_statement(campaign_id=1, user_id=1).compile(dialect=postgresql.dialect())
+        )
+
+        assert statement.startswith("WITH claimed AS")
+
+    def test_claim_skips_issued_codes_only_with_leases(self, app: Flask) -> None:
+        with app.app_context():
+            statement = str(
+                _claim_statement(campaign_id=1, user_id=1).compile(dialect=postgresql.dialect())
+            )
+
+        assert ("EXISTS" in statement) == discount_code_lease_pool.enabled
+        assert "FOR UPDATE SKIP LOCKED" in statement
+        assert "INSERT INTO fetched_discount_codes" in statement
+
+
+class TestCreateLeasedDiscountCode(TestCreateDiscountCode):
+    @pytest.fixture(autouse=True)
+    def enable_discount_code_lease(self, app: Flask, monkeypatch: MonkeyPatch) -> None:
+        monkeypatch.setenv("DISCOUNT_CODE_LEASE_ENABLED", "true")
+        monkeypatch.setenv("DISCOUNT_CODE_LEASE_BLOCK_SIZE", "10")
+        # Keep the refill synchronous, so leased codes are deterministic
+        monkeypatch.setenv("DISCOUNT_CODE_LEASE_REFILL_THRESHOLD", "-1")
+        get_settings.cache_clear()
+        discount_code_lease_pool.init_app(app)
+
+    def test_discount_code_created_for_user_first_time(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            res = self.create_discount_code(client)
+            data = res.get_json()
+            # Row of the issued code stays leased until the next refill or lease release
+            leased_discount_code = AvailableDiscountCode.query.filter(
+                AvailableDiscountCode.id == data["id"]
+            ).first()
+            fetched_discount_code = FetchedDiscountCode.query.filter(
+                FetchedDiscountCode.id == data["id"],
+                FetchedDiscountCode.campaign_id == TEST_CAMPAIGN_ID,
+                FetchedDiscountCode.user_id == TEST_USER_ID,
+            ).first()
+
+            assert res.status_code == 201
+            assert leased_discount_code.leased_by == discount_code_lease_pool.worker_id
+            assert fetched_discount_code
+
+    def test_block_of_codes_leased_by_worker(self, app: Flask, client: FlaskClient) -> None:
+        with app.app_context():
+            res = self.create_discount_code(client)
+            leased_codes = AvailableDiscountCode.query.filter(
+                AvailableDiscountCode.leased_by == discount_code_lease_pool.worker_id
+            ).all()
+
+            assert res.status_code == 201
+            assert len(leased_codes) == 10
+            assert res.get_json()["id"] in [code.id for code in leased_codes]
+            assert all(code.lease_expires_at > datetime.datetime.utcnow() for code in leased_codes)
+
+    def test_leased_codes_released_back_to_pool(self, app: Flask, client: FlaskClient) -> None:
+        with app.app_context():
+            res = self.create_discount_code(client)
+
+            discount_code_lease_pool.release_leases()
+
+            assert not AvailableDiscountCode.query.filter(
+                AvailableDiscountCode.leased_by.isnot(None)
+            ).count()
+            assert AvailableDiscountCode.query.count() == 99
+            assert not AvailableDiscountCode.query.get(res.get_json()["id"])
+
+    def test_expired_leases_released_back_to_pool(self, app: Flask, client: FlaskClient) -> None:
+        with app.app_context():
+            AvailableDiscountCode.query.update(
+                {
+                    "leased_by": "crashed-worker",
+                    "lease_expires_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=1),
+                }
+            )
+            db.session.commit()
+
+            res = self.create_discount_code(client)
+
+            assert res.status_code == 201
+            assert (
+                AvailableDiscountCode.query.filter(
+                    AvailableDiscountCode.leased_by == "crashed-worker"
+                ).count()
+                == 0
+            )
+
+    def test_lease_within_safety_margin_not_handed_out(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            first_id = self.create_discount_code(client).get_json()["id"]
+            # Lease expires in less than the safety margin
+            lease = discount_code_lease_pool._leases[TEST_CAMPAIGN_ID]
+            lease.expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+
+            res = self.create_discount_code(client, user_id="2")
+
+            # Handed out from a new lease, unissued codes of the old one may be leased again
+            assert res.status_code == 201
+            assert res.get_json()["id"] != first_id
+            assert discount_code_lease_pool._leases[TEST_CAMPAIGN_ID] is not lease
+            assert discount_code_lease_pool._leases[TEST_CAMPAIGN_ID].expires_at > (
+                datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
+            )
+
+    def test_leased_code_issued_by_other_worker_skipped(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            self.create_discount_code(client)
+            next_leased_id = discount_code_lease_pool._leases[TEST_CAMPAIGN_ID].codes[0].id
+            # Issued by another worker after the lease expired
+            db.session.add(
+                FetchedDiscountCode(id=next_leased_id, campaign_id=TEST_CAMPAIGN_ID, user_id=1)
+            )
+            db.session.commit()
+
+            res = self.create_discount_code(client, user_id="2")
+
+            assert res.status_code == 201
+            assert res.get_json()["id"] != next_leased_id
+
+    def test_exit_handler_registered_once(self, app: Flask, monkeypatch: MonkeyPatch) -> None:
+        registered = []
+        monkeypatch.setattr("atexit.register", registered.append)
+        monkeypatch.setattr(discount_code_lease_pool, "_is_exit_handler_registered", False)
+
+        discount_code_lease_pool.init_app(app)
+        discount_code_lease_pool.init_app(app)
+
+        assert len(registered) == 1
+
+
+class TestCreateBatchedDiscountCode(TestCreateDiscountCode):
+    @pytest.fixture(autouse=True)
+    def enable_claim_batching(self, app: Flask, monkeypatch: MonkeyPatch) -> None:
+        monkeypatch.setenv("DISCOUNT_CODE_CLAIM_BATCHING_ENABLED", "true")
+        monkeypatch.setenv("DISCOUNT_CODE_CLAIM_BATCHING_WINDOW_MS", "200")
+        get_settings.cache_clear()
+        discount_code_claim_coalescer.init_app(app)
+
+    def create_discount_codes_concurrently(
+        self, app: Flask, user_ids: List[str]
+    ) -> List[TestResponse]:
+        responses: List[TestResponse] = [None] * len(user_ids)
+
+        def create_discount_code(index: int, user_id: str) -> None:
+            responses[index] = self.create_discount_code(app.test_client(), user_id=user_id)
+
+        threads = [
+            threading.Thread(target=create_discount_code, args=(index, user_id))
+            for index, user_id in enumerate(user_ids)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_concurrent_claims_served_in_one_batch(self, app: Flask) -> None:
+        user_ids = [str(user_id) for user_id in range(1, 11)]
+
+        responses = self.create_discount_codes_concurrently(app, user_ids)
+
+        with app.app_context():
+            assert [res.status_code for res in responses] == [201] * 10
+            assert [res.get_json()["user_id"] for res in responses] == [int(u) for u in user_ids]
+            assert len({res.get_json()["id"] for res in responses}) == 10
+            assert FetchedDiscountCode.query.count() == 10
+            assert AvailableDiscountCode.query.count() == 90
+            assert discount_code_claim_coalescer.stats() == {"batches": 1, "claims": 10}
+
+    def test_repeated_claim_of_user_in_same_batch(self, app: Flask) -> None:
+        responses = self.create_discount_codes_concurrently(app, [TEST_USER_ID, TEST_USER_ID])
+
+        with app.app_context():
+            assert sorted(res.status_code for res in responses) == [201, 409]
+            assert FetchedDiscountCode.query.count() == 1
+
+    def test_batch_larger_than_available_codes(self, app: Flask) -> None:
+        with app.app_context():
+            AvailableDiscountCode.query.filter(
+                AvailableDiscountCode.id.notin_(
+                    db.session.query(AvailableDiscountCode.id).limit(3).scalar_subquery()
+                )
+            ).delete(synchronize_session=False)
+            db.session.commit()
+
+        responses = self.create_discount_codes_concurrently(app, ["1", "2", "3", "4", "5"])
+
+        assert sorted(res.status_code for res in responses) == [201, 201, 201, 404, 404]
+
+    def test_max_size_starts_next_batch(self, app: Flask, monkeypatch: MonkeyPatch) -> None:
+        monkeypatch.setenv("DISCOUNT_CODE_CLAIM_BATCHING_MAX_SIZE", "2")
+        get_settings.cache_clear()
+        discount_code_claim_coalescer.init_app(app)
+
+        responses = self.create_discount_codes_concurrently(app, ["1", "2", "3", "4"])
+
+        assert [res.status_code for res in responses] == [201] * 4
+        assert discount_code_claim_coalescer.stats() == {"batches": 2, "claims": 4}
+
+
+class TestCreateDiscountCodesBatch:
+    TEST_ADMIN_ID = "987654"
+
+    def create_discount_codes_batch(
+        self, client: FlaskClient, user_ids: list, admin_id: str = TEST_ADMIN_ID
+    ) -> TestResponse:
+        return client.post(
+            f"/api/discounts/{TEST_CAMPAIGN_ID}/batch",
+            headers={"Authorization": admin_id},
+            json={"user_ids": user_ids},
+        )
+
+    def test_401_if_authorization_token_is_not_sent(self, client: FlaskClient) -> None:
+        res = self.create_discount_codes_batch(client, user_ids=[1], admin_id="")
+
+        assert res.status_code == 401
+
+    def test_400_if_request_validation_failed(self, client: FlaskClient) -> None:
+        res = self.create_discount_codes_batch(client, user_ids=[])
+        data = res.get_json()
+
+        assert res.status_code == 400
+        assert data["error_code"] == "REQUEST_VALIDATION_FAILED"
+
+    @pytest.mark.parametrize("user_ids", ["123", {"1": 1}, [True, False], [1, "2"], None])
+    def test_400_if_user_ids_are_not_list_of_integers(
+        self, app: Flask, client: FlaskClient, user_ids
+    ) -> None:
+        with app.app_context():
+            res = self.create_discount_codes_batch(client, user_ids=user_ids)
+
+            assert res.status_code == 400
+            assert res.get_json()["error_code"] == "REQUEST_VALIDATION_FAILED"
+            assert FetchedDiscountCode.query.count() == 0
+
+    def test_discount_codes_created_for_all_users(self, app: Flask, client: FlaskClient) -> None:
+        with app.app_context():
+            res = self.create_discount_codes_batch(client, user_ids=[1, 2, 3])
+            data = res.get_json()
+            created_ids = [result["discount_code"]["id"] for result in data["results"]]
+
+            assert res.status_code == 200
+            assert [result["status"] for result in data["results"]] == ["created"] * 3
+            assert len(set(created_ids)) == 3
+            assert FetchedDiscountCode.query.count() == 3
+            assert AvailableDiscountCode.query.count() == 97
+
+    def test_per_user_results_reported(self, app: Flask, client: FlaskClient) -> None:
+        with app.app_context():
+            client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": "1"})
+            AvailableDiscountCode.query.filter(
+                AvailableDiscountCode.id.notin_(
+                    db.session.query(AvailableDiscountCode.id).limit(1).scalar_subquery()
+                )
+            ).delete(synchronize_session=False)
+            db.session.commit()
+
+            res = self.create_discount_codes_batch(client, user_ids=[1, 2, 2, 3])
+            data = res.get_json()
+
+            assert [(result["user_id"], result["status"]) for result in data["results"]] == [
+                (1, "already_fetched"),
+                (2, "created"),
+                (3, "not_available"),
+            ]
+            assert data["results"][0]["error_code"] == "DISCOUNT_CODE_ALREADY_FETCHED"
+            assert data["results"][2]["error_code"] == "DISCOUNT_CODE_NOT_AVAILABLE"
+
+
+class TestDiscountCodeFetchedEvents:
+    @pytest.fixture(autouse=True)
+    def relay_events_to_memory(self, app: Flask, monkeypatch: MonkeyPatch) -> None:
+        monkeypatch.setenv("DISCOUNT_CODE_EVENT_SINK", "memory")
+        monkeypatch.setenv("DISCOUNT_CODE_EVENT_RELAY_BATCH", "2")
+        monkeypatch.setenv("DISCOUNT_CODE_EVENT_RELAY_IN_BACKGROUND", "false")
+        get_settings.cache_clear()
+        discount_code_event_relay.init_app(app)
+
+    def create_discount_code(
+        self, client: FlaskClient, user_id: str = TEST_USER_ID
+    ) -> TestResponse:
+        return client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": user_id})
+
+    def test_event_written_to_outbox_with_discount_code(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            res = self.create_discount_code(client)
+            event = DiscountCodeFetchedOutbox.query.one()
+            fetched_discount_code = FetchedDiscountCode.query.one()
+
+            assert event.discount_code_id == res.get_json()["id"]
+            assert event.user_id == int(TEST_USER_ID)
+            assert fetched_discount_code.is_fetched_event_sent is False
+
+    def test_no_event_written_if_discount_code_not_created(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            self.create_discount_code(client)
+
+            self.create_discount_code(client)
+
+            assert DiscountCodeFetchedOutbox.query.count() == 1
+
+    def test_relay_publishes_events_in_batches(self, app: Flask, client: FlaskClient) -> None:
+        with app.app_context():
+            for user_id in range(5):
+                self.create_discount_code(client, user_id=str(user_id + 1))
+
+            published_count = discount_code_event_relay.relay()
+
+            assert published_count == 5
+            assert isinstance(discount_code_event_relay.sink, InMemoryEventSink)
+            assert len(discount_code_event_relay.sink.events) == 5
+            assert DiscountCodeFetchedOutbox.query.count() == 0
+            assert (
+                FetchedDiscountCode.query.filter(
+                    FetchedDiscountCode.is_fetched_event_sent.is_(True)
+                ).count()
+                == 5
+            )
+
 
 class TestGetDiscountCode:
     def get_discount_code(
@@ -144,10 +558,95 @@ class TestGetDiscountCode:
             assert data["is_used"] is True
 
 
+class TestGetCachedDiscountCode(TestGetDiscountCode):
+    def test_discount_code_served_from_cache(self, app: Flask, client: FlaskClient) -> None:
+        with app.app_context():
+            db.session.add(
+                FetchedDiscountCode(id="1234", campaign_id=TEST_CAMPAIGN_ID, user_id=TEST_USER_ID)
+            )
+            db.session.commit()
+            self.get_discount_code(client)
+            FetchedDiscountCode.query.delete()
+            db.session.commit()
+
+            res = self.get_discount_code(client)
+
+            assert res.status_code == 200
+            assert res.get_json()["id"] == "1234"
+            assert fetched_discount_code_cache.stats()["hits"] == 1
+
+    def test_not_found_discount_code_served_from_negative_cache(
+        self, app: Flask, client: FlaskClient
+    ) -> None:
+        with app.app_context():
+            self.get_discount_code(client)
+            db.session.add(
+                FetchedDiscountCode(id="1234", campaign_id=TEST_CAMPAIGN_ID, user_id=TEST_USER_ID)
+            )
+            db.session.commit()
+
+            res = self.get_discount_code(client)
+
+            assert res.status_code == 404
+            assert fetched_discount_code_cache.stats()["negative_size"] == 1
+
+    def test_cache_kept_when_fetched_event_is_sent(self, app: Flask, client: FlaskClient) -> None:
+        with app.app_context():
+            db.session.add(
+                FetchedDiscountCode(id="1234", campaign_id=TEST_CAMPAIGN_ID, user_id=TEST_USER_ID)
+            )
+            db.session.add(
+                DiscountCodeFetchedOutbox(
+                    discount_code_id="1234", campaign_id=TEST_CAMPAIGN_ID, user_id=TEST_USER_ID
+                )
+            )
+            db.session.commit()
+            self.get_discount_code(client)
+
+            cached = fetched_discount_code_cache.get(TEST_CAMPAIGN_ID, TEST_USER_ID)
+
+            discount_code_event_relay.relay()
+
+            assert fetched_discount_code_cache.get(TEST_CAMPAIGN_ID, TEST_USER_ID) == cached
+            assert cached["id"] == "1234"
+
+    def test_least_recently_used_entries_evicted(self) -> None:
+        cache = LRUCache(max_size=2)
+        cache.set("first", 1)
+        cache.set("second", 2)
+        cache.get("first")
+
+        cache.set("third", 3)
+
+        assert cache.get("first") == 1
+        assert cache.get("second") is MISSING
+        assert cache.get("third") == 3
+
+    def test_expired_entries_not_returned(self) -> None:
+        cache = LRUCache(ttl=0.01)
+        cache.set("first", 1)
+
+        time.sleep(0.02)
+
+        assert cache.get("first") is MISSING
+
+
 class TestGenerateDiscountCodes:
     TEST_ADMIN_ID = "987654"
     GENERATE_COUNT = 2000
 
+    @pytest.fixture
+    def submitted_jobs(self, monkeypatch: MonkeyPatch) -> List[dict]:
+        """Keeps generation jobs from running in the background; the test runs them with
+        generate_discount_codes_job."""
+        submitted: List[dict] = []
+        monkeypatch.setattr(
+            code_generation,
+            "__generate_discount_codes_job",
+            SimpleNamespace(submit=lambda **kwargs: submitted.append(kwargs)),
+        )
+        return submitted
+
     def generate_discount_code_ids(
         self,
         client: FlaskClient,
@@ -179,6 +678,19 @@ class TestGenerateDiscountCodes:
             assert res.status_code == 404
             assert data["error_code"] == "CAMPAIGN_NOT_FOUND"
 
+    def test_generated_codes_invalidate_exhausted_campaign_cache(
+        self, app: Flask, client: FlaskClient, submitted_jobs: List[dict]
+    ):
+        with app.app_context():
+            AvailableDiscountCode.query.delete()
+            db.session.commit()
+            campaign_availability_cache.mark_exhausted(TEST_CAMPAIGN_ID)
+
+            self.generate_discount_code_ids(client)
+            generate_discount_codes_job(**submitted_jobs[0])
+
+            assert not campaign_availability_cache.is_exhausted(TEST_CAMPAIGN_ID)
+
     def test_400_if_request_validation_failed(self, client: FlaskClient):
         res = self.generate_discount_code_ids(client, discount_codes_count="invalid number")
         data = res.get_json()
@@ -205,6 +717,135 @@ class TestGenerateDiscountCodes:
             assert data["job_id"]
             assert self.GENERATE_COUNT == discount_codes_count
 
+    def test_generation_job_progress_recorded(
+        self, app: Flask, client: FlaskClient, submitted_jobs: List[dict]
+    ):
+        with app.app_context():
+            job_id = self.generate_discount_code_ids(client).get_json()["job_id"]
+            generate_discount_codes_job(**submitted_jobs[0])
+
+            res = client.get(
+                f"/api/discounts/{TEST_CAMPAIGN_ID}/manage/jobs/{job_id}",
+                headers={"Authorization": self.TEST_ADMIN_ID},
+            )
+            data = res.get_json()
+
+            assert res.status_code == 200
+            assert data["status"] == "finished"
+            assert data["target_count"] == self.GENERATE_COUNT
+            assert data["generated_count"] == self.GENERATE_COUNT
+            assert data["rows_per_second"] > 0
+            assert data["finished_at"]
+
+    def test_404_if_generation_job_does_not_exist(self, client: FlaskClient):
+        res = client.get(
+            f"/api/discounts/{TEST_CAMPAIGN_ID}/manage/jobs/unknown",
+            headers={"Authorization": self.TEST_ADMIN_ID},
+        )
+
+        assert res.status_code == 404
+        assert res.get_json()["error_code"] == "GENERATION_JOB_NOT_FOUND"
+
+    def test_interrupted_generation_job_resumed_from_generated_count(
+        self, app: Flask, client: FlaskClient, submitted_jobs: List[dict]
+    ):
+        with app.app_context():
+            AvailableDiscountCode.query.delete()
+            db.session.add(
+                DiscountCodeGenerationJob(
+                    id="interrupted-job",
+                    campaign_id=TEST_CAMPAIGN_ID,
+                    status="running",
+                    target_count=self.GENERATE_COUNT,
+                    generated_count=500,
+                    updated_at=datetime.datetime.utcnow() - datetime.timedelta(hours=1),
+                )
+            )
+            db.session.commit()
+
+            res = client.post(
+                f"/api/discounts/{TEST_CAMPAIGN_ID}/manage/jobs/interrupted-job/resume",
+                headers={"Authorization": self.TEST_ADMIN_ID},
+            )
+            generate_discount_codes_job(**submitted_jobs[0])
+            job = db.session.get(DiscountCodeGenerationJob, "interrupted-job")
+            db.session.refresh(job)
+
+            assert res.status_code == 202
+            assert job.status == "finished"
+            assert job.generated_count == self.GENERATE_COUNT
+            assert AvailableDiscountCode.query.count() == self.GENERATE_COUNT - 500
+
+    def test_409_if_generation_job_is_still_running(self, app: Flask, client: FlaskClient):
+        with app.app_context():
+            db.session.add(
+                DiscountCodeGenerationJob(
+                    id="running-job",
+                    campaign_id=TEST_CAMPAIGN_ID,
+                    status="running",
+                    target_count=self.GENERATE_COUNT,
+                )
+            )
+            db.session.commit()
+
+            res = client.post(
+                f"/api/discounts/{TEST_CAMPAIGN_ID}/manage/jobs/running-job/resume",
+                headers={"Authorization": self.TEST_ADMIN_ID},
+            )
+
+            assert res.status_code == 409
+            assert res.get_json()["error_code"] == "GENERATION_JOB_ALREADY_RUNNING"
+
+    def test_discount_codes_shard_records_progress_to_job(self, app: Flask):
+        with app.app_context():
+            AvailableDiscountCode.query.delete()
+            db.session.add(
+                DiscountCodeGenerationJob(
+                    id="sharded-job",
+                    campaign_id=TEST_CAMPAIGN_ID,
+                    status="running",
+                    target_count=self.GENERATE_COUNT,
+                )
+            )
+            db.session.commit()
+
+            result = generate_discount_codes_shard(
+                get_settings().SQLALCHEMY_DATABASE_URI,
+                "sharded-job",
+                TEST_CAMPAIGN_ID,
+                discount_codes_count=1500,
+                commit_batch=1000,
+                chunk_size=300,
+            )
+            job = db.session.get(DiscountCodeGenerationJob, "sharded-job")
+
+            assert result == {"generated_count": 1500, "error": None}
+            assert job.generated_count == 1500
+            assert AvailableDiscountCode.query.count() == 1500
+
+    def test_discount_codes_generated_in_parallel_shards(
+        self, app: Flask, client: FlaskClient, monkeypatch: MonkeyPatch
+    ):
+        monkeypatch.setenv("DISCOUNT_CODE_GENERATION_PROCESSES", "2")
+        monkeypatch.setenv("DISCOUNT_CODE_GENERATION_SHARD_SIZE", "500")
+        get_settings.cache_clear()
+        with app.app_context():
+            AvailableDiscountCode.query.delete()
+            db.session.commit()
+
+            job_id = self.generate_discount_code_ids(client).get_json()["job_id"]
+            # Spawning worker processes takes longer than generating the codes
+            for _ in range(30):
+                time.sleep(1)
+                job = db.session.get(DiscountCodeGenerationJob, job_id)
+                db.session.refresh(job)
+                if job.status in ("finished", "failed"):
+                    break
+
+            assert job.status == "finished"
+            assert job.generated_count == self.GENERATE_COUNT
+            assert AvailableDiscountCode.query.count() == self.GENERATE_COUNT
+
     def test_discount_codes_are_generated_asynchronously(self, app: Flask, client: FlaskClient):
         with app.app_context():
             AvailableDiscountCode.query.delete()
@@ -0,0 +1,120 @@
+import csv
+import io
+from typing import List
+
+import orjson
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from pytest import MonkeyPatch
+
+from app import db
+from app.config import get_settings
+from app.discounts.export import export_discount_codes
+from app.models import Campaign, FetchedDiscountCode, Marketplace
+
+TEST_CAMPAIGN_ID = "1"
+CODES_COUNT = 7
+
+
+@pytest.fixture(name="issued_codes", autouse=True)
+def issued_codes_fixture(app: Flask, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("DISCOUNT_CODE_EXPORT_CHUNK_SIZE", "3")
+    get_settings.cache_clear()
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="My Test Shop", website_url="https://example.com"))
+        db.session.add(Campaign(id=TEST_CAMPAIGN_ID, name="Campaign", marketplace_id=1))
+        db.session.add(Campaign(id=2, name="Other campaign", marketplace_id=1))
+        # Inserted out of user order - the export is ordered by user id, not by insertion
+        db.session.add_all(
+            FetchedDiscountCode(
+                id=f"CODE{user_id}",
+                campaign_id=TEST_CAMPAIGN_ID,
+                user_id=user_id,
+                is_used=user_id % 2 == 0,
+                is_fetched_event_sent=user_id > 5,
+            )
+            for user_id in reversed(range(1, CODES_COUNT + 1))
+        )
+        db.session.add(FetchedDiscountCode(id="OTHER", campaign_id=2, user_id=1))
+        db.session.commit()
+
+
+def export(client: FlaskClient, campaign_id: str = TEST_CAMPAIGN_ID, **params):
+    return client.get(
+        f"/api/discounts/{campaign_id}/manage/export",
+        query_string=params,
+        headers={"Authorization": "1"},
+    )
+
+
+def ndjson_user_ids(res) -> List[int]:
+    return [orjson.loads(line)["user_id"] for line in res.data.splitlines()]
+
+
+def test_ndjson_export(client: FlaskClient) -> None:
+    res = export(client)
+    lines = [orjson.loads(line) for line in res.data.splitlines()]
+
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    assert [line["user_id"] for line in lines] == list(range(1, CODES_COUNT + 1))
+    assert lines[1] == {
+        "id": "CODE2",
+        "campaign_id": 1,
+        "user_id": 2,
+        "is_used": True,
+        "is_fetched_event_sent": False,
+    }
+
+
+def test_csv_export(client: FlaskClient) -> None:
+    res = export(client, format="csv")
+    rows = list(csv.reader(io.StringIO(res.data.decode())))
+
+    assert res.mimetype == "text/csv"
+    assert rows[0] == ["id", "campaign_id", "user_id", "is_used", "is_fetched_event_sent"]
+    assert rows[1] == ["CODE1", "1", "1", "false", "false"]
+    assert len(rows) == CODES_COUNT + 1
+
+
+def test_filters(client: FlaskClient) -> None:
+    assert ndjson_user_ids(export(client, is_used="true")) == [2, 4, 6]
+    assert ndjson_user_ids(export(client, is_used="false", is_fetched_event_sent="true")) == [7]
+
+
+def test_resume_after_last_user(client: FlaskClient) -> None:
+    assert ndjson_user_ids(export(client, after=4)) == [5, 6, 7]
+    assert ndjson_user_ids(export(client, after=4, is_used="true")) == [6]
+
+
+def test_empty_csv_export_has_header(client: FlaskClient) -> None:
+    res = export(client, format="csv", after=CODES_COUNT)
+
+    assert res.data.decode().splitlines() == [
+        "id,campaign_id,user_id,is_used,is_fetched_event_sent"
+    ]
+
+
+def test_rows_fetched_in_chunks(app: Flask) -> None:
+    with app.app_context():
+        chunks = list(export_discount_codes(TEST_CAMPAIGN_ID, chunk_size=3))
+
+    assert [len(rows) for rows in chunks] == [3, 3, 1]
+
+
+@pytest.mark.parametrize(
+    "params", [{"format": "xml"}, {"is_used": "yes"}, {"after": "last"}], ids=str
+)
+def test_invalid_parameters(client: FlaskClient, params: dict) -> None:
+    res = export(client, **params)
+
+    assert res.status_code == 400
+    assert res.get_json()["error_code"] == "REQUEST_VALIDATION_FAILED"
+
+
+def test_unknown_campaign(client: FlaskClient) -> None:
+    res = export(client, campaign_id="999")
+
+    assert res.status_code == 404
+    assert res.get_json()["error_code"] == "CAMPAIGN_NOT_FOUND"
@@ -0,0 +1,225 @@
+import threading
+import time
+from typing import List, Optional
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from pytest import MonkeyPatch
+from werkzeug.test import TestResponse
+
+from app import create_app, db
+from app.config import get_settings
+from app.discounts import idempotency, routes
+from app.discounts.idempotency import check_shared_store, idempotent_responses
+from app.models import AvailableDiscountCode, Campaign, FetchedDiscountCode, Marketplace
+from app.util.redis_client import create_redis_client
+
+TEST_CAMPAIGN_ID = "1"
+TEST_USER_ID = "123456"
+
+
+@pytest.fixture(name="claims", autouse=True)
+def claims_fixture(app: Flask, monkeypatch: MonkeyPatch) -> List[int]:
+    """User ids of `create_discount_code` calls."""
+    monkeypatch.setenv("IDEMPOTENCY_REDIS_URL", "memory://idempotency-test")
+    monkeypatch.setenv("IDEMPOTENCY_WAIT_SECONDS", "0.5")
+    monkeypatch.setenv("IDEMPOTENCY_POLL_INTERVAL_MS", "1")
+    get_settings.cache_clear()
+    idempotent_responses.init_app(app)
+    idempotent_responses.redis.flushall()
+
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="My Test Shop", website_url="https://example.com"))
+        db.session.add(Campaign(id=TEST_CAMPAIGN_ID, name="Campaign", marketplace_id=1))
+        db.session.add_all(AvailableDiscountCode(campaign_id=TEST_CAMPAIGN_ID) for _ in range(5))
+        db.session.commit()
+
+    claims = []
+    create_discount_code = routes.create_discount_code
+
+    def counted_create_discount_code(campaign_id, user_id):
+        claims.append(user_id)
+        return create_discount_code(campaign_id=campaign_id, user_id=user_id)
+
+    monkeypatch.setattr(routes, "create_discount_code", counted_create_discount_code)
+    return claims
+
+
+def create_discount_code(
+    client: FlaskClient, idempotency_key: Optional[str] = "key-1", user_id: str = TEST_USER_ID
+) -> TestResponse:
+    headers = {"Authorization": user_id}
+    if idempotency_key is not None:
+        headers["Idempotency-Key"] = idempotency_key
+    return client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers=headers)
+
+
+def test_retry_gets_original_response_without_claiming(
+    app: Flask, client: FlaskClient, claims: List[int]
+) -> None:
+    first = create_discount_code(client)
+
+    retry = create_discount_code(client)
+
+    assert first.status_code == retry.status_code == 201
+    assert retry.data == first.data
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert claims == [int(TEST_USER_ID)]
+    with app.app_context():
+        assert FetchedDiscountCode.query.count() == 1
+
+
+def test_retry_replayed_by_another_worker(app: Flask, claims: List[int]) -> None:
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    responses = []
+    for _ in range(2):
+        # Apps of two workers with their own connections to one Redis server
+        worker_app = create_app()
+        idempotent_responses.redis = fakeredis.FakeRedis(server=server)
+        responses.append(create_discount_code(worker_app.test_client()))
+
+    first, retry = responses
+    assert first.status_code == retry.status_code == 201
+    assert retry.data == first.data
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert claims == [int(TEST_USER_ID)]
+
+
+def test_per_process_store_refused_for_more_workers(monkeypatch: MonkeyPatch) -> None:
+    check_shared_store(workers_count=1)
+
+    with pytest.raises(RuntimeError, match="per process"):
+        check_shared_store(workers_count=4)
+
+    monkeypatch.setenv("IDEMPOTENCY_ENABLED", "false")
+    get_settings.cache_clear()
+    check_shared_store(workers_count=4)
+
+
+def test_unreachable_redis_refused(monkeypatch: MonkeyPatch) -> None:
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setenv("IDEMPOTENCY_REDIS_URL", "redis://localhost:1/1")
+    get_settings.cache_clear()
+
+    with pytest.raises(RuntimeError, match="can't be reached"):
+        check_shared_store(workers_count=4)
+
+    monkeypatch.setattr(idempotency, "create_redis_client", lambda url: fakeredis.FakeRedis())
+    check_shared_store(workers_count=4)
+
+
+def test_keys_are_scoped_to_user_and_campaign(client: FlaskClient, claims: List[int]) -> None:
+    first = create_discount_code(client)
+
+    other_key = create_discount_code(client, idempotency_key="key-2")
+    other_user = create_discount_code(client, user_id="2")
+    without_key = create_discount_code(client, idempotency_key=None)
+
+    assert other_key.status_code == 409
+    assert other_user.status_code == 201
+    assert other_user.get_json()["id"] != first.get_json()["id"]
+    assert without_key.status_code == 409
+    assert claims == [int(TEST_USER_ID), int(TEST_USER_ID), 2, int(TEST_USER_ID)]
+
+
+def test_error_response_replayed(client: FlaskClient, claims: List[int]) -> None:
+    create_discount_code(client, idempotency_key=None)
+
+    first = create_discount_code(client)
+    retry = create_discount_code(client)
+
+    assert first.status_code == retry.status_code == 409
+    assert retry.get_json()["error_code"] == "DISCOUNT_CODE_ALREADY_FETCHED"
+    assert len(claims) == 2
+
+
+def test_server_error_not_stored(
+    client: FlaskClient, claims: List[int], monkeypatch: MonkeyPatch
+) -> None:
+    create_discount_code_once = routes.create_discount_code
+
+    def failing_create_discount_code(campaign_id, user_id):
+        monkeypatch.setattr(routes, "create_discount_code", create_discount_code_once)
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr(routes, "create_discount_code", failing_create_discount_code)
+
+    first = create_discount_code(client)
+    retry = create_discount_code(client)
+
+    assert first.status_code == 500
+    assert retry.status_code == 201
+    assert "Idempotent-Replayed" not in retry.headers
+
+
+def test_concurrent_duplicate_waits_for_first_request(
+    client: FlaskClient, claims: List[int], monkeypatch: MonkeyPatch
+) -> None:
+    create_discount_code_now = routes.create_discount_code
+    first_started = threading.Event()
+
+    def slow_create_discount_code(campaign_id, user_id):
+        first_started.set()
+        time.sleep(0.1)
+        return create_discount_code_now(campaign_id, user_id)
+
+    monkeypatch.setattr(routes, "create_discount_code", slow_create_discount_code)
+    responses = {}
+    first = threading.Thread(
+        target=lambda: responses.setdefault("first", create_discount_code(client))
+    )
+    first.start()
+    first_started.wait()
+
+    duplicate = create_discount_code(client)
+    first.join()
+
+    assert responses["first"].status_code == duplicate.status_code == 201
+    assert duplicate.data == responses["first"].data
+    assert duplicate.headers["Idempotent-Replayed"] == "true"
+    assert claims == [int(TEST_USER_ID)]
+
+
+def test_duplicate_gives_up_waiting(client: FlaskClient, claims: List[int]) -> None:
+    key = idempotent_responses.key(int(TEST_USER_ID), f"/api/discounts/{TEST_CAMPAIGN_ID}", "key-1")
+    # Taken by a request which is still running in another worker
+    idempotent_responses.redis.set(key, b"in-flight:other", ex=30)
+
+    res = create_discount_code(client)
+
+    assert res.status_code == 409
+    assert res.get_json()["error_code"] == "IDEMPOTENCY_KEY_IN_USE"
+    assert not claims
+
+
+def test_too_long_key_rejected(client: FlaskClient, claims: List[int]) -> None:
+    res = create_discount_code(client, idempotency_key="k" * 256)
+
+    assert res.status_code == 400
+    assert res.get_json()["error_code"] == "REQUEST_VALIDATION_FAILED"
+    assert not claims
+
+
+def test_disabled(app: Flask, client: FlaskClient, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("IDEMPOTENCY_ENABLED", "false")
+    get_settings.cache_clear()
+    idempotent_responses.init_app(app)
+
+    assert create_discount_code(client).status_code == 201
+    assert create_discount_code(client).status_code == 409
+
+
+def test_in_process_store_evicts_oldest_keys() -> None:
+    redis = create_redis_client("memory://idempotency-eviction-test?max_keys=2")
+    redis.set("a", 1)
+    redis.set("b", 2)
+    redis.set("a", 3)
+
+    redis.set("c", 4)
+
+    assert redis.get("a") is None
+    assert redis.get("b") == b"2"
+    assert redis.get("c") == b"4"
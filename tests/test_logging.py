@@ -0,0 +1,107 @@
+import io
+import json
+import logging
+
+import pytest
+import structlog
+from flask import Flask
+
+from app.middleware import enrich_structlog_with_request_context
+from app.util.structlog import (
+    AsyncLogWriter,
+    EventSampler,
+    QueueLogger,
+    add_timestamp,
+    return_event_dict,
+)
+
+
+def create_logger(writer: AsyncLogWriter, sampler: EventSampler = None):
+    processors = [structlog.processors.add_log_level, add_timestamp, return_event_dict]
+    if sampler:
+        processors.insert(0, sampler)
+    return structlog.wrap_logger(
+        QueueLogger(writer),
+        processors=processors,
+        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
+    )
+
+
+def written_events(stream: io.StringIO) -> list:
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_events_written_as_json_lines_by_background_writer() -> None:
+    stream = io.StringIO()
+    writer = AsyncLogWriter(stream, batch_size=2)
+    writer.start()
+    logger = create_logger(writer)
+
+    logger.info("discount_code_created", id="ABC", user_id=1)
+    logger.debug("not_logged_below_info")
+    logger.error("app_error", error_code="DISCOUNT_CODE_NOT_FOUND")
+    writer.stop()
+
+    events = written_events(stream)
+    assert [(event["event"], event["level"]) for event in events] == [
+        ("discount_code_created", "info"),
+        ("app_error", "error"),
+    ]
+    assert events[0]["id"] == "ABC"
+    assert events[0]["timestamp"].endswith("+00:00")
+    assert writer.stats() == {"queued": 0, "written": 2, "dropped": 0}
+
+
+def test_events_dropped_when_queue_is_full() -> None:
+    stream = io.StringIO()
+    # Writer is not running yet, so the queue doesn't drain
+    writer = AsyncLogWriter(stream, queue_size=2)
+    logger = create_logger(writer)
+
+    for index in range(5):
+        logger.info("discount_code_created", index=index)
+    writer.start()
+    writer.stop()
+
+    events = written_events(stream)
+    assert [event.get("index") for event in events] == [0, 1, None]
+    assert events[-1]["event"] == "log_events_dropped"
+    assert events[-1]["count"] == 3
+    assert writer.stats()["dropped"] == 3
+
+
+@pytest.mark.parametrize(
+    ("sample_rate", "written_count"),
+    [(0.0, 0), (1.0, 10)],
+)
+def test_success_path_events_sampled(sample_rate: float, written_count: int) -> None:
+    stream = io.StringIO()
+    writer = AsyncLogWriter(stream)
+    writer.start()
+    sampler = EventSampler({"discount_code_created": sample_rate})
+    logger = create_logger(writer, sampler)
+
+    for _ in range(10):
+        logger.info("discount_code_created")
+    logger.error("app_error")
+    writer.stop()
+
+    events = written_events(stream)
+    assert len([e for e in events if e["event"] == "discount_code_created"]) == written_count
+    assert [e for e in events if e["event"] == "app_error"]
+    assert sampler.sampled_out_count == 10 - written_count
+
+
+def test_request_context_bound_to_logs(app: Flask) -> None:
+    with app.test_request_context(
+        "/api/discounts/1",
+        headers={"X-Request-ID": "request-1", "X-Forwarded-For": "10.0.0.1, 10.0.0.2"},
+        environ_base={"REMOTE_ADDR": "127.0.0.1"},
+    ):
+        enrich_structlog_with_request_context()
+
+        context = structlog.threadlocal.get_threadlocal()
+        assert context["request_id"] == "request-1"
+        assert context["peer"] == "10.0.0.1"
+        assert context["remote_addr"] == "127.0.0.1"
+        assert context["view"] == "/api/discounts/1"
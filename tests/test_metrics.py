@@ -0,0 +1,91 @@
+import subprocess  # nosec
+import sys
+from pathlib import Path
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from prometheus_client import REGISTRY
+from pytest import MonkeyPatch
+
+from app import db
+from app.models import AvailableDiscountCode, Campaign, Marketplace
+
+TEST_CAMPAIGN_ID = 1
+ROUTE = "/api/discounts/<campaign_id>"
+
+
+@pytest.fixture(name="create_test_discount_code", autouse=True)
+def create_test_discount_code_fixture(app: Flask) -> None:
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="My Test Shop", website_url="https://example.com"))
+        db.session.add(Campaign(id=TEST_CAMPAIGN_ID, name="Campaign", marketplace_id=1))
+        db.session.add(AvailableDiscountCode(campaign_id=TEST_CAMPAIGN_ID))
+        db.session.commit()
+
+
+def sample_value(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_claim_outcomes_counted(client: FlaskClient) -> None:
+    before = {
+        outcome: sample_value("discount_code_claims_total", outcome=outcome)
+        for outcome in ("created", "already_fetched", "not_available")
+    }
+
+    client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": "1"})
+    client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": "1"})
+    client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": "2"})
+
+    assert {
+        outcome: sample_value("discount_code_claims_total", outcome=outcome) - value
+        for outcome, value in before.items()
+    } == {"created": 1, "already_fetched": 1, "not_available": 1}
+
+
+def test_request_latency_and_db_statements_recorded(client: FlaskClient) -> None:
+    labels = {"route": ROUTE, "method": "POST"}
+    requests_before = sample_value("http_request_duration_seconds_count", **labels)
+    statements_before = sample_value("http_request_db_statements_sum", **labels)
+    created_before = sample_value("http_requests_total", status="201", **labels)
+
+    res = client.post(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": "1"})
+
+    assert res.status_code == 201
+    assert sample_value("http_request_duration_seconds_count", **labels) == requests_before + 1
+    assert sample_value("http_request_db_statements_sum", **labels) > statements_before
+    assert sample_value("http_requests_total", status="201", **labels) == created_before + 1
+
+
+def test_metrics_served_in_prometheus_text_format(client: FlaskClient) -> None:
+    client.get(f"/api/discounts/{TEST_CAMPAIGN_ID}", headers={"Authorization": "1"})
+
+    res = client.get("/metrics")
+
+    assert res.status_code == 200
+    assert res.content_type.startswith("text/plain")
+    body = res.get_data(as_text=True)
+    assert "# TYPE http_request_duration_seconds histogram" in body
+    assert "# TYPE discount_code_claims_total counter" in body
+    assert f'route="{ROUTE}"' in body
+
+
+def test_metrics_aggregated_across_processes(
+    client: FlaskClient, monkeypatch: MonkeyPatch, tmp_path: Path
+) -> None:
+    # Own directory - the collector reads all *.db files, also the test database
+    metrics_dir = tmp_path / "metrics"
+    metrics_dir.mkdir()
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(metrics_dir))
+    record_claim = (
+        "from app.metrics import DISCOUNT_CODE_CLAIMS; "
+        "DISCOUNT_CODE_CLAIMS.labels('created').inc()"
+    )
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", record_claim], check=True)  # nosec
+
+    res = client.get("/metrics")
+
+    assert res.status_code == 200
+    assert 'discount_code_claims_total{outcome="created"} 2.0' in res.get_data(as_text=True)
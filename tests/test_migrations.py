@@ -0,0 +1,110 @@
+import pytest
+from flask import Flask
+from sqlalchemy import inspect, text
+
+from app import db
+from app.migrations import MIGRATIONS, get_current_version, migrate
+from app.models import Campaign, Marketplace
+
+# Schema of the discount code tables before the first migration
+LEGACY_SCHEMA = [
+    """
+    CREATE TABLE available_discount_codes (
+        id VARCHAR(10) NOT NULL,
+        campaign_id INTEGER NOT NULL,
+        PRIMARY KEY (id, campaign_id),
+        UNIQUE (id),
+        FOREIGN KEY(campaign_id) REFERENCES campaigns (id)
+    )
+    """,
+    """
+    CREATE TABLE fetched_discount_codes (
+        id VARCHAR(10) NOT NULL,
+        campaign_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        is_used BOOLEAN NOT NULL,
+        is_fetched_event_sent BOOLEAN NOT NULL,
+        PRIMARY KEY (id, campaign_id, user_id),
+        UNIQUE (id),
+        FOREIGN KEY(campaign_id) REFERENCES campaigns (id)
+    )
+    """,
+]
+
+
+@pytest.fixture(name="legacy_schema")
+def legacy_schema_fixture(app: Flask) -> None:
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="Shop", website_url="https://shop.com"))
+        db.session.add(Campaign(id=1, name="Campaign", marketplace_id=1))
+        db.session.commit()
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP TABLE available_discount_codes"))
+            connection.execute(text("DROP TABLE fetched_discount_codes"))
+            connection.execute(text("DROP TABLE discount_code_fetched_outbox"))
+            connection.execute(text("DROP TABLE schema_migrations"))
+            connection.execute(text("DROP TABLE campaign_counters"))
+            for statement in LEGACY_SCHEMA:
+                connection.execute(text(statement))
+            connection.execute(
+                text("INSERT INTO available_discount_codes (id, campaign_id) VALUES ('A', 1)")
+            )
+            connection.execute(
+                text(
+                    "INSERT INTO fetched_discount_codes "
+                    "(id, campaign_id, user_id, is_used, is_fetched_event_sent) "
+                    "VALUES ('F', 1, 123, 0, 1)"
+                )
+            )
+
+
+@pytest.mark.usefixtures("legacy_schema")
+def test_legacy_schema_migrated_to_claim_optimized_indexes(app: Flask):
+    with app.app_context(), db.engine.begin() as connection:
+        applied_versions = migrate(connection)
+        inspector = inspect(connection)
+
+        assert applied_versions == [1, 2, 3]
+        assert get_current_version(connection) == 3
+        assert inspector.get_pk_constraint("available_discount_codes")["constrained_columns"] == [
+            "id"
+        ]
+        assert inspector.get_pk_constraint("fetched_discount_codes")["constrained_columns"] == [
+            "id"
+        ]
+        assert {index["name"] for index in inspector.get_indexes("available_discount_codes")} == {
+            "ix_available_discount_codes_campaign_id_not_leased",
+            "ix_available_discount_codes_leased_by",
+        }
+        assert [
+            constraint["column_names"]
+            for constraint in inspector.get_unique_constraints("fetched_discount_codes")
+        ] == [["campaign_id", "user_id"]]
+        assert inspector.has_table("discount_code_fetched_outbox")
+        assert connection.execute(text("SELECT id FROM available_discount_codes")).all() == [("A",)]
+        assert connection.execute(text("SELECT id FROM fetched_discount_codes")).all() == [("F",)]
+        assert connection.execute(
+            text(
+                "SELECT campaign_id, available_count, issued_count, redeemed_count "
+                "FROM campaign_counters"
+            )
+        ).all() == [(1, 1, 1, 0)]
+
+
+@pytest.mark.usefixtures("legacy_schema")
+def test_applied_migrations_not_applied_again(app: Flask):
+    with app.app_context(), db.engine.begin() as connection:
+        migrate(connection)
+
+        assert migrate(connection) == []
+
+
+def test_new_database_created_with_latest_version(app: Flask):
+    with app.app_context():
+        db.drop_all()
+        with db.engine.begin() as connection:
+            applied_versions = migrate(connection)
+
+            assert applied_versions == []
+            assert get_current_version(connection) == MIGRATIONS[-1].version
+            assert inspect(connection).has_table("available_discount_codes")
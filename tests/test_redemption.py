@@ -0,0 +1,146 @@
+import io
+from typing import List
+
+import orjson
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from pytest import MonkeyPatch
+
+from app import db
+from app.config import get_settings
+from app.discounts.bulk import MAX_LINE_BYTES, parse_code_ids
+from app.discounts.code_cache import fetched_discount_code_cache
+from app.models import Campaign, FetchedDiscountCode, Marketplace
+
+TEST_CAMPAIGN_ID = "1"
+OTHER_CAMPAIGN_ID = "2"
+ISSUED_CODES = [f"CODE{index:06d}" for index in range(10)]
+
+
+@pytest.fixture(name="issued_codes", autouse=True)
+def issued_codes_fixture(app: Flask, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("DISCOUNT_CODE_REDEMPTION_CHUNK_SIZE", "4")
+    get_settings.cache_clear()
+    with app.app_context():
+        db.session.add(Marketplace(id=1, name="My Test Shop", website_url="https://example.com"))
+        db.session.add(Campaign(id=TEST_CAMPAIGN_ID, name="Campaign", marketplace_id=1))
+        db.session.add(Campaign(id=OTHER_CAMPAIGN_ID, name="Other campaign", marketplace_id=1))
+        db.session.add_all(
+            FetchedDiscountCode(id=code_id, campaign_id=TEST_CAMPAIGN_ID, user_id=user_id)
+            for user_id, code_id in enumerate(ISSUED_CODES, start=1)
+        )
+        db.session.add(FetchedDiscountCode(id="OTHER", campaign_id=OTHER_CAMPAIGN_ID, user_id=1))
+        db.session.commit()
+
+
+def redeem(client: FlaskClient, body: bytes, content_type: str = "application/x-ndjson"):
+    return client.post(
+        f"/api/discounts/{TEST_CAMPAIGN_ID}/manage/redemptions",
+        data=body,
+        headers={"Authorization": "1", "Content-Type": content_type},
+    )
+
+
+def response_lines(res) -> List[dict]:
+    return [orjson.loads(line) for line in res.data.splitlines()]
+
+
+def used_code_ids(app: Flask) -> List[str]:
+    with app.app_context():
+        return sorted(code.id for code in FetchedDiscountCode.query.filter_by(is_used=True))
+
+
+def test_ndjson_redeemed_in_chunks(app: Flask, client: FlaskClient) -> None:
+    lines = [orjson.dumps(code_id) for code_id in ISSUED_CODES[:5]]
+    lines.append(orjson.dumps({"id": ISSUED_CODES[5]}))
+    body = b"\n".join(lines) + b"\n"
+
+    res = redeem(client, body)
+
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    assert response_lines(res) == [
+        {"chunk": 1, "redeemed": 4, "already_used": 0, "unknown": 0, "invalid": 0},
+        {"chunk": 2, "redeemed": 2, "already_used": 0, "unknown": 0, "invalid": 0},
+        {"totals": {"redeemed": 6, "already_used": 0, "unknown": 0, "invalid": 0}},
+    ]
+    assert used_code_ids(app) == ISSUED_CODES[:6]
+
+
+def test_already_used_unknown_and_invalid_counted(app: Flask, client: FlaskClient) -> None:
+    redeem(client, orjson.dumps(ISSUED_CODES[0]))
+    body = b"\n".join(
+        [
+            orjson.dumps(ISSUED_CODES[0]),  # already used
+            orjson.dumps(ISSUED_CODES[1]),
+            orjson.dumps(ISSUED_CODES[1]),  # repeated in the chunk
+            b"",
+            orjson.dumps("OTHER"),  # issued for another campaign
+            b"not json",
+            orjson.dumps(123),
+            orjson.dumps("X" * 11),  # longer than any code id
+            orjson.dumps("NOPE"),
+            orjson.dumps("NOPE"),
+        ]
+    )
+
+    res = redeem(client, body)
+
+    assert response_lines(res)[-1] == {
+        "totals": {"redeemed": 1, "already_used": 2, "unknown": 3, "invalid": 3}
+    }
+    assert used_code_ids(app) == ISSUED_CODES[:2]
+    with app.app_context():
+        assert not db.session.get(FetchedDiscountCode, "OTHER").is_used
+
+
+def test_csv_redeemed(app: Flask, client: FlaskClient) -> None:
+    body = "id,order\r\n" + "".join(f"{code_id},order-1\r\n" for code_id in ISSUED_CODES[:3])
+
+    res = redeem(client, body.encode(), content_type="text/csv")
+
+    assert response_lines(res)[-1]["totals"]["redeemed"] == 3
+    assert used_code_ids(app) == ISSUED_CODES[:3]
+
+
+def test_cached_code_updated(app: Flask, client: FlaskClient) -> None:
+    get_path = f"/api/discounts/{TEST_CAMPAIGN_ID}"
+    assert client.get(get_path, headers={"Authorization": "1"}).get_json()["is_used"] is False
+
+    redeem(client, orjson.dumps(ISSUED_CODES[0]))
+
+    assert fetched_discount_code_cache.get(TEST_CAMPAIGN_ID, 1)["is_used"] is True
+    assert client.get(get_path, headers={"Authorization": "1"}).get_json()["is_used"] is True
+
+
+def test_empty_body(client: FlaskClient) -> None:
+    res = redeem(client, b"")
+
+    assert response_lines(res) == [
+        {"totals": {"redeemed": 0, "already_used": 0, "unknown": 0, "invalid": 0}}
+    ]
+
+
+def test_unsupported_content_type(client: FlaskClient) -> None:
+    res = redeem(client, b"{}", content_type="application/json")
+
+    assert res.status_code == 400
+    assert res.get_json()["error_code"] == "REQUEST_VALIDATION_FAILED"
+
+
+def test_unknown_campaign(client: FlaskClient) -> None:
+    res = client.post(
+        "/api/discounts/999/manage/redemptions",
+        data=b"",
+        headers={"Authorization": "1", "Content-Type": "application/x-ndjson"},
+    )
+
+    assert res.status_code == 404
+    assert res.get_json()["error_code"] == "CAMPAIGN_NOT_FOUND"
+
+
+def test_long_lines_skipped_without_reading_them_whole() -> None:
+    stream = io.BytesIO(b'"A"\n' + b"x" * (MAX_LINE_BYTES * 5) + b'\n"B"')
+
+    assert list(parse_code_ids(stream, "application/x-ndjson")) == ["A", None, "B"]
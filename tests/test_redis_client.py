@@ -0,0 +1,93 @@
+import time
+from typing import Any, Callable, List
+
+import pytest
+
+from app.util.redis_client import InProcessRedis, create_redis_client
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def run_on_both(commands: Callable[[Any], List[Any]]) -> None:
+    """Runs the commands on the stand-in and on fakeredis, their results must match."""
+    assert commands(InProcessRedis()) == commands(fakeredis.FakeRedis())
+
+
+def test_strings_match_redis() -> None:
+    run_on_both(
+        lambda redis: [
+            redis.get("key"),
+            redis.set("key", "1"),
+            redis.set("key", "2", nx=True),
+            redis.get("key"),
+            redis.set("key", 3, ex=60),
+            redis.get("key"),
+            redis.set("other", b"value", nx=True, px=60000),
+            redis.delete("key", "other", "missing"),
+            redis.get("key"),
+            redis.delete("key"),
+        ]
+    )
+
+
+def test_expired_keys_match_redis() -> None:
+    def commands(redis) -> List[Any]:
+        results = [redis.set("key", "1", px=50), redis.set("lock", "1", nx=True, px=50)]
+        time.sleep(0.1)
+        return results + [redis.get("key"), redis.set("lock", "2", nx=True), redis.get("lock")]
+
+    run_on_both(commands)
+
+
+def test_lists_match_redis() -> None:
+    run_on_both(
+        lambda redis: [
+            redis.lpop("list"),
+            redis.llen("list"),
+            redis.lrange("list", 0, -1),
+            redis.ltrim("list", 0, -1),
+            redis.rpush("list", "a", b"b", 3),
+            redis.rpush("list", "d", "e"),
+            redis.llen("list"),
+            redis.lrange("list", 0, 1),
+            redis.lrange("list", 1, -1),
+            redis.lrange("list", -2, 10),
+            redis.lrange("list", 4, 2),
+            redis.lpop("list"),
+            redis.ltrim("list", 2, -1),
+            redis.lrange("list", 0, -1),
+            redis.ltrim("list", 5, -1),
+            redis.llen("list"),
+            redis.lpop("list"),
+            redis.rpush("list", "f"),
+            redis.delete("list"),
+            redis.lrange("list", 0, -1),
+        ]
+    )
+
+
+def test_pipeline_matches_redis() -> None:
+    def commands(redis) -> List[Any]:
+        with redis.pipeline(transaction=True) as pipeline:
+            results = pipeline.set("key", "1", nx=True).rpush("list", "a", "b").execute()
+        with redis.pipeline(transaction=False) as pipeline:
+            pipeline.set("key", "2", nx=True)
+            pipeline.lpop("list")
+            results += pipeline.execute()
+        return results + [redis.get("key"), redis.lrange("list", 0, -1)]
+
+    run_on_both(commands)
+
+
+def test_unsupported_command_refused_when_queued() -> None:
+    with pytest.raises(AttributeError):
+        InProcessRedis().pipeline().incr("key")
+
+
+def test_memory_url_shared_by_the_process() -> None:
+    redis = create_redis_client("memory://redis-client-test")
+    redis.flushall()
+    redis.set("key", "1")
+
+    assert create_redis_client("memory://redis-client-test").get("key") == b"1"
+    assert create_redis_client("memory://redis-client-other-test").get("key") is None
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+from flask import Flask
+
+from app.errors.handlers import api_error_response
+from app.models import FetchedDiscountCode
+from app.util.serialization import (
+    encode_error,
+    encode_fetched_discount_code,
+    json_response,
+)
+
+
+@pytest.mark.parametrize(
+    "discount_code",
+    [
+        FetchedDiscountCode(id="A1B2C3D4E5", campaign_id=1, user_id=123456, is_used=False),
+        FetchedDiscountCode(id="ZZZZZZZZZZ", campaign_id=42, user_id=1, is_used=True),
+        # Not a code of the generators - escaped by the encoder
+        FetchedDiscountCode(id='A"\\B-ü', campaign_id=1, user_id=2, is_used=False),
+    ],
+)
+def test_fetched_discount_code_encoded_as_its_dict(discount_code: FetchedDiscountCode) -> None:
+    assert json.loads(encode_fetched_discount_code(discount_code)) == discount_code.to_dict()
+
+
+def test_error_bodies_encoded_once() -> None:
+    body = encode_error("DISCOUNT_CODE_NOT_FOUND")
+
+    assert json.loads(body) == {"error_code": "DISCOUNT_CODE_NOT_FOUND"}
+    assert encode_error("DISCOUNT_CODE_NOT_FOUND") is body
+    assert json.loads(encode_error(404, "Not Found")) == {
+        "error_code": 404,
+        "error_message": "Not Found",
+    }
+
+
+def test_json_responses(app: Flask) -> None:
+    with app.app_context():
+        response = json_response({"job_id": "1"}, 202)
+        error_response = api_error_response("CAMPAIGN_NOT_FOUND", status_code=404)
+
+    assert response.status_code == 202
+    assert response.mimetype == "application/json"
+    assert response.get_json() == {"job_id": "1"}
+    assert error_response.status_code == 404
+    assert error_response.get_json() == {"error_code": "CAMPAIGN_NOT_FOUND"}
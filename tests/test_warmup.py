@@ -0,0 +1,57 @@
+import pytest
+from flask import Flask
+from pytest import MonkeyPatch
+from sqlalchemy import event
+
+from app import db
+from app.config import get_settings
+from app.warmup import warmup
+
+
+@pytest.fixture(name="warmup_enabled")
+def warmup_enabled_fixture(app: Flask, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("WARMUP_ENABLED", "true")
+    get_settings.cache_clear()
+    warmup.init_app(app)
+
+
+def test_ready_without_warmup(app: Flask) -> None:
+    response = app.test_client().get("/ready")
+
+    assert response.status_code == 200
+    assert response.get_json() == {"status": "ready"}
+
+
+@pytest.mark.usefixtures("warmup_enabled")
+def test_ready_only_after_warmup(app: Flask) -> None:
+    client = app.test_client()
+    assert client.get("/ready").status_code == 503
+    assert client.get("/ready").get_json() == {"error_code": "WORKER_NOT_READY"}
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    warmup.warm_up(app)
+
+    assert client.get("/ready").status_code == 200
+    # Claim and lookup statements were compiled and executed once
+    assert any(
+        statement.startswith("SELECT available_discount_codes.id") for statement in statements
+    )
+    assert any("FROM fetched_discount_codes" in statement for statement in statements)
+
+
+@pytest.mark.usefixtures("warmup_enabled")
+def test_failed_warmup_retried_by_readiness_check(app: Flask) -> None:
+    with app.app_context():
+        db.drop_all()
+    warmup.warm_up(app)
+    assert warmup.has_failed
+    client = app.test_client()
+    assert client.get("/ready").status_code == 503
+
+    with app.app_context():
+        db.create_all()
+
+    assert client.get("/ready").status_code == 200
+    assert not warmup.has_failed